@@ -0,0 +1,295 @@
+"""
+Dialogue inference benchmark.
+
+Measures get_dialogue/generate_response with either a randomly initialized
+tiny GPT-2 (fast, no download needed) or the fine-tuned checkpoint when it
+is present, over a sweep of conversation lengths, batch sizes, attention
+backends and thread counts. Results are written as JSON so runs of
+different commits can be compared with --compare.
+
+    python -m benchmarks.dialogue_benchmark --mode tiny
+    python -m benchmarks.dialogue_benchmark --mode checkpoint --compare benchmarks/results/old.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+
+import numpy as np
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from game import dialoGPT
+from game.dialoGPT import get_dialogue, load_models
+from game.dialogue_stub import StubTokenizer
+
+
+CHECKPOINT_PATH = "game/static/game/dialoGPT.pth"
+
+PLAYER = {
+    "name": "Player",
+    "persona": "I am an explorer from earth. I like to travel to different places and learn about strong but interesting things.",
+    "appearance": "I am wearing jeans and a long black windbreaker."
+}
+
+CHARACTER = {
+    "name": "Rubeus Hagrid",
+    "location": "Diagon Alley",
+    "location_description": "Diagon Alley is a hidden wizard commerce and retail section in London.",
+    "persona": "Rubeus Hagrid is a half-giant who takes Harry to Diagon Alley to buy school supplies and a wand.",
+    "appearance": "Rubeus Hagrid is a giant of a man with a wild black beard.",
+    "dialogues": []
+}
+
+EXCHANGES = [
+    ("Where can I buy a wand?", "Ollivander's sells the best wands in London."),
+    ("Who are you?", "I am the keeper of keys and grounds at Hogwarts."),
+    ("What is this place?", "This is Diagon Alley, where wizards buy their supplies."),
+    ("Is it dangerous here?", "Not if you stay close to me."),
+]
+
+
+def load_tokenizer():
+    """
+    The DialoGPT tokenizer if it is in the local cache, otherwise the byte
+    tokenizer stand-in.
+    """
+    try:
+        from transformers import GPT2Tokenizer
+        tokenizer = GPT2Tokenizer.from_pretrained("microsoft/DialoGPT-small", local_files_only=True)
+    except (OSError, ValueError):
+        return StubTokenizer()
+    # some versions return an empty tokenizer instead of raising
+    if len(tokenizer) < 50257:
+        return StubTokenizer()
+    return tokenizer
+
+
+def load_benchmark_models(mode, backend):
+    """
+    Returns (tokenizer, model, mode) where mode is "tiny" or "checkpoint".
+    """
+    if mode == "auto":
+        mode = "checkpoint" if os.path.exists(CHECKPOINT_PATH) else "tiny"
+    if mode == "checkpoint":
+        tokenizer, model = load_models(CHECKPOINT_PATH)
+        model.config._attn_implementation = backend
+        return tokenizer, model, mode
+
+    tokenizer = load_tokenizer()
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=4096,
+        n_embd=64,
+        n_layer=2,
+        n_head=2,
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id
+    )
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(config).to(dialoGPT.device)
+    model.config._attn_implementation = backend
+    model.eval()
+    return tokenizer, model, mode
+
+
+def make_history(tokenizer, turns):
+    """
+    A chat history of the given number of player/NPC exchanges, in the
+    format generate_response builds.
+    """
+    text = ""
+    for i in range(turns):
+        question, answer = EXCHANGES[i % len(EXCHANGES)]
+        text += "Player:" + question + "\n" + CHARACTER["name"] + ":" + answer + "\n"
+    return torch.tensor([tokenizer.encode(text)], dtype=torch.long).to(dialoGPT.device)
+
+
+class PeakMemory:
+    """
+    Context manager sampling the resident set size of the process (or the
+    CUDA allocator) and recording its peak in bytes.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def rss(self):
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.running = True
+        self.peak = self.rss()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        if torch.cuda.is_available():
+            self.peak = torch.cuda.max_memory_allocated()
+
+
+def batch_inputs(tokenizer, history, batch_size):
+    """
+    The full prompt and history of one message, repeated batch_size times.
+    """
+    prompt = dialoGPT.build_prompt(PLAYER, CHARACTER)
+    turn = "Player:" + EXCHANGES[0][0] + "\n" + CHARACTER["name"] + ":"
+    prompt_ids = torch.tensor([tokenizer.encode(prompt)], dtype=torch.long).to(dialoGPT.device)
+    turn_ids = torch.tensor([tokenizer.encode(turn)], dtype=torch.long).to(dialoGPT.device)
+    input_ids = torch.cat([prompt_ids, history, turn_ids], dim=-1)
+    return input_ids.repeat(batch_size, 1)
+
+
+def timed_generate(model, tokenizer, input_ids, new_tokens):
+    """
+    Seconds taken by generating exactly new_tokens tokens for every row.
+    """
+    start = time.perf_counter()
+    with torch.no_grad():
+        model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            pad_token_id=tokenizer.eos_token_id,
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=False,
+            num_beams=1
+        )
+    return time.perf_counter() - start
+
+
+def run_config(tokenizer, model, turns, batch_size, threads, repeats, new_tokens):
+    """
+    Benchmark one point of the sweep and return its metrics.
+    """
+    torch.set_num_threads(threads)
+    history = make_history(tokenizer, turns)
+    input_ids = batch_inputs(tokenizer, history, batch_size)
+
+    with PeakMemory() as memory:
+        # warm up
+        timed_generate(model, tokenizer, input_ids, 1)
+
+        prefill = []
+        ttft = []
+        decode = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            with torch.no_grad():
+                model(input_ids)
+            prefill.append(time.perf_counter() - start)
+            ttft.append(timed_generate(model, tokenizer, input_ids, 1))
+            decode.append(timed_generate(model, tokenizer, input_ids, new_tokens))
+
+        # end-to-end latency of the path views.parse_command takes
+        latency = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(batch_size):
+                get_dialogue(tokenizer, model, PLAYER, CHARACTER, EXCHANGES[0][0], history, max_length=new_tokens)
+            latency.append(time.perf_counter() - start)
+
+    decode_time = np.median(decode) - np.median(ttft)
+    return {
+        "input_tokens": int(input_ids.shape[-1]),
+        "prefill_s": float(np.median(prefill)),
+        "ttft_s": float(np.median(ttft)),
+        "tokens_per_s": float(batch_size * (new_tokens - 1) / decode_time) if decode_time > 0 else None,
+        "peak_memory_bytes": int(memory.peak),
+        "latency_p50_s": float(np.percentile(latency, 50)),
+        "latency_p99_s": float(np.percentile(latency, 99))
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, baseline_filename):
+    """
+    Print the relative change of every metric against a previous run.
+    """
+    baseline = json.load(open(baseline_filename, 'r'))
+    key = lambda r: (r["backend"], r["threads"], r["turns"], r["batch_size"])
+    previous = {key(r): r for r in baseline["results"]}
+    print("\nChange against %s (%s):" % (baseline_filename, baseline["commit"]))
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        changes = []
+        for metric in ["prefill_s", "ttft_s", "tokens_per_s", "latency_p50_s", "latency_p99_s", "peak_memory_bytes"]:
+            if old.get(metric) and result.get(metric):
+                changes.append("%s %+.1f%%" % (metric, 100 * (result[metric] / old[metric] - 1)))
+        print("  %s: %s" % (key(result), ", ".join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["auto", "tiny", "checkpoint"], default="auto")
+    parser.add_argument("--turns", type=int, nargs="+", default=[0, 4, 16])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--backends", nargs="+", default=["eager", "sdpa"])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, torch.get_num_threads()])
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = []
+    for backend in args.backends:
+        tokenizer, model, mode = load_benchmark_models(args.mode, backend)
+        for threads in sorted(set(args.threads)):
+            for turns in args.turns:
+                for batch_size in args.batch_sizes:
+                    metrics = run_config(tokenizer, model, turns, batch_size, threads, args.repeats, args.new_tokens)
+                    result = dict(backend=backend, threads=threads, turns=turns, batch_size=batch_size, **metrics)
+                    results.append(result)
+                    print(json.dumps(result))
+
+    output = args.output or os.path.join("benchmarks", "results", "dialogue-%s-%s.json" % (mode, commit))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as outfile:
+        json.dump({
+            "commit": commit,
+            "mode": mode,
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "results": results
+        }, outfile, indent=4)
+    print("Wrote " + output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
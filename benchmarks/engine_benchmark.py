@@ -0,0 +1,312 @@
+"""
+Game engine benchmark.
+
+Generates synthetic worlds (world_construction/synthetic_world.py) of
+growing size in every shape and measures build_game's load time and memory
+and the latency of every kind of command through Parser.parse_command, for
+a seeded random walk of a player moving, looking, taking and dropping
+things and talking about characters. Results are written as JSON so runs
+of different commits can be compared with --compare.
+
+With --region-size the world is also sharded into regions (game/regions.py)
+and the sharded game's start time and resident memory after the walk are
+measured too. With --typos a fraction of the commands has two letters
+swapped, and their latency (including the parser's typo correction) is
+reported as "typo".
+
+    python -m benchmarks.engine_benchmark
+    python -m benchmarks.engine_benchmark --locations 1000 100000 --shapes grid dense
+    python -m benchmarks.engine_benchmark --locations 100000 --region-size 256 --max-resident 5000
+"""
+import os
+import gc
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from collections import defaultdict
+
+import numpy as np
+
+from game.game import Parser, build_game
+from game.regions import build_sharded_game, shard_world
+from world_construction.synthetic_world import SHAPES, generate_world, save_world, world_filenames
+
+
+def next_command(game, rng):
+    """
+    A random command that makes sense in the current state of the game.
+    """
+    location = game.curr_location
+    things = [name for name, item in location.items.items() if not item.properties["character"]]
+    characters = [name for name, item in location.items.items() if item.properties["character"]]
+    choices = ["look", "inventory", "dance"]
+    if location.connections:
+        choices += ["go"] * 4
+    if things:
+        choices += ["take", "examine"]
+    if game.inventory:
+        choices.append("drop")
+    if characters:
+        choices.append("who")
+
+    choice = rng.choice(choices)
+    if choice == "go":
+        return "go " + rng.choice(list(location.connections))
+    if choice == "take":
+        return "take " + rng.choice(things)
+    if choice == "examine":
+        return "examine " + rng.choice(things)
+    if choice == "drop":
+        return "drop " + rng.choice(list(game.inventory))
+    if choice == "who":
+        return "who is " + rng.choice(characters).lower()
+    return choice
+
+
+def add_typo(command, rng):
+    """
+    The command with two adjacent letters of its last word swapped.
+    """
+    words = command.split(" ")
+    word = words[-1]
+    if len(word) < 4:
+        return command
+    i = rng.randrange(1, len(word) - 2)
+    words[-1] = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return " ".join(words)
+
+
+def measure_load(filenames):
+    """
+    Seconds taken by build_game, and the bytes the world holds once loaded
+    and at the peak of loading, from a second, traced load.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    build_game(**filenames)
+    load_s = time.perf_counter() - start
+
+    gc.collect()
+    tracemalloc.start()
+    game = build_game(**filenames)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return game, load_s, current, peak
+
+
+def measure_sharded(filenames, directory, region_size, max_resident, commands, seed):
+    """
+    Seconds taken by build_sharded_game, and the bytes the game holds at
+    start and after a random walk, with regions paged in and evicted.
+    """
+    sharded_dir = os.path.join(directory, "sharded")
+    shard_world(
+        filenames["locations_filename"], filenames["characters_filename"], filenames["items_filename"],
+        sharded_dir, region_size=region_size
+    )
+    gc.collect()
+    start = time.perf_counter()
+    build_sharded_game(sharded_dir, max_resident)
+    load_s = time.perf_counter() - start
+
+    gc.collect()
+    tracemalloc.start()
+    game = build_sharded_game(sharded_dir, max_resident)
+    start_bytes, _ = tracemalloc.get_traced_memory()
+    parser = Parser(game)
+    rng = random.Random(seed)
+    latencies = []
+    for _ in range(commands):
+        command = next_command(game, rng)
+        start = time.perf_counter()
+        parser.parse_command(command)
+        latencies.append(time.perf_counter() - start)
+    walk_bytes, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "region_size": region_size,
+        "max_resident_locations": max_resident,
+        "load_s": load_s,
+        "start_bytes": start_bytes,
+        "resident_bytes": walk_bytes,
+        "peak_bytes": peak,
+        "command_p50_s": float(np.percentile(latencies, 50)),
+        "command_p99_s": float(np.percentile(latencies, 99)),
+        "world": game.world.stats()
+    }
+
+
+def run_config(
+    shape, n_locations, items_per_location, characters_per_location, commands, seed, directory,
+    region_size=None, max_resident=10000, typos=0.0
+):
+    world = generate_world(shape, n_locations, items_per_location, characters_per_location, seed)
+    save_world(directory, *world)
+    game, load_s, resident, peak = measure_load(world_filenames(directory))
+    parser = Parser(game)
+
+    rng = random.Random(seed)
+    latencies = defaultdict(list)
+    for _ in range(commands):
+        command = next_command(game, rng)
+        intent = parser.get_player_intent(command) or "unknown"
+        if rng.random() < typos:
+            command, intent = add_typo(command, rng), "typo"
+        start = time.perf_counter()
+        parser.parse_command(command)
+        latencies[intent].append(time.perf_counter() - start)
+
+    # the same commands in the room holding the most things
+    game.curr_location = max(reachable_locations(game), key=lambda location: len(location.items))
+    crowded_room_things = len(game.curr_location.items)
+    crowded = defaultdict(list)
+    for _ in range(min(commands, 200)):
+        command = next_command(game, rng)
+        intent = parser.get_player_intent(command) or "unknown"
+        if intent == "direction":
+            continue
+        if rng.random() < typos:
+            command, intent = add_typo(command, rng), "typo"
+        start = time.perf_counter()
+        parser.parse_command(command)
+        crowded[intent].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        game.get_current_characters()
+        game.get_current_items()
+        crowded["render"].append(time.perf_counter() - start)
+
+    rooms = [len(location["connections"]) for location in world[0].values()]
+    result = {
+        "shape": shape,
+        "locations": n_locations,
+        "characters": len(world[1]),
+        "items": len(world[2]),
+        "max_connections": max(rooms),
+        "load_s": load_s,
+        "resident_bytes": resident,
+        "peak_load_bytes": peak,
+        "crowded_room_things": crowded_room_things,
+        "commands": summarize(latencies),
+        "crowded_room_commands": summarize(crowded)
+    }
+    if region_size:
+        result["sharded"] = measure_sharded(
+            world_filenames(directory), directory, region_size, max_resident, commands, seed
+        )
+    return result
+
+
+def summarize(latencies):
+    return {
+        intent: {
+            "count": len(values),
+            "p50_s": float(np.percentile(values, 50)),
+            "p99_s": float(np.percentile(values, 99))
+        }
+        for intent, values in sorted(latencies.items())
+    }
+
+
+def reachable_locations(game):
+    """
+    Every location reachable from the current one.
+    """
+    seen = {game.curr_location}
+    stack = [game.curr_location]
+    while stack:
+        for connected in stack.pop().connections.values():
+            if connected not in seen:
+                seen.add(connected)
+                stack.append(connected)
+    return seen
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, baseline_filename):
+    """
+    Print the relative change of load time, memory and command latency
+    against a previous run.
+    """
+    baseline = json.load(open(baseline_filename, 'r'))
+    key = lambda r: (r["shape"], r["locations"])
+    previous = {key(r): r for r in baseline["results"]}
+    print("\nChange against %s (%s):" % (baseline_filename, baseline["commit"]))
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        changes = []
+        for metric in ["load_s", "resident_bytes", "peak_load_bytes"]:
+            if old.get(metric) and result.get(metric):
+                changes.append("%s %+.1f%%" % (metric, 100 * (result[metric] / old[metric] - 1)))
+        for metric in ["load_s", "resident_bytes", "command_p50_s"]:
+            new_value = result.get("sharded", {}).get(metric)
+            old_value = old.get("sharded", {}).get(metric)
+            if old_value and new_value:
+                changes.append("sharded %s %+.1f%%" % (metric, 100 * (new_value / old_value - 1)))
+        for section, label in [("commands", "walk"), ("crowded_room_commands", "crowded")]:
+            for intent, latency in result[section].items():
+                old_latency = old.get(section, {}).get(intent)
+                if old_latency and old_latency["p50_s"] and latency["p50_s"]:
+                    changes.append("%s %s p50 %+.1f%%" % (
+                        label, intent, 100 * (latency["p50_s"] / old_latency["p50_s"] - 1)
+                    ))
+        print("  %s: %s" % (key(result), ", ".join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=SHAPES)
+    parser.add_argument("--locations", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--items-per-location", type=float, default=2.0)
+    parser.add_argument("--characters-per-location", type=float, default=0.5)
+    parser.add_argument("--commands", type=int, default=2000, help="commands of the random walk")
+    parser.add_argument("--typos", type=float, default=0.0, help="fraction of commands with a typo")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--region-size", type=int, default=None, help="also measure the world sharded into regions")
+    parser.add_argument("--max-resident", type=int, default=10000, help="locations a sharded game keeps loaded")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for shape in args.shapes:
+            for n_locations in args.locations:
+                result = run_config(
+                    shape, n_locations, args.items_per_location, args.characters_per_location,
+                    args.commands, args.seed, directory, args.region_size, args.max_resident, args.typos
+                )
+                results.append(result)
+                print(json.dumps(result))
+
+    output = args.output or os.path.join("benchmarks", "results", "engine-%s.json" % commit)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as outfile:
+        json.dump({
+            "commit": commit,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "seed": args.seed,
+            "results": results
+        }, outfile, indent=4)
+    print("Wrote " + output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
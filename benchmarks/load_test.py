@@ -0,0 +1,373 @@
+"""
+Load test of the web app.
+
+Simulates players as threads, each with its own session (cookies, CSRF
+token) and keep-alive connection, playing against a running server: they
+walk through the exits shown on the page, take, drop and examine the
+things in view, look around and chat with the characters, in the mix given
+by --mix, with --think-time seconds between requests. Every player count
+of --players runs for --duration seconds and reports requests per second,
+error rate and p50/p90/p99 latency per endpoint (every command intent and
+chat is its own endpoint), as JSON that --compare compares against an
+earlier run.
+
+With --serve the server is started for the run (manage.py runserver) with
+DIALOGUE_STUB=1, so dialogue is answered by game.dialogue_stub.StubModel
+after a modelled latency instead of loading the models:
+
+    python -m benchmarks.load_test --serve --players 1 4 16
+    python -m benchmarks.load_test --url http://localhost:8000 --players 8 --duration 60
+"""
+import os
+import re
+import sys
+import json
+import time
+import html
+import random
+import socket
+import argparse
+import platform
+import threading
+import subprocess
+import http.client
+from collections import defaultdict
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+
+from benchmarks.engine_benchmark import git_commit
+
+
+# Dictionary mapping from action to its default weight in the mix
+MIX = {
+    "go": 4,
+    "look": 1,
+    "take": 2,
+    "drop": 2,
+    "examine": 2,
+    "chat": 2,
+    "metrics": 0.1
+}
+
+MESSAGES = [
+    "Hello, who are you?",
+    "What is this place?",
+    "Have you seen anything strange around here?",
+    "Where should I go next?",
+    "Can you help me?",
+]
+
+EXITS = re.compile(r"Exits: (.*)")
+ITEM = re.compile(r'class="item-img" src="[^"]*" title="([^"]*)"')
+CHARACTER = re.compile(r'<span class="name">([^<]*)</span>')
+CSRF_INPUT = re.compile(r'name="csrfmiddlewaretoken" value="([^"]*)"')
+
+
+class Client:
+    """
+    One player's browser: a keep-alive connection and its cookies.
+    """
+    def __init__(self, url, timeout=60):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.connection = None
+        # Dictionary mapping from cookie name to value
+        self.cookies = {}
+
+    def request(self, method, path, fields=None):
+        """
+        Returns (status, body). Reconnects once if the server closed the
+        keep-alive connection.
+        """
+        headers = {"Connection": "keep-alive"}
+        if self.cookies:
+            headers["Cookie"] = "; ".join("%s=%s" % cookie for cookie in self.cookies.items())
+        body = None
+        if fields is not None:
+            body = urlencode(fields)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            headers["X-CSRFToken"] = self.cookies.get("csrftoken", "")
+            headers["Referer"] = "http://%s:%d/" % (self.host, self.port)
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+                self.close()
+                if attempt:
+                    raise
+                continue
+            for header, value in response.getheaders():
+                if header.lower() == "set-cookie":
+                    name, _, rest = value.partition("=")
+                    self.cookies[name.strip()] = rest.split(";", 1)[0]
+            if response.getheader("Connection", "").lower() == "close":
+                self.close()
+            return response.status, data.decode("utf-8", errors="replace")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class View:
+    """
+    What a player knows from the last game page: exits, things in view and
+    characters to talk to.
+    """
+    def __init__(self):
+        self.exits = []
+        self.things = []
+        self.characters = []
+
+    def update(self, page):
+        exits = EXITS.findall(page)
+        if exits:
+            self.exits = [exit.strip() for exit in html.unescape(exits[-1]).split(",") if exit.strip()]
+        self.things = [html.unescape(name) for name in ITEM.findall(page)]
+        self.characters = [html.unescape(name).strip() for name in CHARACTER.findall(page)]
+
+
+def next_action(view, carried, rng, mix):
+    """
+    (endpoint, path, fields) of a random action the page allows.
+    """
+    weights = dict(mix)
+    if not view.exits:
+        weights.pop("go", None)
+    if not view.things:
+        weights.pop("take", None)
+        weights.pop("examine", None)
+    if not carried:
+        weights.pop("drop", None)
+    if not view.characters:
+        weights.pop("chat", None)
+    weights = {action: weight for action, weight in weights.items() if weight > 0}
+    action = rng.choices(list(weights), list(weights.values()))[0] if weights else "look"
+
+    if action == "metrics":
+        return "metrics", "/metrics/", None
+    if action == "chat":
+        # the view reads the first digit of characterId only
+        index = rng.randrange(min(len(view.characters), 9))
+        return "chat", "/game/", {"message": rng.choice(MESSAGES), "characterId": str(index + 1)}
+    if action == "go":
+        command = "go " + rng.choice(view.exits)
+    elif action == "take":
+        command = "take " + rng.choice(view.things)
+    elif action == "drop":
+        command = "drop " + rng.choice(sorted(carried))
+    elif action == "examine":
+        command = "examine " + rng.choice(view.things)
+    else:
+        command = "look"
+    return action, "/game/", {"command": command}
+
+
+def run_config(url, n_players, duration, think_time, mix, seed):
+    # Dictionary mapping from endpoint to latencies and error count
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    barrier = threading.Barrier(n_players + 1)
+    deadline = [None]
+
+    def record(endpoint, seconds, ok):
+        with lock:
+            latencies[endpoint].append(seconds)
+            if not ok:
+                errors[endpoint] += 1
+
+    def play(index):
+        rng = random.Random(seed * 1000 + index)
+        client = Client(url)
+        view = View()
+        carried = set()
+        try:
+            start = time.perf_counter()
+            try:
+                status, page = client.request("GET", "/game/")
+                ok = status == 200
+                if ok:
+                    view.update(page)
+            except (OSError, http.client.HTTPException):
+                ok = False
+            record("page", time.perf_counter() - start, ok)
+            barrier.wait()
+            while time.perf_counter() < deadline[0]:
+                endpoint, path, fields = next_action(view, carried, rng, mix)
+                start = time.perf_counter()
+                try:
+                    status, page = client.request("POST" if fields else "GET", path, fields)
+                    ok = status == 200
+                except (OSError, http.client.HTTPException):
+                    ok = False
+                record(endpoint, time.perf_counter() - start, ok)
+                if ok and path == "/game/":
+                    view.update(page)
+                    if endpoint == "take":
+                        carried.add(fields["command"][len("take "):])
+                    elif endpoint == "drop":
+                        carried.discard(fields["command"][len("drop "):])
+                if think_time:
+                    time.sleep(rng.expovariate(1 / think_time))
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=play, args=(index,), daemon=True) for index in range(n_players)]
+    for thread in threads:
+        thread.start()
+    # the first page of every player is not part of the measured window
+    deadline[0] = float("inf")
+    barrier.wait()
+    start = time.perf_counter()
+    deadline[0] = start + duration
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    endpoints = {}
+    for endpoint, values in sorted(latencies.items()):
+        if endpoint == "page":
+            continue
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "requests_per_s": len(values) / seconds,
+            "error_rate": errors[endpoint] / len(values),
+            "p50_s": float(np.percentile(values, 50)),
+            "p90_s": float(np.percentile(values, 90)),
+            "p99_s": float(np.percentile(values, 99))
+        }
+    total = sum(len(values) for endpoint, values in latencies.items() if endpoint != "page")
+    return {
+        "players": n_players,
+        "seconds": seconds,
+        "requests": total,
+        "requests_per_s": total / seconds,
+        "error_rate": sum(errors[endpoint] for endpoint in endpoints) / max(total, 1),
+        "page_errors": errors["page"],
+        "endpoints": endpoints
+    }
+
+
+def wait_for_port(host, port, process, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited with status %d" % process.returncode)
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("the server did not start listening on %s:%d" % (host, port))
+
+
+def serve(url):
+    """
+    Migrate the database and start manage.py runserver on the port of url
+    with the stubbed models.
+    """
+    parts = urlsplit(url)
+    environment = dict(os.environ, DIALOGUE_STUB="1")
+    subprocess.check_call([sys.executable, "manage.py", "migrate", "--verbosity", "0"], env=environment)
+    process = subprocess.Popen(
+        [sys.executable, "manage.py", "runserver", "--noreload", "%s:%d" % (parts.hostname, parts.port or 80)],
+        env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for_port(parts.hostname, parts.port or 80, process)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def compare(results, baseline_filename):
+    """
+    Print the relative change of throughput, error rate and latency per
+    endpoint against a previous run.
+    """
+    baseline = json.load(open(baseline_filename, 'r'))
+    previous = {r["players"]: r for r in baseline["results"]}
+    print("\nChange against %s (%s):" % (baseline_filename, baseline["commit"]))
+    for result in results:
+        old = previous.get(result["players"])
+        if old is None:
+            continue
+        for endpoint, metrics in result["endpoints"].items():
+            old_metrics = old["endpoints"].get(endpoint)
+            if old_metrics is None:
+                continue
+            changes = []
+            for metric in ["requests_per_s", "p50_s", "p90_s", "p99_s"]:
+                if old_metrics.get(metric) and metrics.get(metric):
+                    changes.append("%s %+.1f%%" % (metric, 100 * (metrics[metric] / old_metrics[metric] - 1)))
+            changes.append("error_rate %.3f -> %.3f" % (old_metrics["error_rate"], metrics["error_rate"]))
+            print("  %d players, %s: %s" % (result["players"], endpoint, ", ".join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--serve", action="store_true", help="start the server with DIALOGUE_STUB=1 for the run")
+    parser.add_argument("--players", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per player count")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean seconds between a player's requests")
+    parser.add_argument("--mix", nargs="+", default=[], metavar="ACTION=WEIGHT",
+                        help="override weights of the action mix, e.g. chat=0 go=8")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    args = parser.parse_args()
+
+    mix = dict(MIX)
+    for override in args.mix:
+        action, _, weight = override.partition("=")
+        if action not in MIX:
+            parser.error("unknown action %r, expected one of %s" % (action, ", ".join(MIX)))
+        mix[action] = float(weight)
+
+    commit = git_commit()
+    process = serve(args.url) if args.serve else None
+    results = []
+    try:
+        for n_players in args.players:
+            result = run_config(args.url, n_players, args.duration, args.think_time, mix, args.seed)
+            results.append(result)
+            print(json.dumps(result))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    output = args.output or os.path.join("benchmarks", "results", "load-%s.json" % commit)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as outfile:
+        json.dump({
+            "commit": commit,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "url": args.url,
+            "stubbed": args.serve,
+            "duration": args.duration,
+            "think_time": args.think_time,
+            "mix": mix,
+            "seed": args.seed,
+            "results": results
+        }, outfile, indent=4)
+    print("Wrote " + output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Multiplayer benchmark.
+
+Players join a synthetic world (world_construction/synthetic_world.py) as
+threads of one process and run commands through SharedWorld.run as fast as
+they can, for growing player counts and both lock modes (a lock per
+location, and one lock for the whole world). Two workloads:
+
+    walk      players wander off the start location, taking and dropping things
+    hot_room  every player stays in the start location, taking and dropping
+              the same few things
+
+Reports commands per second, p50/p99 command latency and room events
+delivered, as JSON that --compare compares against an earlier run.
+
+    python -m benchmarks.multiplayer_benchmark
+    python -m benchmarks.multiplayer_benchmark --players 1 8 64 --workloads walk
+"""
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+
+import numpy as np
+
+from benchmarks.engine_benchmark import git_commit
+from game.multiplayer import build_shared_world
+from world_construction.synthetic_world import generate_world, save_world, world_filenames
+
+
+WORKLOADS = ["walk", "hot_room"]
+LOCK_MODES = ["location", "world"]
+
+
+def next_action(player, rng, workload):
+    """
+    A random take, drop or (in the walk workload) move of player.
+    """
+    game = player.game
+    location = game.curr_location
+    things = [name for name, item in list(location.items.items()) if not item.properties["character"]]
+    choices = []
+    if things:
+        choices.append("take")
+    if game.inventory:
+        choices.append("drop")
+    if workload == "walk" and location.connections:
+        choices.append("go")
+    choice = rng.choice(choices) if choices else "look"
+    if choice == "take":
+        return "take " + rng.choice(things)
+    if choice == "drop":
+        return "drop " + rng.choice(list(game.inventory))
+    if choice == "go":
+        return "go " + rng.choice(list(location.connections))
+    return choice
+
+
+def run_config(filenames, workload, lock_mode, n_players, commands, seed):
+    world = build_shared_world(lock_mode=lock_mode, **filenames)
+    players = [world.join("Player %03d" % index) for index in range(n_players)]
+    latencies = [[] for _ in players]
+    barrier = threading.Barrier(n_players + 1)
+
+    def play(index):
+        player = players[index]
+        rng = random.Random(seed * 1000 + index)
+        barrier.wait()
+        for _ in range(commands):
+            command = next_action(player, rng, workload)
+            start = time.perf_counter()
+            world.run(player, command)
+            latencies[index].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=play, args=(index,)) for index in range(n_players)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    values = [latency for player_latencies in latencies for latency in player_latencies]
+    return {
+        "workload": workload,
+        "lock_mode": lock_mode,
+        "players": n_players,
+        "commands": len(values),
+        "seconds": seconds,
+        "commands_per_s": len(values) / seconds,
+        "p50_s": float(np.percentile(values, 50)),
+        "p99_s": float(np.percentile(values, 99)),
+        "events_delivered": sum(player.received for player in players),
+        "rooms_occupied": sum(1 for present in world.present.values() if present)
+    }
+
+
+def compare(results, baseline_filename):
+    """
+    Print the relative change of throughput and latency against a previous run.
+    """
+    baseline = json.load(open(baseline_filename, 'r'))
+    key = lambda r: (r["workload"], r["lock_mode"], r["players"])
+    previous = {key(r): r for r in baseline["results"]}
+    print("\nChange against %s (%s):" % (baseline_filename, baseline["commit"]))
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        changes = []
+        for metric in ["commands_per_s", "p50_s", "p99_s"]:
+            if old.get(metric) and result.get(metric):
+                changes.append("%s %+.1f%%" % (metric, 100 * (result[metric] / old[metric] - 1)))
+        print("  %s: %s" % (key(result), ", ".join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=WORKLOADS)
+    parser.add_argument("--lock-modes", nargs="+", choices=LOCK_MODES, default=LOCK_MODES)
+    parser.add_argument("--locations", type=int, default=1000)
+    parser.add_argument("--items-per-location", type=float, default=2.0)
+    parser.add_argument("--commands", type=int, default=2000, help="commands per player")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        save_world(directory, *generate_world("grid", args.locations, args.items_per_location, 0.5, args.seed))
+        for workload in args.workloads:
+            for lock_mode in args.lock_modes:
+                for n_players in args.players:
+                    result = run_config(
+                        world_filenames(directory), workload, lock_mode, n_players, args.commands, args.seed
+                    )
+                    results.append(result)
+                    print(json.dumps(result))
+
+    output = args.output or os.path.join("benchmarks", "results", "multiplayer-%s.json" % commit)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as outfile:
+        json.dump({
+            "commit": commit,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "seed": args.seed,
+            "results": results
+        }, outfile, indent=4)
+    print("Wrote " + output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
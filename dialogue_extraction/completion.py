@@ -0,0 +1,202 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class OpenAIBackend:
+    """
+    Completions from the OpenAI API.
+    """
+    def __init__(self, engine="text-curie-001", temperature=0.7, max_tokens=256):
+        import openai
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        self.openai = openai
+        self.engine = engine
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.name = "openai/" + engine
+
+    def complete(self, prompt):
+        response = self.openai.Completion.create(
+            engine=self.engine,
+            prompt=prompt,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            top_p=1,
+            frequency_penalty=0,
+            presence_penalty=0
+        )
+        return response['choices'][0]['text']
+
+
+class LocalBackend:
+    """
+    Completions from a small local causal language model, so extraction
+    can run without network access.
+    """
+    def __init__(self, model_name="distilgpt2", max_new_tokens=64):
+        from transformers import pipeline
+        self.generator = pipeline("text-generation", model=model_name)
+        self.max_new_tokens = max_new_tokens
+        self.name = "local/" + model_name
+
+    def complete(self, prompt):
+        output = self.generator(prompt, max_new_tokens=self.max_new_tokens, do_sample=False)
+        return output[0]["generated_text"][len(prompt):]
+
+
+class FakeBackend:
+    """
+    Deterministic stand-in that answers instantly, for tests and dry runs.
+    """
+    name = "fake"
+
+    def complete(self, prompt):
+        return " A character described by the prompt: " + prompt
+
+
+BACKENDS = {
+    "openai": OpenAIBackend,
+    "local": LocalBackend,
+    "fake": FakeBackend
+}
+
+
+class CompletionCache:
+    """
+    Persistent cache of completions in a SQLite file, keyed by a hash of
+    (movie, character, prompt, model), so re-running an extraction only
+    pays for prompts it has not seen before.
+    """
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions "
+            "(key TEXT PRIMARY KEY, movie TEXT, character TEXT, prompt TEXT, model TEXT, text TEXT)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def key(movie, character, prompt, model):
+        return hashlib.sha256(json.dumps([movie, character, prompt, model]).encode("utf-8")).hexdigest()
+
+    def get(self, movie, character, prompt, model):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT text FROM completions WHERE key = ?", (self.key(movie, character, prompt, model),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, movie, character, prompt, model, text):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?)",
+                (self.key(movie, character, prompt, model), movie, character, prompt, model, text)
+            )
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class RateLimiter:
+    """
+    Token bucket shared by the worker threads, allowing rate calls per
+    second on average with bursts of up to burst calls.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def complete_with_retry(backend, prompt, limiter, retries=3, backoff=2.0):
+    """
+    Call the backend, waiting for the rate limiter before every attempt and
+    backing off exponentially after a failure.
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return backend.complete(prompt)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff ** attempt)
+
+
+class CompletionError(Exception):
+    """
+    Raised by complete_all when some jobs still failed after their retries.
+    failures maps the index of every failed job to its exception, and
+    results holds the completions of the other jobs (None for the failed
+    ones), which are cached all the same.
+    """
+    def __init__(self, failures, results):
+        index, error = next(iter(failures.items()))
+        super().__init__("%d completions failed, the first (job %d) with %r" % (len(failures), index, error))
+        self.failures = failures
+        self.results = results
+
+
+def complete_all(jobs, backend, cache=None, max_workers=8, rate=None, retries=3):
+    """
+    Complete every job, a dictionary with "movie", "character" and "prompt",
+    with at most max_workers calls in flight and at most rate calls per
+    second. Cached jobs are not sent to the backend, and every new
+    completion is cached as soon as it arrives so an interrupted run
+    resumes where it stopped. Returns the completions in the order of jobs.
+    A job failing after its retries does not stop the others; once they
+    are all done, CompletionError is raised if any failed.
+    """
+    results = [None] * len(jobs)
+    pending = []
+    for index, job in enumerate(jobs):
+        cached = cache.get(job["movie"], job["character"], job["prompt"], backend.name) if cache else None
+        if cached is None:
+            pending.append(index)
+        else:
+            results[index] = cached
+
+    limiter = RateLimiter(rate, burst=max_workers) if rate else None
+    # Dictionary mapping from job index to the exception it failed with
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(complete_with_retry, backend, jobs[index]["prompt"], limiter, retries): index
+            for index in pending
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            job = jobs[index]
+            try:
+                results[index] = future.result()
+            except Exception as error:
+                failures[index] = error
+                continue
+            if cache:
+                cache.put(job["movie"], job["character"], job["prompt"], backend.name, results[index])
+    print("%d completions, %d from cache, %d failed" % (len(jobs), len(jobs) - len(pending), len(failures)))
+    if failures:
+        raise CompletionError(dict(sorted(failures.items())), results)
+    return results
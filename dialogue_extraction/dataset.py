@@ -0,0 +1,201 @@
+"""
+Pre-tokenized dialogue dataset.
+
+Renders every conversation of the extracted dialogue JSONL files in the
+prompt format get_dialogue uses, tokenizes it once with the GPT-2
+tokenizer and stores all conversations as one flat token array plus an
+offsets index, so training can memory-map it without parsing anything.
+The speaker who opens a conversation plays the Player and the other one
+the NPC; a mask marks the NPC's turns, the only tokens worth a loss.
+
+    python -m dialogue_extraction.dataset dialogue_extraction/dialogues data/dialogues
+"""
+import os
+import glob
+import json
+import argparse
+
+import jsonlines
+import numpy as np
+
+from game.prompts import PLAYER_STR, npc_str, render_prompt
+
+
+TOKENS_FILE = "tokens.bin"
+MASK_FILE = "mask.bin"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+
+
+def render_conversation(conversation, setting):
+    """
+    Split a conversation into (text, is_npc) pieces: the prompt, then for
+    every turn its speaker prefix, line and newline. Returns None for
+    conversations without two distinct speakers.
+    """
+    dialogue = conversation["dialogue"]
+    if not dialogue:
+        return None
+    player_name = dialogue[0]["name"]
+    npcs = [character for character in conversation["characters"] if character["name"] != player_name]
+    players = [character for character in conversation["characters"] if character["name"] == player_name]
+    if not npcs or not players:
+        return None
+    npc = npcs[0]
+    player = {"name": "Player", "persona": players[0]["persona"]}
+
+    pieces = [(render_prompt([setting], npc, player), False)]
+    for turn in dialogue:
+        is_npc = turn["name"] == npc["name"]
+        pieces.append((npc_str(npc["name"]) if is_npc else PLAYER_STR, False))
+        pieces.append((turn["line"], is_npc))
+        # the newline ends a turn, and the model has to learn to emit it
+        pieces.append(("\n", is_npc))
+    return pieces
+
+
+def build_dataset(input_files, output_dir, tokenizer_name="microsoft/DialoGPT-small", batch_size=256):
+    """
+    Tokenize every conversation of input_files and write tokens.bin
+    (uint16), mask.bin (uint8) and offsets.npy (int64, one more entry than
+    there are conversations) to output_dir.
+    """
+    from transformers import GPT2TokenizerFast
+    tokenizer = GPT2TokenizerFast.from_pretrained(tokenizer_name)
+    if len(tokenizer) > np.iinfo(np.uint16).max + 1:
+        raise ValueError("vocabulary of %d tokens does not fit in uint16" % len(tokenizer))
+
+    os.makedirs(output_dir, exist_ok=True)
+    offsets = [0]
+    skipped = 0
+    with open(os.path.join(output_dir, TOKENS_FILE), 'wb') as tokens_file, \
+            open(os.path.join(output_dir, MASK_FILE), 'wb') as mask_file:
+
+        def flush(batch):
+            # tokenize the pieces of a batch of conversations in one call
+            flat = [text for pieces in batch for text, _ in pieces]
+            encoded = iter(tokenizer(flat)["input_ids"])
+            for pieces in batch:
+                tokens = []
+                mask = []
+                for _, is_npc in pieces:
+                    ids = next(encoded)
+                    tokens.extend(ids)
+                    mask.extend([is_npc] * len(ids))
+                np.asarray(tokens, dtype=np.uint16).tofile(tokens_file)
+                np.asarray(mask, dtype=np.uint8).tofile(mask_file)
+                offsets.append(offsets[-1] + len(tokens))
+
+        batch = []
+        for filename in input_files:
+            movie = os.path.splitext(os.path.basename(filename))[0]
+            with jsonlines.open(filename) as reader:
+                for conversation in reader:
+                    pieces = render_conversation(conversation, movie.title())
+                    if pieces is None:
+                        skipped += 1
+                        continue
+                    batch.append(pieces)
+                    if len(batch) == batch_size:
+                        flush(batch)
+                        batch = []
+        flush(batch)
+
+    np.save(os.path.join(output_dir, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    with open(os.path.join(output_dir, META_FILE), 'w') as meta_file:
+        json.dump({
+            "tokenizer": tokenizer_name,
+            "eos_token_id": tokenizer.eos_token_id,
+            "conversations": len(offsets) - 1,
+            "tokens": offsets[-1],
+            "skipped": skipped,
+            "sources": [os.path.basename(filename) for filename in input_files]
+        }, meta_file, indent=4)
+    print("%d conversations, %d tokens, %d skipped" % (len(offsets) - 1, offsets[-1], skipped))
+
+
+class DialogueDataset:
+    """
+    Memory-mapped view of a dataset written by build_dataset. Indexing
+    returns the (tokens, mask) arrays of one conversation without copying.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta = json.load(open(os.path.join(path, META_FILE), 'r'))
+        self.tokens = np.memmap(os.path.join(path, TOKENS_FILE), dtype=np.uint16, mode='r')
+        self.mask = np.memmap(os.path.join(path, MASK_FILE), dtype=np.uint8, mode='r')
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        self.eos_token_id = self.meta["eos_token_id"]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.tokens[start:end], self.mask[start:end]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def random_conversations(self, rng, max_length=None):
+        """
+        Yield (tokens, mask) of every conversation in random order, cut to
+        max_length tokens.
+        """
+        for index in rng.permutation(len(self)):
+            tokens, mask = self[index]
+            yield tokens[:max_length], mask[:max_length]
+
+    def packed(self, seq_len, rng, eos_token_id=None):
+        """
+        Yield (tokens, mask, segments) arrays of exactly seq_len tokens made
+        by concatenating conversations in random order, each followed by an
+        end-of-sequence token. segments numbers the conversations of a
+        sequence from 1 and is 0 on padding, so a trainer can reset
+        positions and keep the loss from crossing conversation boundaries.
+        Conversations longer than seq_len are split into several chunks.
+        """
+        eos_token_id = self.eos_token_id if eos_token_id is None else eos_token_id
+        tokens = np.full(seq_len, eos_token_id, dtype=np.int64)
+        mask = np.zeros(seq_len, dtype=np.uint8)
+        segments = np.zeros(seq_len, dtype=np.int32)
+        used = 0
+        segment = 0
+        for index in rng.permutation(len(self)):
+            conversation_tokens, conversation_mask = self[index]
+            for start in range(0, len(conversation_tokens), seq_len - 1):
+                chunk_tokens = conversation_tokens[start:start + seq_len - 1]
+                chunk_mask = conversation_mask[start:start + seq_len - 1]
+                length = len(chunk_tokens) + 1
+                if used + length > seq_len:
+                    yield tokens, mask, segments
+                    tokens = np.full(seq_len, eos_token_id, dtype=np.int64)
+                    mask = np.zeros(seq_len, dtype=np.uint8)
+                    segments = np.zeros(seq_len, dtype=np.int32)
+                    used = 0
+                    segment = 0
+                segment += 1
+                tokens[used:used + length - 1] = chunk_tokens
+                mask[used:used + length - 1] = chunk_mask
+                segments[used:used + length] = segment
+                used += length
+        if used:
+            yield tokens, mask, segments
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a pre-tokenized dialogue dataset.")
+    parser.add_argument("input", help="a dialogue JSONL file or a directory of them")
+    parser.add_argument("output", help="directory for the dataset files")
+    parser.add_argument("--tokenizer", default="microsoft/DialoGPT-small")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input):
+        input_files = sorted(glob.glob(os.path.join(args.input, "*.jsonl")))
+    else:
+        input_files = [args.input]
+    build_dataset(input_files, args.output, tokenizer_name=args.tokenizer)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,92 @@
-import os 
+import os
+import argparse
 import jsonlines
+from array import array
 from pprint import pprint
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
-import openai
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from completion import BACKENDS, CompletionCache, complete_all
 
 
-def read_dataset():
+CORPUS = "cornell-movie-dialogs-corpus"
+SEPARATOR = ' +++$+++ '
+
+
+def iter_records(filename, n_fields):
     """
-    Importing the dataset (lines for correlation to match in conversations)
+    Stream the ' +++$+++ '-delimited records of a corpus file together with
+    the byte offset of each line, skipping malformed lines.
     """
-    corpus = "cornell-movie-dialogs-corpus"
-    lines = open(corpus + '/movie_lines.txt', encoding='utf-8', errors='ignore').read().split('\n')
-    conversations= open(corpus + '/movie_conversations.txt', encoding = 'utf-8', errors = 'ignore').read().split('\n')
-    characters = open(corpus + '/movie_characters_metadata.txt', encoding = 'utf-8', errors = 'ignore').read().split('\n')
-    return lines, conversations, characters
+    with open(filename, 'rb') as corpus_file:
+        offset = 0
+        for raw_line in corpus_file:
+            line = raw_line.decode('utf-8', errors='ignore').rstrip('\r\n')
+            record = line.split(SEPARATOR)
+            if len(record) == n_fields:
+                yield offset, record
+            offset += len(raw_line)
 
 
-def extract_characters_and_persona(characters_data, movie):
+class LineIndex:
     """
-    Extract character names and use GPT3 to extract personas.
+    Maps each line id of movie_lines.txt ("L1045") to the byte offset of
+    its record, stored in a flat array indexed by the number in the id.
+    Texts stay on disk and are read back with a seek when a conversation
+    needs them, so memory is 8 bytes per line however long the lines are.
     """
-    id2character = {}
-    for line_raw in characters_data:
-        line = line_raw.split(' +++$+++ ')
-        if len(line) != 6:
-            continue
-        character_id, character_name, movie_id, movie_name = line[:4]
-        if movie_name != movie:
+    def __init__(self, filename):
+        self.filename = filename
+        self.offsets = array('q')
+        for offset, record in iter_records(filename, 5):
+            number = int(record[0][1:])
+            if number >= len(self.offsets):
+                self.offsets.extend([-1] * (number + 1 - len(self.offsets)))
+            self.offsets[number] = offset
+        self.file = open(filename, 'rb')
+
+    def get(self, line_id):
+        """
+        Returns the text and character id of a line.
+        """
+        self.file.seek(self.offsets[int(line_id[1:])])
+        record = self.file.readline().decode('utf-8', errors='ignore').rstrip('\r\n').split(SEPARATOR)
+        return {"line": record[4], "character_id": record[1]}
+
+    def close(self):
+        self.file.close()
+
+
+def create_id2movie(characters_filename):
+    """
+    Map each movie id to the movie name, in one pass over the character file.
+    """
+    id2movie = {}
+    for _, record in iter_records(characters_filename, 6):
+        character_id, character_name, movie_id, movie_name = record[:4]
+        id2movie[movie_id] = movie_name
+    return id2movie
+
+
+def extract_characters_and_persona(characters_filename, backend, cache=None, movies=None, max_workers=8, rate=None):
+    """
+    Extract character names of the requested movies (all of them when
+    movies is None) in one pass over the character file, and use the
+    completion backend to extract personas.
+    """
+    characters = []
+    jobs = []
+    for _, record in iter_records(characters_filename, 6):
+        character_id, character_name, movie_id, movie_name = record[:4]
+        if movies is not None and movie_name not in movies:
             continue
         prompt = "Who is {} in the movie '{}' and what is their persona?".format(character_name.lower().capitalize(), movie_name.title())
-        response = openai.Completion.create(
-            engine="text-curie-001",
-            prompt=prompt,
-            temperature=0.7,
-            max_tokens=256,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-        persona = response['choices'][0]['text'].replace("\n", "")
+        characters.append((character_id, character_name))
+        jobs.append({"movie": movie_name, "character": character_name, "prompt": prompt})
+
+    id2character = {}
+    completions = complete_all(jobs, backend, cache=cache, max_workers=max_workers, rate=rate)
+    for (character_id, character_name), completion in zip(characters, completions):
+        persona = completion.replace("\n", "")
         id2character[character_id] = {
             "name": character_name.lower().capitalize(),
             "persona": persona
@@ -49,84 +95,107 @@ def extract_characters_and_persona(characters_data, movie):
     return id2character
 
 
-def create_id2movie(characters_data):
-    id2movie = {}
-    for line in characters_data:
-        _line = line.split(' +++$+++ ')
-        if len(_line) != 6:
-            continue
-        character_id, character_name, movie_id, movie_name = _line[:4]
-        id2movie[movie_id] = movie_name        
-    return id2movie
-
-
-def create_id2line(lines_data):
-    """
-    Creating a dictionary that maps each line id to the actual text 
-    and the ID of the character that it belongs to.
-    """
-    id2line = {}
-    for line in lines_data:
-        _line = line.split(' +++$+++ ')
-        if len(_line) == 5:
-            id2line[_line[0]] = {"line": _line[4], "character_id": _line[1]}
-    return id2line
-
-
-def count_conversations(conversations_data, id2movie):
+def count_conversations(conversations_filename, id2movie):
     counter = defaultdict(int)
-    for conversation_raw in conversations_data:
-        conversation = conversation_raw.split(' +++$+++ ')
-        if len(conversation) != 4:
-            continue
+    for _, conversation in iter_records(conversations_filename, 4):
         characterA_id, characterB_id, movie_id, lines_id = conversation
         movie_name = id2movie[movie_id]
         counter[movie_name] += 1
     pprint(sorted(counter.items(), key=lambda kv: kv[1], reverse=True))
 
 
-def extract_dialogue_data(id2line, id2movie, conversations_data, characters_data, movie):
-    id2character = extract_characters_and_persona(characters_data, movie)
-
-    data = []
-    for conversation_raw in conversations_data:
-        conversation = conversation_raw.split(' +++$+++ ')
-        if len(conversation) != 4:
-            continue
-        characterA_id, characterB_id, movie_id, lines_id = conversation
-        if id2movie[movie_id] != movie:
-            continue
-        lines_id = lines_id[1:-1].replace("'", "").replace(" ", "").split(",")
-        dialogue = []
-        for line_id in lines_id:
-            character_id = id2line[line_id]["character_id"]
-            character_name = id2character[character_id]["name"]
-            line_text = id2line[line_id]["line"]
-            dialogue.append({"name": character_name, "line": line_text})
-
-        conversation = {
-            "characters": [id2character[characterA_id], id2character[characterB_id]],
-            "dialogue": dialogue
-        }
-        data.append(conversation)
+class WriterPool:
+    """
+    Keeps at most max_open per-movie JSONL writers open, closing the least
+    recently used one when another movie needs a file. A file is truncated
+    the first time it is opened and appended to afterwards.
+    """
+    def __init__(self, output_dir, max_open=64):
+        self.output_dir = output_dir
+        self.max_open = max_open
+        self.writers = OrderedDict()
+        self.opened = set()
+
+    def write(self, movie, data):
+        writer = self.writers.get(movie)
+        if writer is None:
+            if len(self.writers) >= self.max_open:
+                _, oldest = self.writers.popitem(last=False)
+                oldest.close()
+            mode = 'a' if movie in self.opened else 'w'
+            filename = os.path.join(self.output_dir, movie.replace("/", "_") + ".jsonl")
+            writer = self.writers[movie] = jsonlines.open(filename, mode)
+            self.opened.add(movie)
+        self.writers.move_to_end(movie)
+        writer.write(data)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+
+
+def extract_dialogue_data(line_index, id2movie, id2character, conversations_filename, movies=None, output_dir="dialogues"):
+    """
+    Write the conversations of every requested movie (all of them when
+    movies is None) to dialogues/<movie>.jsonl in a single pass over
+    movie_conversations.txt.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    writers = WriterPool(output_dir)
+    try:
+        for _, conversation in iter_records(conversations_filename, 4):
+            characterA_id, characterB_id, movie_id, lines_id = conversation
+            movie = id2movie[movie_id]
+            if movies is not None and movie not in movies:
+                continue
+            lines_id = lines_id[1:-1].replace("'", "").replace(" ", "").split(",")
+            dialogue = []
+            for line_id in lines_id:
+                line = line_index.get(line_id)
+                character_name = id2character[line["character_id"]]["name"]
+                dialogue.append({"name": character_name, "line": line["line"]})
+
+            writers.write(movie, {
+                "characters": [id2character[characterA_id], id2character[characterB_id]],
+                "dialogue": dialogue
+            })
+    finally:
+        writers.close()
 
-    filename = "dialogues/" + movie + ".jsonl"
-    with jsonlines.open(filename, 'w') as writer:
-        writer.write_all(data)
-    
 
 def main():
-    # import dataset    
-    lines_data, conversations_data, characters_data = read_dataset()
+    parser = argparse.ArgumentParser(description="Extract per-movie dialogues from the Cornell movie dialogs corpus.")
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--output", default="dialogues")
+    parser.add_argument("--movies", nargs="+", default=["aliens", "alien", "alien vs. predator"])
+    parser.add_argument("--all", action="store_true", help="extract every movie of the corpus")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="openai")
+    parser.add_argument("--cache", default="personas.sqlite3", help="persona completion cache")
+    parser.add_argument("--workers", type=int, default=8, help="completion requests in flight")
+    parser.add_argument("--rate", type=float, default=None, help="completion requests per second")
+    args = parser.parse_args()
+    movies = None if args.all else set(args.movies)
+    backend = BACKENDS[args.backend]()
+    cache = CompletionCache(args.cache)
 
     # create data mapping
-    id2line = create_id2line(lines_data)
-    id2movie = create_id2movie(characters_data)
+    characters_filename = os.path.join(args.corpus, 'movie_characters_metadata.txt')
+    line_index = LineIndex(os.path.join(args.corpus, 'movie_lines.txt'))
+    id2movie = create_id2movie(characters_filename)
+    id2character = extract_characters_and_persona(
+        characters_filename, backend, cache=cache, movies=movies, max_workers=args.workers, rate=args.rate
+    )
+    cache.close()
 
     # create a dialogue file for each movie
-    movies = ["aliens", "alien", "alien vs. predator"]
-    for movie in movies:
-        extract_dialogue_data(id2line, id2movie, conversations_data, characters_data, movie)
+    try:
+        extract_dialogue_data(
+            line_index, id2movie, id2character, os.path.join(args.corpus, 'movie_conversations.txt'),
+            movies=movies, output_dir=args.output
+        )
+    finally:
+        line_index.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,211 @@
+"""
+Build the response index of the model-free dialogue backend.
+
+Generates questions a player might ask every character of a world, from
+templates filled with the world's locations, characters and items, and
+has the dialogue model answer each of them --pool-size times, with the
+prompt get_dialogue builds for a new conversation. Every batch of
+--batch-size questions is answered by one generate call, the questions
+left-padded to the same length and --pool-size answers sampled for each,
+by --workers processes holding their own copy of the model. The questions
+and answers are written as the index game/response_index.py serves from
+(DIALOGUE_BACKEND = "response_index" in the settings).
+
+    python -m dialogue_systems.build_response_index --output game/static/game/responses.npz
+    python -m dialogue_systems.build_response_index --stub --max-questions 50 --output /tmp/responses.npz
+"""
+import os
+import time
+import random
+import argparse
+import multiprocessing
+
+from game.game import load_world_data
+from game.prompts import PLAYER_STR, build_prompt, npc_str
+from game.response_index import save_response_index
+
+
+PLAYER = {
+    "name": "Player",
+    "persona": "I am an explorer from earth. I like to travel to different places and learn about strong but interesting things. I am always excited about exploring the unknown.",
+    "appearance": "I am wearing jeans. The jeans are loose but strong. I am wearing windbreaker. The windbreaker is long, black and looks very cold. I am wearing a hat. I'm wearing a hat. The hat is brown and partly hides my face."
+}
+
+QUESTIONS = [
+    "Hello!",
+    "Who are you?",
+    "What are you doing here?",
+    "Tell me about yourself.",
+    "What is this place?",
+    "Can you help me?",
+    "Where should I go next?",
+    "Is it dangerous here?",
+    "Goodbye.",
+]
+
+# Templates of questions about a location, a character or an item
+TOPIC_QUESTIONS = {
+    "location": ["What do you know about {}?", "How do I get to {}?"],
+    "character": ["Have you seen {}?", "What do you think of {}?"],
+    "item": ["What is the {} for?", "Where can I find the {}?", "Do you have the {}?"],
+}
+
+# the stub answers at once, to try the whole pipeline without a model
+STUB_LATENCY = {"prefill_seconds": 0.0, "prefill_token_seconds": 0.0, "token_seconds": 0.0}
+
+# model of the worker process, loaded once by load_worker
+worker = {}
+
+
+def questions(world_data, character_name):
+    """
+    Every question to ask a character.
+    """
+    topics = {
+        "location": list(world_data["locations"]),
+        "character": [name for name in world_data["characters"] if name != character_name],
+        "item": list(world_data["items"]),
+    }
+    result = list(QUESTIONS)
+    for kind, templates in TOPIC_QUESTIONS.items():
+        for template in templates:
+            result.extend(template.format(topic) for topic in topics[kind])
+    return result
+
+
+def character_dict(world_data, name):
+    """
+    The character as Game.get_current_characters describes it.
+    """
+    data = world_data["characters"][name]
+    return {
+        "name": name,
+        "location": data["location"],
+        "location_description": world_data["locations"][data["location"]]["description"],
+        "persona": data["description"],
+        "appearance": data["appearance"],
+        "dialogues": []
+    }
+
+
+def load_worker(model_path, base_model, stub, threads):
+    # imported here, so that only the workers load torch
+    import torch
+    from game.dialoGPT import load_models
+    from game.dialogue_stub import load_stub_models
+
+    torch.set_num_threads(threads)
+    if stub:
+        worker["tokenizer"], worker["model"] = load_stub_models(**STUB_LATENCY)
+    else:
+        worker["tokenizer"], worker["model"] = load_models(model_path, base_model=base_model)
+
+
+def encode_question(tokenizer, character, question):
+    """
+    Token ids of the prompt generate_response builds for question, the
+    first message of a conversation with character.
+    """
+    text = build_prompt(PLAYER, character) + PLAYER_STR + question + "\n" + npc_str(character["name"])
+    return tokenizer.encode(text)
+
+
+def answer_batch(batch):
+    """
+    Answer a batch of (character, question, pool size, max new tokens)
+    tasks, each in a new conversation, with one generate call. Returns
+    (character name, question, responses) tuples.
+    """
+    import torch
+    from game.dialoGPT import device
+
+    tokenizer, model = worker["tokenizer"], worker["model"]
+    pool_size, max_new_tokens = batch[0][2], batch[0][3]
+    newline_id = tokenizer.encode("\n")[0]
+    encoded = [encode_question(tokenizer, character, question) for character, question, _, _ in batch]
+    length = max(len(ids) for ids in encoded)
+    # padded on the left, so that every answer starts right after its prompt
+    input_ids = torch.full((len(batch), length), tokenizer.eos_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), length), dtype=torch.long)
+    for row, ids in enumerate(encoded):
+        input_ids[row, length - len(ids):] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, length - len(ids):] = 1
+    with torch.no_grad():
+        output_ids = model.generate(
+            input_ids.to(device),
+            attention_mask=attention_mask.to(device),
+            pad_token_id=tokenizer.eos_token_id,
+            max_new_tokens=max_new_tokens,
+            no_repeat_ngram_size=3,
+            top_k=50, top_p=0.9, temperature=0.3,
+            do_sample=True,
+            num_beams=1,
+            num_return_sequences=pool_size,
+            eos_token_id=newline_id
+        )
+
+    results = []
+    for row, (character, question, _, _) in enumerate(batch):
+        responses = []
+        # the pool_size answers of a question are consecutive rows
+        for answer_ids in output_ids[row * pool_size:(row + 1) * pool_size, length:]:
+            response = tokenizer.decode(answer_ids, skip_special_tokens=True)
+            response = response.split("\n")[0].replace("#", "").strip()
+            if response and response not in responses:
+                responses.append(response)
+        if responses:
+            results.append((character["name"], question, responses))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="game/static/game/data", help="directory of the world data files")
+    parser.add_argument("--model-path", default="game/static/game/dialoGPT.pth")
+    parser.add_argument("--base-model", default="microsoft/DialoGPT-medium")
+    parser.add_argument("--stub", action="store_true", help="answer with game.dialogue_stub instead of the model")
+    parser.add_argument("--pool-size", type=int, default=4, help="answers generated per question")
+    parser.add_argument("--max-new-tokens", type=int, default=128, help="longest answer, in tokens")
+    parser.add_argument("--max-questions", type=int, default=None, help="questions per character, sampled")
+    parser.add_argument("--batch-size", type=int, default=16, help="questions answered by one generate call")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 4))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="game/static/game/responses.npz")
+    args = parser.parse_args()
+
+    world_data = load_world_data(
+        os.path.join(args.data, "locations.json"),
+        os.path.join(args.data, "characters.json"),
+        os.path.join(args.data, "items.json")
+    )
+    rng = random.Random(args.seed)
+    tasks = []
+    for name in world_data["characters"]:
+        character = character_dict(world_data, name)
+        character_questions = questions(world_data, name)
+        if args.max_questions is not None and len(character_questions) > args.max_questions:
+            character_questions = rng.sample(character_questions, args.max_questions)
+        tasks.extend((character, question, args.pool_size, args.max_new_tokens) for question in character_questions)
+    batches = [tasks[i:i + args.batch_size] for i in range(0, len(tasks), args.batch_size)]
+    print("%d questions to %d characters in %d batches" % (len(tasks), len(world_data["characters"]), len(batches)))
+
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    entries = []
+    start = time.perf_counter()
+    # spawned workers do not inherit the parent's torch threads
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        args.workers, initializer=load_worker, initargs=(args.model_path, args.base_model, args.stub, threads)
+    ) as pool:
+        for done, results in enumerate(pool.imap_unordered(answer_batch, batches), 1):
+            entries.extend(results)
+            if done % 10 == 0 or done == len(batches):
+                print("%d/%d batches, %.1fs" % (done, len(batches), time.perf_counter() - start))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    save_response_index(args.output, entries)
+    print("Wrote %d questions to %s (%d bytes)" % (len(entries), args.output, os.path.getsize(args.output)))
+
+
+if __name__ == '__main__':
+    main()
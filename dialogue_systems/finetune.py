@@ -0,0 +1,188 @@
+"""
+Fine-tune DialoGPT on extracted dialogues.
+
+Trains the model load_models expects from a dataset built by
+dialogue_extraction/dataset.py (built on the fly from the dialogue JSONL
+files if it does not exist yet). Conversations are packed into fixed-length
+sequences instead of being padded. Each token attends only to the earlier
+tokens of its own conversation (a block-diagonal causal attention mask),
+positions restart at every conversation and only the NPC's turns
+contribute to the loss, so no compute is spent on padding and packed
+conversations are trained as if each were alone.
+
+    python -m dialogue_systems.finetune --dialogues dialogue_extraction/dialogues --output game/static/game/dialoGPT.pth
+"""
+import os
+import glob
+import time
+import argparse
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, get_linear_schedule_with_warmup
+
+from dialogue_extraction.dataset import DialogueDataset, build_dataset
+
+
+def position_ids(segments):
+    """
+    Positions that restart at 0 at the beginning of every conversation of a
+    packed sequence.
+    """
+    positions = np.arange(len(segments))
+    starts = np.flatnonzero(np.diff(segments, prepend=-1))
+    segment_starts = np.repeat(starts, np.diff(np.append(starts, len(segments))))
+    return positions - segment_starts
+
+
+def attention_mask(segments):
+    """
+    Additive (batch, 1, seq_len, seq_len) attention mask of packed
+    sequences: 0 where a token may attend to another, an earlier token of
+    the same conversation, and the smallest float everywhere else.
+    """
+    segments = torch.as_tensor(segments)
+    same = segments[:, :, None] == segments[:, None, :]
+    causal = torch.ones(segments.shape[-1], segments.shape[-1], dtype=torch.bool).tril()
+    allowed = (same & causal).unsqueeze(1)
+    return torch.zeros(allowed.shape).masked_fill(~allowed, torch.finfo(torch.float32).min)
+
+
+def stack(rows):
+    input_ids, positions, labels, segments = (torch.from_numpy(np.stack(column)).long() for column in zip(*rows))
+    return input_ids, positions, attention_mask(segments), labels
+
+
+def packed_batches(dataset, seq_len, batch_size, rng):
+    """
+    Yield (input_ids, position_ids, attention_mask, labels) tensors of
+    packed sequences. Labels are -100 everywhere but on the NPC's tokens.
+    """
+    rows = []
+    for tokens, mask, segments in dataset.packed(seq_len, rng):
+        labels = np.where(mask.astype(bool), tokens, -100)
+        rows.append((tokens, position_ids(segments), labels, segments))
+        if len(rows) == batch_size:
+            yield stack(rows)
+            rows = []
+    if rows:
+        yield stack(rows)
+
+
+def optimizer_step(model, optimizer, scheduler, scale=1.0):
+    """
+    Apply the accumulated gradients, multiplied by scale.
+    """
+    if scale != 1.0:
+        for parameter in model.parameters():
+            if parameter.grad is not None:
+                parameter.grad.mul_(scale)
+    torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+    optimizer.step()
+    scheduler.step()
+    optimizer.zero_grad()
+
+
+def load_dataset(dataset_dir, dialogues_dir):
+    if not os.path.exists(os.path.join(dataset_dir, "offsets.npy")):
+        build_dataset(sorted(glob.glob(os.path.join(dialogues_dir, "*.jsonl"))), dataset_dir)
+    return DialogueDataset(dataset_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dialogues", default="dialogue_extraction/dialogues", help="directory of dialogue JSONL files")
+    parser.add_argument("--dataset", default="data/dialogues", help="pre-tokenized dataset directory")
+    parser.add_argument("--base-model", default="microsoft/DialoGPT-medium")
+    parser.add_argument("--init", default=None, help="state dict to start from, e.g. an earlier dialoGPT.pth")
+    parser.add_argument("--output", default="dialoGPT.pth")
+    parser.add_argument("--seq-len", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--accumulation-steps", type=int, default=8)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--max-steps", type=int, default=None, help="stop after this many optimizer steps")
+    parser.add_argument("--lr", type=float, default=5e-5)
+    parser.add_argument("--warmup-steps", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--bf16", action="store_true", help="autocast to bfloat16, fast on recent CPUs")
+    parser.add_argument("--gradient-checkpointing", action="store_true", help="trade compute for memory")
+    parser.add_argument("--log-steps", type=int, default=10)
+    parser.add_argument("--save-steps", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+
+    dataset = load_dataset(args.dataset, args.dialogues)
+    model = AutoModelForCausalLM.from_pretrained(args.base_model).to(device)
+    if args.init:
+        model.load_state_dict(torch.load(args.init, map_location=device))
+    if args.gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+    model.train()
+
+    # estimate the number of optimizer steps for the learning rate schedule
+    sequences = int(np.ceil((dataset.lengths() + 1).sum() / args.seq_len))
+    total_steps = int(np.ceil(sequences / args.batch_size / args.accumulation_steps)) * args.epochs
+    if args.max_steps:
+        total_steps = min(total_steps, args.max_steps)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=0.01)
+    scheduler = get_linear_schedule_with_warmup(optimizer, min(args.warmup_steps, total_steps), total_steps)
+    print("%d conversations, %d tokens, about %d optimizer steps" % (len(dataset), dataset.meta["tokens"], total_steps))
+
+    rng = np.random.default_rng(args.seed)
+    step = 0
+    tokens_seen = 0
+    trained_tokens = 0
+    running_loss = 0.0
+    start = time.perf_counter()
+    for epoch in range(args.epochs):
+        micro_step = 0
+        for input_ids, positions, mask, labels in packed_batches(dataset, args.seq_len, args.batch_size, rng):
+            input_ids, positions, mask, labels = input_ids.to(device), positions.to(device), mask.to(device), labels.to(device)
+            with torch.autocast(device_type=device.split(":")[0], dtype=torch.bfloat16, enabled=args.bf16):
+                loss = model(input_ids=input_ids, position_ids=positions, attention_mask=mask, labels=labels).loss
+            (loss / args.accumulation_steps).backward()
+            running_loss += loss.item()
+            tokens_seen += input_ids.numel()
+            trained_tokens += int((labels != -100).sum())
+            micro_step += 1
+            if micro_step % args.accumulation_steps != 0:
+                continue
+
+            optimizer_step(model, optimizer, scheduler)
+            step += 1
+
+            if step % args.log_steps == 0:
+                elapsed = time.perf_counter() - start
+                print("epoch %d step %d/%d loss %.4f %.0f tokens/s (%.0f trained tokens/s)" % (
+                    epoch, step, total_steps, running_loss / (args.log_steps * args.accumulation_steps),
+                    tokens_seen / elapsed, trained_tokens / elapsed
+                ))
+                running_loss = 0.0
+            if step % args.save_steps == 0:
+                torch.save(model.state_dict(), args.output)
+            if step == total_steps:
+                break
+        if step == total_steps:
+            break
+        leftover = micro_step % args.accumulation_steps
+        if leftover:
+            # step on the micro-batches left at the end of the epoch too,
+            # their gradients averaged over how many there are
+            optimizer_step(model, optimizer, scheduler, args.accumulation_steps / leftover)
+            step += 1
+        if step == total_steps:
+            break
+
+    elapsed = time.perf_counter() - start
+    print("%d steps in %.0fs, %.0f tokens/s" % (step, elapsed, tokens_seen / elapsed))
+    # same format as game/static/game/dialoGPT.pth, which load_models reads
+    torch.save(model.state_dict(), args.output)
+    print("Saved " + args.output)
+
+
+if __name__ == '__main__':
+    main()
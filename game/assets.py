@@ -0,0 +1,60 @@
+import os
+import json
+
+
+ASSET_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets.json")
+
+
+class AssetManifest:
+    """
+    Resolves the images of locations, characters and items to the
+    right-sized, content-hashed files built by
+    graphics_generation/derivatives.py. Assets missing from the manifest
+    (or a missing manifest) resolve to the full-size PNG they were built
+    from, so a world without derivatives still renders.
+
+    url turns a path relative to the static root into a URL, e.g. Django's
+    static(); the engine itself never depends on Django. root is the
+    directory under the static root with the full-size images of the world.
+    """
+    def __init__(self, filename=ASSET_MANIFEST, url=None, root="game"):
+        self.manifest = {"assets": {}, "atlases": {}}
+        if filename is not None and os.path.exists(filename):
+            self.manifest = json.load(open(filename, 'r'))
+        self.url = url if url is not None else (lambda path: path)
+        self.root = root
+
+    def image(self, kind, name):
+        """
+        Returns the src of an <img> (the largest PNG) and the srcsets of its
+        WebP and PNG variants, None when there are no variants.
+        """
+        entry = self.manifest["assets"].get(kind + "/" + name)
+        if entry is None:
+            return {"src": self.url("%s/%s/%s.png" % (self.root, kind, name)), "webp": None, "png": None}
+        variants = entry["variants"]
+        return {
+            "src": self.url(variants[-1]["png"]),
+            "webp": ", ".join("%s %dw" % (self.url(variant["webp"]), variant["width"]) for variant in variants),
+            "png": ", ".join("%s %dw" % (self.url(variant["png"]), variant["width"]) for variant in variants)
+        }
+
+    def sprite(self, kind, name):
+        """
+        Returns the inline CSS that shows an asset from the sprite atlas of
+        its class, at whatever size the element has, or None when the asset
+        is not in an atlas.
+        """
+        entry = self.manifest["assets"].get(kind + "/" + name)
+        atlas = self.manifest["atlases"].get(kind)
+        if entry is None or atlas is None or "sprite" not in entry:
+            return None
+        columns, rows = atlas["columns"], atlas["rows"]
+        x = 100 * entry["sprite"]["column"] / (columns - 1) if columns > 1 else 0
+        y = 100 * entry["sprite"]["row"] / (rows - 1) if rows > 1 else 0
+        # browsers without image-set() ignore the second declaration and keep the PNG
+        return (
+            "background-image: url(%s); "
+            "background-image: image-set(url(%s) type(\"image/webp\"), url(%s) type(\"image/png\")); "
+            "background-size: %d%% %d%%; background-position: %.4f%% %.4f%%"
+        ) % (self.url(atlas["png"]), self.url(atlas["webp"]), self.url(atlas["png"]), columns * 100, rows * 100, x, y)
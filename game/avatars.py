@@ -0,0 +1,125 @@
+"""
+Avatars of the players' profile images.
+
+Uploaded profile images are stored as they are, under a content-hashed name
+in a directory of their own per player (see models.update_filename). The
+AvatarWorker turns them into the small square images the game page shows,
+on a background thread so the upload request does not wait for decoding
+and resizing a large photo: an avatar for the chat bubbles and a thumbnail,
+both WebP with content-hashed names next to the upload. Until they are
+ready the page shows the uploaded image.
+"""
+import io
+import os
+import queue
+import hashlib
+import threading
+
+from PIL import Image, ImageOps
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+
+from .models import Profile
+
+
+# Dictionary mapping from Profile field to the width of its square image,
+# twice the size the game displays it at
+SIZES = {
+    "avatar": 144,
+    "thumbnail": 72,
+}
+WEBP_QUALITY = 80
+
+
+def make_square(image, width):
+    # keep the top of portraits, where the faces are
+    return ImageOps.fit(image, (width, width), Image.LANCZOS, centering=(0.5, 0.3))
+
+
+def encode_webp(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "WEBP", quality=WEBP_QUALITY, method=4)
+    return buffer.getvalue()
+
+
+def save_hashed(data, directory, stem, storage=default_storage):
+    """
+    Save data under a name containing its content hash in directory of
+    storage, unless the same content is already there, and return the name.
+    """
+    name = "%s/%s.%s.webp" % (directory, stem, hashlib.sha256(data).hexdigest()[:16])
+    if not storage.exists(name):
+        storage.save(name, ContentFile(data))
+    return name
+
+
+def build_avatars(image_name, storage=default_storage):
+    """
+    Make the images of SIZES from the image image_name of storage, and
+    return a dictionary from Profile field to the name of its image.
+    """
+    with storage.open(image_name, "rb") as infile:
+        image = Image.open(infile)
+        # JPEGs are decoded at a fraction of their size when that is enough
+        largest = max(SIZES.values())
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    directory = os.path.dirname(image_name).replace(os.sep, "/")
+    return {
+        field: save_hashed(encode_webp(make_square(image, width)), directory, field, storage)
+        for field, width in SIZES.items()
+    }
+
+
+class AvatarWorker:
+    """
+    Background thread building the avatars of profiles. on_ready is called
+    with every profile whose avatars were built.
+    """
+    def __init__(self, storage=default_storage, max_queue=100, on_ready=None):
+        self.storage = storage
+        self.on_ready = on_ready
+        self.queue = queue.Queue(maxsize=max_queue)
+        # counters
+        self.built = 0
+        self.failed = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="avatar-worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, profile_id):
+        """
+        Queue the profile to build the avatars of. Returns False, and the
+        profile keeps its uploaded image, when the queue is full.
+        """
+        try:
+            self.queue.put_nowait(profile_id)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def run(self):
+        while True:
+            profile_id = self.queue.get()
+            try:
+                self.process(profile_id)
+            except (OSError, ValueError, Image.DecompressionBombError, Profile.DoesNotExist):
+                # not an image Pillow can read, or deleted in the meantime
+                self.failed += 1
+            finally:
+                close_old_connections()
+
+    def process(self, profile_id):
+        profile = Profile.objects.get(pk=profile_id)
+        if not profile.image:
+            return
+        names = build_avatars(profile.image.name, self.storage)
+        Profile.objects.filter(pk=profile_id).update(**names)
+        for field, name in names.items():
+            setattr(profile, field, name)
+        self.built += 1
+        if self.on_ready is not None:
+            self.on_ready(profile)
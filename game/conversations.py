@@ -0,0 +1,191 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ConversationStore:
+    """
+    The ConversationStore keeps the token history of every conversation
+    between a player session and a character, so that a character still
+    remembers the player after they leave the location and come back.
+    Histories are stored as uint16 arrays (the GPT-2 vocabulary has 50257
+    tokens), a quarter of the size of the int64 tensors the model uses.
+    Each session has a memory cap, and all sessions together another one;
+    when either is exceeded, the least recently used conversations (of that
+    session, or of the least recently used sessions) are spilled to disk
+    and loaded back on the next access without re-tokenizing any text.
+    Sessions idle for longer than max_idle_seconds are forgotten by
+    expire(), in memory and on disk.
+    """
+    def __init__(
+        self,
+        spill_dir,
+        max_session_bytes=256 * 1024,
+        max_bytes=64 * 1024 * 1024,
+        max_idle_seconds=24 * 60 * 60,
+        dtype=np.uint16
+    ):
+        # Directory where evicted conversations are written
+        self.spill_dir = spill_dir
+        # Memory cap for the histories of one session, and of all of them
+        self.max_session_bytes = max_session_bytes
+        self.max_bytes = max_bytes
+        self.max_idle_seconds = max_idle_seconds
+        self.dtype = dtype
+        # OrderedDict mapping from session key to an OrderedDict of
+        # character name to token array, both least recently used first
+        self.sessions = OrderedDict()
+        # Dictionary mapping from session key to bytes held in memory
+        self.session_bytes = {}
+        self.nbytes = 0
+        # Dictionary mapping from session key to the time of its last access
+        self.last_used = {}
+        self.lock = threading.Lock()
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.restores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def session_dir(self, session_key):
+        return os.path.join(self.spill_dir, hashlib.sha1(session_key.encode("utf-8")).hexdigest())
+
+    def spill_path(self, session_key, character_name):
+        """
+        Path of the spill file of a conversation.
+        """
+        character_file = hashlib.sha1(character_name.encode("utf-8")).hexdigest() + ".npy"
+        return os.path.join(self.session_dir(session_key), character_file)
+
+    def get(self, session_key, character_name):
+        """
+        Returns the token history of a conversation as an array, or None if
+        the player has not talked to this character yet.
+        """
+        with self.lock:
+            self.last_used[session_key] = time.time()
+            conversations = self.sessions.get(session_key)
+            if conversations is not None and character_name in conversations:
+                self.hits += 1
+                conversations.move_to_end(character_name)
+                self.sessions.move_to_end(session_key)
+                return conversations[character_name]
+
+            path = self.spill_path(session_key, character_name)
+            if not os.path.exists(path):
+                self.misses += 1
+                return None
+            token_ids = np.load(path)
+            os.remove(path)
+            self.restores += 1
+            self.insert(session_key, character_name, token_ids)
+            return token_ids
+
+    def put(self, session_key, character_name, token_ids):
+        """
+        Store the token history of a conversation.
+        """
+        token_ids = np.asarray(token_ids)
+        if token_ids.size and token_ids.max() > np.iinfo(self.dtype).max:
+            raise ValueError("token id %d does not fit in %s" % (token_ids.max(), np.dtype(self.dtype).name))
+        with self.lock:
+            self.last_used[session_key] = time.time()
+            self.insert(session_key, character_name, token_ids.astype(self.dtype))
+
+    def insert(self, session_key, character_name, token_ids):
+        """
+        Add a history to the in-memory session and spill the least recently
+        used conversations of that session until it fits its cap again,
+        then the ones of the least recently used sessions until all fit the
+        global cap. Callers must hold the lock.
+        """
+        conversations = self.sessions.setdefault(session_key, OrderedDict())
+        self.sessions.move_to_end(session_key)
+        old = conversations.pop(character_name, None)
+        added = token_ids.nbytes - (old.nbytes if old is not None else 0)
+        self.session_bytes[session_key] = self.session_bytes.get(session_key, 0) + added
+        self.nbytes += added
+        conversations[character_name] = token_ids
+
+        # never spill the conversation that was just stored
+        while self.session_bytes[session_key] > self.max_session_bytes and len(conversations) > 1:
+            self.spill(session_key)
+        for other_key in list(self.sessions):
+            if self.nbytes <= self.max_bytes or other_key == session_key:
+                break
+            while other_key in self.sessions:
+                self.spill(other_key)
+
+    def spill(self, session_key):
+        """
+        Write the least recently used conversation of a session to disk.
+        Callers must hold the lock.
+        """
+        conversations = self.sessions[session_key]
+        evicted_name, evicted_ids = conversations.popitem(last=False)
+        path = self.spill_path(session_key, evicted_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, evicted_ids)
+        self.session_bytes[session_key] -= evicted_ids.nbytes
+        self.nbytes -= evicted_ids.nbytes
+        self.evictions += 1
+        if not conversations:
+            del self.sessions[session_key]
+            del self.session_bytes[session_key]
+
+    def drop_session(self, session_key):
+        """
+        Forget every conversation of a session, in memory and on disk.
+        """
+        with self.lock:
+            self.forget(session_key)
+
+    def forget(self, session_key):
+        """
+        Callers must hold the lock.
+        """
+        self.sessions.pop(session_key, None)
+        self.nbytes -= self.session_bytes.pop(session_key, 0)
+        self.last_used.pop(session_key, None)
+        shutil.rmtree(self.session_dir(session_key), ignore_errors=True)
+
+    def expire(self):
+        """
+        Forget the sessions not used for max_idle_seconds, including the
+        spill directories left by sessions of earlier runs.
+        """
+        cutoff = time.time() - self.max_idle_seconds
+        with self.lock:
+            for session_key, used in list(self.last_used.items()):
+                if used < cutoff:
+                    self.forget(session_key)
+                    self.expirations += 1
+            known = {os.path.basename(self.session_dir(session_key)) for session_key in self.last_used}
+        if not os.path.isdir(self.spill_dir):
+            return
+        for entry in os.scandir(self.spill_dir):
+            if entry.is_dir() and entry.name not in known and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                self.expirations += 1
+
+    def stats(self):
+        """
+        Snapshot of the store counters.
+        """
+        with self.lock:
+            return {
+                "sessions": len(self.last_used),
+                "resident_sessions": len(self.sessions),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "restores": self.restores,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
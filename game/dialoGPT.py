@@ -1,46 +1,121 @@
+import threading
+import time
+
+import numpy as np
 import torch
 from transformers import AutoModelForCausalLM, GPT2Tokenizer
+from transformers.generation.streamers import BaseStreamer
+
+from .dialogue_stub import load_stub_models
+from .metrics import STAGE_SECONDS, span
+from .prompts import PLAYER_STR, DialogueOverloaded, build_prompt, npc_str
 
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
 
 
-def load_models(model_path="game/static/game/dialoGPT.pth"):
+def load_models(model_path="game/static/game/dialoGPT.pth", base_model="microsoft/DialoGPT-medium"):
     global device
 
     # initialize tokenizer
     tokenizer = GPT2Tokenizer.from_pretrained('microsoft/DialoGPT-small')
 
-    # initialize model
-    model = AutoModelForCausalLM.from_pretrained(pretrained_model_name_or_path="microsoft/DialoGPT-medium").to(device)
-    model.load_state_dict(torch.load(model_path, map_location=device))
+    # initialize model, optionally with fine-tuned weights on top of the base model
+    model = AutoModelForCausalLM.from_pretrained(pretrained_model_name_or_path=base_model).to(device)
+    if model_path:
+        model.load_state_dict(torch.load(model_path, map_location=device))
     model.eval()
 
     return tokenizer, model
 
 
-def get_dialogue(tokenizer, model, player, character, input_str, chat_history_ids):
-    prompt_str = "Setting:\n* " + character["location"] + ": " + character["location_description"] + "\n\n" \
-             + "Characters:\n* " + character["name"] + ":\n- persona: " + character["persona"] + "\n" \
-             + "- appearance: " + character["appearance"] + "\n* Player:\n" + "- persona: " + player["persona"] + "\n" \
-             + "- appearance: " + player["appearance"] + "\n\n\n===\n\nConversation:\n"
-    player_str = "Player:"
-    npc_str = character["name"] + ":"
-    return generate_response(tokenizer, model, input_str, prompt_str, player_str, npc_str, chat_history_ids)
+def history_to_array(chat_history_ids):
+    """
+    Convert a (1, n) chat history tensor into a flat array of token ids.
+    """
+    return chat_history_ids[0].cpu().numpy()
+
+
+def array_to_history(token_ids):
+    """
+    Convert a flat array of token ids back into a (1, n) chat history tensor.
+    """
+    global device
+    return torch.from_numpy(np.asarray(token_ids, dtype=np.int64)).unsqueeze(0).to(device)
+
+
+def get_dialogue(tokenizer, model, player, character, input_str, chat_history_ids, max_length=256, lore=None, on_text=None):
+    prompt_str = build_prompt(player, character, lore=lore)
+    return generate_response(
+        tokenizer, model, input_str, prompt_str, PLAYER_STR, npc_str(character["name"]), chat_history_ids,
+        max_length=max_length, on_text=on_text
+    )
         
 
-def generate_response(tokenizer, model, input_str, prompt_str, player_str, npc_str, chat_history_ids, max_length=256):
+class StageStreamer(BaseStreamer):
+    """
+    Streamer that notes when generate() emits its first new token, which
+    splits generation time into prefill and decode. Given on_text, it also
+    calls on_text with every new piece of the decoded response as it is
+    generated.
+    """
+    def __init__(self, tokenizer=None, on_text=None):
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.prompt_seen = False
+        self.tokenizer = tokenizer
+        self.on_text = on_text
+        self.token_ids = []
+        self.text = ""
+
+    def put(self, value):
+        # the first call carries the prompt, the second the first new token
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        if self.on_text is not None:
+            self.token_ids.extend(value.flatten().tolist())
+            text = self.tokenizer.decode(self.token_ids, skip_special_tokens=True).replace("#", "")
+            # wait for the rest of a character split across tokens
+            if len(text) > len(self.text) and not text.endswith("\ufffd"):
+                self.on_text(text[len(self.text):])
+                self.text = text
+
+    def end(self):
+        end = time.perf_counter()
+        first_token = self.first_token or end
+        STAGE_SECONDS.observe(first_token - self.start, "prefill")
+        STAGE_SECONDS.observe(end - first_token, "decode")
+
+
+def fit_history(model, chat_history_ids, prompt_length, max_length):
+    """
+    Keep only the most recent history tokens, so that the prompt, the
+    history and max_length new tokens fit the model's positions (1024 for
+    GPT-2). Models without n_positions in their config are not limited.
+    """
+    n_positions = getattr(getattr(model, "config", None), "n_positions", None)
+    if n_positions is None:
+        return chat_history_ids
+    keep = max(0, n_positions - prompt_length - max_length)
+    return chat_history_ids[:, chat_history_ids.shape[-1] - min(keep, chat_history_ids.shape[-1]):]
+
+
+def generate_response(tokenizer, model, input_str, prompt_str, player_str, npc_str, chat_history_ids, max_length=256, on_text=None):
     global device
 
-    newline_ids = tokenizer.encode("\n", return_tensors='pt').to(device)
-    eos_token_id = newline_ids[0]
+    with span("tokenize"):
+        newline_ids = tokenizer.encode("\n", return_tensors='pt').to(device)
+        eos_token_id = newline_ids[0]
 
-    prompt_ids = tokenizer.encode(prompt_str, return_tensors='pt').to(device)
-    player_ids = tokenizer.encode(player_str, return_tensors='pt').to(device)
-    npc_ids = tokenizer.encode(npc_str, return_tensors='pt').long().to(device)
-    input_str_ids = tokenizer.encode(input_str, return_tensors='pt').to(device)
-    chat_history_ids = torch.cat([chat_history_ids, player_ids, input_str_ids, newline_ids, npc_ids], dim=-1)
+        prompt_ids = tokenizer.encode(prompt_str, return_tensors='pt').to(device)
+        player_ids = tokenizer.encode(player_str, return_tensors='pt').to(device)
+        npc_ids = tokenizer.encode(npc_str, return_tensors='pt').long().to(device)
+        input_str_ids = tokenizer.encode(input_str, return_tensors='pt').to(device)
+        chat_history_ids = torch.cat([chat_history_ids, player_ids, input_str_ids, newline_ids, npc_ids], dim=-1)
+        chat_history_ids = fit_history(model, chat_history_ids, prompt_ids.shape[-1], max_length)
 
- 
     bot_input_ids = torch.cat([prompt_ids, chat_history_ids], dim=-1)
     bot_ouput_ids = model.generate(
         bot_input_ids,
@@ -50,10 +125,194 @@ def generate_response(tokenizer, model, input_str, prompt_str, player_str, npc_s
         top_k=50, top_p=0.9, temperature = 0.3,
         do_sample=True,
         num_beams=1,
-        eos_token_id=tokenizer.encode("\n")[0]
+        eos_token_id=tokenizer.encode("\n")[0],
+        streamer=StageStreamer(tokenizer, on_text)
     )
     
     chat_history_ids = bot_ouput_ids[:, prompt_ids.shape[-1]:]
     response = tokenizer.decode(bot_ouput_ids[:, bot_input_ids.shape[-1]:][0], skip_special_tokens=True)
     response = response.replace("#", "")
     return chat_history_ids, response
+
+
+class ModelRouter:
+    """
+    The ModelRouter picks which dialogue model answers a message. Models
+    are given from the preferred (largest) to the cheapest one and share
+    the GPT-2 tokenizer, so chat histories can move freely between them.
+    The router tracks how many generations are in flight and moving
+    averages of the seconds each model needs per request and per
+    generated token. When
+    the projected latency of the preferred model would exceed the budget,
+    the request goes to the next model, and if none fits, the cheapest
+    model answers with a capped max_length. Requests beyond
+    max_queue_depth are rejected instead of queueing without limit. The
+    averages of a model halve every decay_seconds without a new sample, so
+    a model skipped (or capped) under a burst of load is tried again once
+    the load is gone.
+    """
+    def __init__(
+        self,
+        models,
+        latency_budget=3.0,
+        max_queue_depth=8,
+        max_length=256,
+        min_length=24,
+        smoothing=0.2,
+        decay_seconds=30.0
+    ):
+        # models is a list of (name, tokenizer, model) tuples, preferred first
+        self.models = models
+        self.tokenizer = models[0][1]
+        # target end-to-end generation time in seconds
+        self.latency_budget = latency_budget
+        # number of generations allowed to run at the same time
+        self.max_queue_depth = max_queue_depth
+        # default and smallest max_length handed to generate_response
+        self.max_length = max_length
+        self.min_length = min_length
+        # weight of the newest sample in the latency averages
+        self.smoothing = smoothing
+        # seconds for the averages of a model without new samples to halve
+        self.decay_seconds = decay_seconds
+
+        self.queue_depth = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        # request and per-token latencies measured as if the model ran alone
+        self.request_latency = {name: None for name, _, _ in models}
+        self.token_latency = {name: None for name, _, _ in models}
+        # time of the last sample folded into the averages of each model
+        self.sampled_at = {name: None for name, _, _ in models}
+        self.counters = {
+            name: {"routed": 0, "capped": 0, "completed": 0, "errors": 0}
+            for name, _, _ in models
+        }
+
+    def projected_latency(self, name, queue_depth):
+        """
+        Projected seconds for a request to the named model while
+        queue_depth generations share the machine.
+        """
+        request_latency = self.decayed(name, self.request_latency[name])
+        if request_latency is None:
+            return 0.0
+        return request_latency * queue_depth
+
+    def decayed(self, name, average):
+        """
+        The average of the named model, halved for every decay_seconds
+        since its last sample. Callers must hold the lock.
+        """
+        if average is None or not self.decay_seconds:
+            return average
+        age = time.monotonic() - self.sampled_at[name]
+        return average * 0.5 ** (age / self.decay_seconds)
+
+    def route(self):
+        """
+        Reserve a slot and return (name, tokenizer, model, max_length,
+        queue_depth) for the next request. Must be paired with a call to
+        release().
+        """
+        with self.lock:
+            if self.queue_depth >= self.max_queue_depth:
+                self.rejected += 1
+                raise DialogueOverloaded("%d dialogue requests in flight" % self.queue_depth)
+            self.queue_depth += 1
+            queue_depth = self.queue_depth
+
+            for name, tokenizer, model in self.models:
+                if self.projected_latency(name, queue_depth) <= self.latency_budget:
+                    self.counters[name]["routed"] += 1
+                    return name, tokenizer, model, self.max_length, queue_depth
+
+            # nothing fits the budget, so cap the length of the cheapest model
+            name, tokenizer, model = self.models[-1]
+            budget_tokens = self.latency_budget / (self.decayed(name, self.token_latency[name]) * queue_depth)
+            max_length = max(self.min_length, min(self.max_length, int(budget_tokens)))
+            self.counters[name]["routed"] += 1
+            self.counters[name]["capped"] += 1
+            return name, tokenizer, model, max_length, queue_depth
+
+    def release(self, name, elapsed, new_tokens, queue_depth, failed=False):
+        """
+        Free the slot taken by route() and fold the measured latency into
+        the moving average of the model. queue_depth is the depth route()
+        returned; the request is taken to have shared the machine with the
+        mean of that and the depth now.
+        """
+        with self.lock:
+            shared = (queue_depth + self.queue_depth) / 2
+            self.queue_depth -= 1
+            if failed:
+                self.counters[name]["errors"] += 1
+                return
+            self.counters[name]["completed"] += 1
+            request_sample = elapsed / max(shared, 1)
+            token_sample = request_sample / max(new_tokens, 1)
+            self.request_latency[name] = self.smooth(self.decayed(name, self.request_latency[name]), request_sample)
+            self.token_latency[name] = self.smooth(self.decayed(name, self.token_latency[name]), token_sample)
+            self.sampled_at[name] = time.monotonic()
+
+    def smooth(self, average, sample):
+        """
+        Exponential moving average update that starts from the first sample.
+        """
+        if average is None:
+            return sample
+        return average + self.smoothing * (sample - average)
+
+    def get_dialogue(self, player, character, input_str, chat_history_ids, lore=None, on_text=None):
+        """
+        Same as get_dialogue, but answered by whichever model the router
+        picks for the current load.
+        """
+        name, tokenizer, model, max_length, queue_depth = self.route()
+        start = time.perf_counter()
+        try:
+            chat_history_ids, response = get_dialogue(
+                tokenizer, model, player, character, input_str, chat_history_ids, max_length=max_length, lore=lore,
+                on_text=on_text
+            )
+        except Exception:
+            self.release(name, time.perf_counter() - start, 0, queue_depth, failed=True)
+            raise
+        elapsed = time.perf_counter() - start
+        self.release(name, elapsed, len(tokenizer.encode(response)), queue_depth)
+        return chat_history_ids, response
+
+    def stats(self):
+        """
+        Snapshot of the routing counters of every model.
+        """
+        with self.lock:
+            stats = {
+                "queue_depth": self.queue_depth,
+                "rejected": self.rejected,
+                "models": {}
+            }
+            for name, _, _ in self.models:
+                stats["models"][name] = dict(
+                    self.counters[name],
+                    request_latency=self.request_latency[name],
+                    token_latency=self.token_latency[name]
+                )
+            return stats
+
+
+def load_router(model_configs, latency_budget=3.0, max_queue_depth=8, stub=None):
+    """
+    Load every model in model_configs (dicts with "name", "model_path" and
+    "base_model") and wrap them in a ModelRouter. Given stub, a dict of
+    StubModel latency parameters, every model is replaced by a StubModel
+    instead, with the parameters overridden by the config's "stub" dict.
+    """
+    models = []
+    for config in model_configs:
+        if stub is not None:
+            tokenizer, model = load_stub_models(**dict(stub, **config.get("stub", {})))
+        else:
+            tokenizer, model = load_models(config.get("model_path"), base_model=config["base_model"])
+        models.append((config["name"], tokenizer, model))
+    return ModelRouter(models, latency_budget=latency_budget, max_queue_depth=max_queue_depth)
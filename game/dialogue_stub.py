@@ -0,0 +1,152 @@
+"""
+Stand-in for the dialogue models in load tests.
+
+StubModel.generate answers with a canned line after sleeping as long as a
+real model would take: a prefill time growing with the prompt, then a time
+per generated token, slowed down by the other generations running at the
+same time and scattered by random jitter. Everything around generate
+(tokenizing, histories, routing, streaming) runs as usual, so a load test
+measures the web tier and the engine apart from the model. The
+StubTokenizer encodes one token per byte and needs no download, but counts
+(and charges prefill for) about as many tokens as GPT-2's tokenizer would.
+"""
+import re
+import time
+import random
+import threading
+from types import SimpleNamespace
+
+import torch
+
+
+RESPONSES = [
+    "I have not seen anyone pass through here today.",
+    "You should ask at the castle, they know more than I do.",
+    "Be careful, the path ahead is darker than it looks.",
+    "I keep an eye on this place for the headmaster.",
+    "That is a long story, and I am not sure you want to hear it.",
+    "Have you been to Diagon Alley yet?",
+]
+
+
+# Pieces GPT-2's tokenizer splits text into before byte-pair merging,
+# about one token each for English text, where bytes are four times as many
+BPE_PIECES = re.compile(r"'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+")
+
+
+class StubTokenizer:
+    """
+    Stand-in for the GPT-2 tokenizer when it cannot be downloaded: one
+    token per UTF-8 byte, with 256 as the end-of-sequence token.
+    count_tokens estimates how many GPT-2 tokens a text is, so that token
+    budgets (e.g. of lore) cover about as much text as with the real one.
+    """
+    eos_token_id = 256
+
+    def __len__(self):
+        return 257
+
+    def encode(self, text, return_tensors=None):
+        ids = list(text.encode("utf-8"))
+        if return_tensors == "pt":
+            return torch.tensor([ids], dtype=torch.long)
+        return ids
+
+    def decode(self, ids, skip_special_tokens=False):
+        ids = [int(i) for i in ids if int(i) < 256]
+        return bytes(ids).decode("utf-8", errors="ignore")
+
+    def count_tokens(self, text):
+        return len(BPE_PIECES.findall(text))
+
+
+class StubModel:
+    """
+    Sleeps for prefill_seconds + prefill_token_seconds per prompt token
+    (counted as GPT-2 tokens, not bytes), then token_seconds per generated
+    token (about mean_tokens of them, streamed as the bytes of a canned
+    line), each time multiplied by 1 + contention for every other
+    generation in flight and by a lognormal jitter of spread jitter. Like
+    GPT-2, it fails when prompt and answer need more than n_positions
+    positions.
+    """
+    def __init__(
+        self,
+        tokenizer,
+        prefill_seconds=0.05,
+        prefill_token_seconds=0.0002,
+        token_seconds=0.02,
+        mean_tokens=24,
+        jitter=0.2,
+        contention=0.5,
+        n_positions=4096,
+        seed=None
+    ):
+        self.tokenizer = tokenizer
+        self.prefill_seconds = prefill_seconds
+        self.prefill_token_seconds = prefill_token_seconds
+        self.token_seconds = token_seconds
+        self.mean_tokens = mean_tokens
+        self.jitter = jitter
+        self.contention = contention
+        self.rng = random.Random(seed)
+        # like GPT-2's 1024 positions, in bytes of about four per token
+        self.config = SimpleNamespace(n_positions=n_positions)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def eval(self):
+        return self
+
+    def slowdown(self):
+        with self.lock:
+            return (1 + self.contention * (self.in_flight - 1)) * self.rng.lognormvariate(0, self.jitter)
+
+    def generate(self, input_ids, max_length=None, max_new_tokens=None, num_return_sequences=1, streamer=None, **kwargs):
+        positions = max_length or input_ids.shape[-1] + (max_new_tokens or 0)
+        if positions > self.config.n_positions:
+            # GPT-2 runs out of position embeddings the same way
+            raise IndexError("%d positions asked of a model with %d" % (positions, self.config.n_positions))
+        rows = input_ids.shape[0] * num_return_sequences
+        with self.lock:
+            self.in_flight += 1
+            responses = [self.rng.choice(RESPONSES) for _ in range(rows)]
+        try:
+            if streamer is not None:
+                streamer.put(input_ids)
+            # a batch is prefilled at once, as long as its longest prompt
+            prompt_tokens = max(self.tokenizer.count_tokens(self.tokenizer.decode(row)) for row in input_ids)
+            time.sleep((self.prefill_seconds + self.prefill_token_seconds * prompt_tokens) * self.slowdown())
+
+            # every canned line ends with the newline generate_response
+            # stops at, and takes as long as about mean_tokens real tokens,
+            # at most max_length of them
+            if max_new_tokens is None:
+                max_new_tokens = (max_length or input_ids.shape[-1] + 256) - input_ids.shape[-1]
+            budget = max(2, max_new_tokens)
+            answers = [self.tokenizer.encode(response)[:budget - 1] + self.tokenizer.encode("\n") for response in responses]
+            steps = max(len(ids) for ids in answers)
+            tokens = min(budget, max(1, round(self.mean_tokens * self.rng.lognormvariate(0, self.jitter))))
+            step_seconds = self.token_seconds * tokens / steps
+            for step in range(steps):
+                time.sleep(step_seconds * self.slowdown())
+                if streamer is not None and step < len(answers[0]):
+                    streamer.put(torch.tensor([answers[0][step]]))
+            if streamer is not None:
+                streamer.end()
+            # finished answers are padded like generate pads them
+            padded = [ids + [self.tokenizer.eos_token_id] * (steps - len(ids)) for ids in answers]
+            prompts = input_ids.repeat_interleave(num_return_sequences, dim=0)
+            return torch.cat([prompts, torch.tensor(padded, dtype=torch.long)], dim=-1)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def load_stub_models(**latency):
+    """
+    (tokenizer, model) like load_models, with the model's latency set by
+    the keyword arguments of StubModel.
+    """
+    tokenizer = StubTokenizer()
+    return tokenizer, StubModel(tokenizer, **latency)
@@ -0,0 +1,143 @@
+"""
+Typo-tolerant matching of what the player typed against the names in
+scope: command verbs, directions, items and characters.
+
+A FuzzyIndex maps names to values through an index of their character
+trigrams. A lookup first tries the exact name (a dictionary hit), then only
+verifies names sharing enough trigrams with the query to be within the
+allowed number of edits, so it stays fast in rooms with hundreds of things.
+"""
+from collections import Counter, defaultdict
+from itertools import chain
+
+
+def max_edits(text):
+    """
+    Edits allowed when matching text: none for very short words, where a
+    single edit turns one word into another, two for long ones.
+    """
+    if len(text) <= 2:
+        return 0
+    if len(text) <= 5:
+        return 1
+    return 2
+
+
+def trigrams(text):
+    padded = "  " + text + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    """
+    Levenshtein distance of a and b counting a swap of two adjacent
+    characters as one edit (optimal string alignment), or limit + 1 as soon
+    as it is certain to exceed limit. Only the cells within limit of the
+    diagonal are computed, since any other alignment takes more edits.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    over = limit + 1
+    previous_previous = None
+    previous = [j if j <= limit else over for j in range(len(b) + 1)]
+    for i, a_char in enumerate(a, 1):
+        current = [over] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        row_min = current[0]
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            b_char = b[j - 1]
+            if a_char == b_char:
+                value = previous[j - 1]
+            else:
+                value = previous[j - 1] + 1
+                if previous[j] < value - 1:
+                    value = previous[j] + 1
+                if current[j - 1] < value - 1:
+                    value = current[j - 1] + 1
+                if j > 1 and i > 1 and a_char == b[j - 2] and a[i - 2] == b_char and previous_previous[j - 2] + 1 < value:
+                    value = previous_previous[j - 2] + 1
+            if value > over:
+                value = over
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > limit:
+            return over
+        previous_previous, previous = previous, current
+    return min(previous[-1], over)
+
+
+class FuzzyIndex:
+    """
+    Index of lowercased names, each with a value, for match().
+    """
+    def __init__(self, entries=()):
+        # Dictionary mapping from name to value
+        self.values = {}
+        # Dictionary mapping from trigram to the names containing it
+        self.postings = defaultdict(set)
+        for name, value in entries:
+            self.add(name, value)
+
+    def add(self, name, value):
+        name = name.lower()
+        self.values[name] = value
+        for trigram in trigrams(name):
+            self.postings[trigram].add(name)
+
+    def remove(self, name):
+        name = name.lower()
+        if self.values.pop(name, None) is None:
+            return
+        for trigram in trigrams(name):
+            self.postings[trigram].discard(name)
+
+    def match(self, query, limit=None):
+        """
+        The value of the name closest to query within limit edits (by
+        default max_edits(query)), or None. Ties go to the name sharing the
+        most trigrams with query.
+        """
+        query = query.lower().strip()
+        if query in self.values:
+            return self.values[query]
+        limit = max_edits(query) if limit is None else limit
+        if limit == 0:
+            return None
+
+        query_trigrams = trigrams(query)
+        needed = len(query_trigrams) - 4 * limit
+        if needed <= 0:
+            # too short for shared trigrams to rule anything out
+            shared = dict.fromkeys(self.values, 0)
+            for trigram in query_trigrams:
+                for name in self.postings.get(trigram, ()):
+                    shared[name] += 1
+        else:
+            # a name sharing needed of the query's trigrams shares one of
+            # any len(query_trigrams) - needed + 1 of them, so only the
+            # postings of the rarest ones are read to find the candidates
+            postings = sorted((self.postings.get(trigram, ()) for trigram in query_trigrams), key=len)
+            names = set().union(*postings[:len(postings) - needed + 1])
+            shared = Counter(chain.from_iterable(names.intersection(posting) for posting in postings))
+
+        # each edit changes at most 3 trigrams, a swap at most 4, so a name
+        # sharing count trigrams is at least (len(query_trigrams) - count) / 4
+        # edits away: checking the names sharing the most trigrams first
+        # stops as soon as the rest cannot be closer than the best so far
+        best = None
+        bound = limit
+        candidates = [(-count, name) for name, count in shared.items() if count >= needed]
+        for count, name in sorted(candidates):
+            count = -count
+            if -(-(len(query_trigrams) - count) // 4) > bound:
+                break
+            distance = edit_distance(query, name, bound)
+            if distance <= bound:
+                best = name
+                bound = distance - 1
+        return self.values[best] if best is not None else None
+
+    def __len__(self):
+        return len(self.values)
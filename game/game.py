@@ -1,6 +1,11 @@
 import os
 import json
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
+
+from .assets import AssetManifest
+from .fuzzy import FuzzyIndex
+from .metrics import timed
 
 
 class Game:
@@ -12,13 +17,20 @@ class Game:
     adjacent location. The player can move from one location to another
     location by typing a command like "Go North".
     """
-    def __init__(self, start_at):
+    def __init__(self, start_at, assets=None):
         # start_at is the location in the game where the player starts
         self.curr_location = start_at
         self.curr_location.has_been_visited = True
+
+        # resolves the images of locations, characters and items
+        self.assets = assets if assets is not None else AssetManifest()
         
         # inventory is the set of objects that the player has collected
         self.inventory = {}
+
+        # Dictionary mapping from location name to Location objects, filled
+        # in by build_world
+        self.locations = {}
         
         # properties of the play
         self.properties = {}
@@ -37,6 +49,7 @@ class Game:
         self.defeat_enemy_score = 0
         self.special_event_score = 0
 
+    @timed("describe")
     def describe(self):
         """
         Describe the current game state by first describing the current 
@@ -81,6 +94,7 @@ class Game:
             narration = "You see:\n" + "".join(items)
         return narration
 
+    @timed("characters")
     def get_current_characters(self):
         characters = []
         if len(self.curr_location.items) > 0:
@@ -90,7 +104,8 @@ class Game:
                     continue
                 characters.append({
                     "name": character.name,
-                    "headshot": "game/characters/" + character.name_clean + ".png",
+                    "headshot": self.assets.image("characters", character.name_clean),
+                    "sprite": self.assets.sprite("characters", character.name_clean),
                     "location": self.curr_location.name,
                     "location_description": self.curr_location.description,
                     "persona": character.description,
@@ -99,6 +114,7 @@ class Game:
                 })
         return characters
 
+    @timed("items")
     def get_current_items(self):
         items = []
         for item_name in self.curr_location.items:
@@ -107,7 +123,7 @@ class Game:
                 continue
             items.append({
                 "name": item.name.title(),
-                "image": "game/items/" + item.name_clean + ".png",
+                "image": self.assets.image("items", item.name_clean),
                 "description": item.description,
                 "in_location": True
             })
@@ -117,7 +133,7 @@ class Game:
                 continue
             items.append({
                 "name": item.name.title(),
-                "image": "game/items/" + item.name_clean + ".png",
+                "image": self.assets.image("items", item.name_clean),
                 "description": item.description,
                 "in_location": False
             })
@@ -181,6 +197,11 @@ class Location:
         self.is_lingerable = True
         # special events preconditions
         self.special_events = []
+        # (things, characters) FuzzyIndex of the items here, kept up to date
+        # as items come and go so that no lookup has to build it
+        self.item_index = (FuzzyIndex(), FuzzyIndex())
+        # FuzzyIndex of the connections, by every run of words of their names
+        self.direction_index = None
 
     def set_property(self, property_name, property_bool=True):
         """
@@ -244,6 +265,7 @@ class Location:
         Put an item in this location.
         """
         self.items[name] = item
+        self.item_index[1 if item.properties["character"] else 0].add(name, name)
 
     def remove_item(self, item):
         """
@@ -251,6 +273,7 @@ class Location:
         up and puts it in their inventory).
         """
         self.items.pop(item.name)
+        self.item_index[1 if item.properties["character"] else 0].remove(item.name)
 
 
 class Item:
@@ -312,6 +335,21 @@ class Item:
         self.commands[command_text] = (function, arguments, preconditions, failure_reason)
 
 
+# Words that start a command, to correct when mistyped
+COMMAND_WORDS = FuzzyIndex(
+    (word, word) for word in
+    ["examine", "take", "get", "drop", "inventory", "look", "redescribe", "north", "south", "east", "west"]
+)
+
+# Dictionary mapping from intent to the words before the name of its object
+OBJECT_VERBS = {
+    "examine": ["examine ", "x "],
+    "take": ["take ", "get "],
+    "drop": ["drop "],
+    "character": ["who is "]
+}
+
+
 class Parser:
     """
     The Parser is the class that handles the player's input. The player 
@@ -319,11 +357,15 @@ class Parser:
     in order to interpret what the player intended, and how that intent
     is reflected in the simulated world. 
     """
-    def __init__(self, game):
-        # A list of all of the commands that the player has issued.
-        self.command_history = []
+    def __init__(self, game, telemetry=None, history_size=100):
+        # The most recent history_size commands that the player has issued.
+        self.command_history = deque(maxlen=history_size)
         # A pointer to the game.
         self.game = game
+        # TelemetryLog that every command is recorded to, if any
+        self.telemetry = telemetry
+        # FuzzyIndex of the inventory, brought up to date when looked up
+        self.inventory_index = FuzzyIndex()
 
     def get_player_intent(self, command):
         command = command.lower()
@@ -349,9 +391,11 @@ class Parser:
     def parse_command(self, command):
         # Add this command to the history
         self.command_history.append(command)
-
+        start = time.perf_counter()
+        location = self.game.curr_location.name
+        typed = command
         # Intents are functions that can be executed
-        intent = self.get_player_intent(command)
+        command, intent = self.correct_command(command)
         if intent == "direction":
             narration = self.go_in_direction(command)
         elif intent == "redescribe":
@@ -378,8 +422,100 @@ class Parser:
         if intent in ["take", "drop"]:
             items = self.game.get_current_items()
 
+        if self.telemetry is not None:
+            self.telemetry.record(
+                "command", command=typed, corrected=command if command != typed else None, intent=intent,
+                location=location, seconds=time.perf_counter() - start
+            )
         return narration, characters, items
 
+    ### Typo Correction ###
+    def correct_command(self, command):
+        """
+        Returns (command, intent) with a mistyped verb, direction, item or
+        character name in the command replaced by the closest one in scope.
+        The command is unchanged when it already matches exactly or nothing
+        is close enough.
+        """
+        intent = self.get_player_intent(command)
+        if intent is None:
+            words = command.lower().split(" ", 1)
+            verb = COMMAND_WORDS.match(words[0])
+            if verb is None:
+                return command, intent
+            command = " ".join([verb] + words[1:])
+            intent = self.get_player_intent(command)
+        if intent == "direction":
+            return self.correct_direction(command), intent
+        if intent in OBJECT_VERBS:
+            return self.correct_object(command, intent), intent
+        return command, intent
+
+    def correct_direction(self, command):
+        direction = self.get_direction(command)
+        location = self.game.curr_location
+        if not direction or any(direction in connection for connection in location.connections):
+            return command
+        if location.direction_index is None:
+            location.direction_index = FuzzyIndex()
+            for connection in location.connections:
+                words = connection.split()
+                for start in range(len(words)):
+                    for end in range(start + 1, len(words) + 1):
+                        location.direction_index.add(" ".join(words[start:end]), connection)
+        connection = location.direction_index.match(direction)
+        return command if connection is None else "go " + connection
+
+    def correct_object(self, command, intent):
+        lowered = command.lower()
+        for verb in OBJECT_VERBS[intent]:
+            if verb in lowered:
+                prefix, words = lowered.split(verb, 1)
+                break
+        else:
+            return command
+
+        location = self.game.curr_location
+        if intent == "character":
+            scopes = [(location.items, lambda: self.location_indexes()[1])]
+        elif intent == "drop":
+            scopes = [(self.game.inventory, self.get_inventory_index)]
+        else:
+            scopes = [(location.items, lambda: self.location_indexes()[0]), (self.game.inventory, self.get_inventory_index)]
+
+        # exact matches are left to the intent functions, whether the words
+        # are an item's name or some run of them is (looked up by run rather
+        # than by scanning every name in a crowded room)
+        if any(words in items for items, _ in scopes):
+            return command
+        indexes = [index() for _, index in scopes]
+        split = lowered.split()
+        runs = {" ".join(split[start:end]) for start in range(len(split)) for end in range(start + 1, len(split) + 1)}
+        if any(run in index.values for index in indexes for run in runs):
+            return command
+        for index in indexes:
+            item_name = index.match(words)
+            if item_name is not None:
+                return prefix + verb + item_name.lower()
+        return command
+
+    def location_indexes(self):
+        """
+        FuzzyIndex of the things and of the characters at the current
+        location.
+        """
+        return self.game.curr_location.item_index
+
+    def get_inventory_index(self):
+        index = self.inventory_index
+        names = {name.lower(): name for name in self.game.inventory}
+        for name in [name for name in index.values if name not in names]:
+            index.remove(name)
+        for lowered, name in names.items():
+            if lowered not in index.values:
+                index.add(name, name)
+        return index
+
     ### Intent Functions ###
     def go_in_direction(self, command):
         """
@@ -557,14 +693,34 @@ class Parser:
         return None
 
 
-def build_game(
+# Index of the location where the player starts when a world names none
+DEFAULT_START_INDEX = 5
+
+
+def load_world_data(
     locations_filename="game/static/game/data/locations.json",
     characters_filename="game/static/game/data/characters.json",
     items_filename="game/static/game/data/items.json"
 ):
+    """
+    The parsed world data files, which build_world builds any number of
+    independent games from.
+    """
+    return {
+        "locations": json.load(open(locations_filename, 'r')),
+        "characters": json.load(open(characters_filename, 'r')),
+        "items": json.load(open(items_filename, 'r'))
+    }
+
+
+def build_world(world_data, assets=None, start=None):
+    """
+    A new Game of the world in world_data, starting at the location named
+    start (by default the one at DEFAULT_START_INDEX).
+    """
     # initialize locations
     locations = {}
-    location_data = json.load(open(locations_filename, 'r'))
+    location_data = world_data["locations"]
     for name, data in location_data.items():
         locations[name] = {
             "obj": Location(name, data["description"]),
@@ -579,17 +735,33 @@ def build_game(
 
     # initialize characters
     characters = []
-    characters_data = json.load(open(characters_filename, 'r'))
+    characters_data = world_data["characters"]
     for name, data in characters_data.items():
         character = Item(name, data["description"], data["appearance"], start_at=locations[data["location"]]['obj'], character=True)
         characters.append(character)
 
     # initialize items
     items = []
-    items_data = json.load(open(items_filename, 'r'))
+    items_data = world_data["items"]
     for name, data in items_data.items():
         item = Item(name, data["description"], data["description"], start_at=locations[data["location"]]['obj'], character=False)
         items.append(item)
 
-    game = Game(list(locations.values())[5]["obj"])
+    if start is None:
+        start = list(locations)[min(DEFAULT_START_INDEX, len(locations) - 1)]
+    elif start not in locations:
+        raise ValueError("the world has no location %r to start at" % start)
+    game = Game(locations[start]["obj"], assets)
+    game.locations = {name: data["obj"] for name, data in locations.items()}
     return game
+
+
+def build_game(
+    locations_filename="game/static/game/data/locations.json",
+    characters_filename="game/static/game/data/characters.json",
+    items_filename="game/static/game/data/items.json",
+    assets=None,
+    start=None
+):
+    world_data = load_world_data(locations_filename, characters_filename, items_filename)
+    return build_world(world_data, assets, start)
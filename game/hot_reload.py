@@ -0,0 +1,179 @@
+"""
+Hot reload of world data.
+
+A WorldWatcher polls the data files of the worlds a WorldRegistry has
+loaded and, when one changes, parses the new data into a new template and
+swaps it in (WorldRegistry.reload). Games started afterwards use the new
+data; a running game is carried over to it with rebase_game on its next
+command, keeping what the player did: where they are, what they carry,
+where they left things and where they have been. Only the new data is
+parsed and every game is rebuilt from it, so a content fix takes
+milliseconds and no model or worker is restarted.
+"""
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Placement of an item in the player's inventory
+INVENTORY = None
+
+
+def diff_worlds(old_data, new_data):
+    """
+    Structural difference of two world data dictionaries: the locations
+    added, removed or changed (description or connections), and the
+    characters and items added, removed, changed or moved to another
+    location (with their old and new location).
+    """
+    diff = {}
+    old_locations, new_locations = old_data["locations"], new_data["locations"]
+    diff["locations"] = {
+        "added": sorted(set(new_locations) - set(old_locations)),
+        "removed": sorted(set(old_locations) - set(new_locations)),
+        "changed": sorted(
+            name for name in set(old_locations) & set(new_locations)
+            if old_locations[name].get("description") != new_locations[name].get("description")
+            or old_locations[name].get("connections") != new_locations[name].get("connections")
+        )
+    }
+    for kind in ["characters", "items"]:
+        old, new = old_data[kind], new_data[kind]
+        both = set(old) & set(new)
+        diff[kind] = {
+            "added": sorted(set(new) - set(old)),
+            "removed": sorted(set(old) - set(new)),
+            "changed": sorted(
+                name for name in both
+                if {key: value for key, value in old[name].items() if key != "location"}
+                != {key: value for key, value in new[name].items() if key != "location"}
+            ),
+            "moved": {
+                name: [old[name]["location"], new[name]["location"]]
+                for name in sorted(both) if old[name]["location"] != new[name]["location"]
+            }
+        }
+    return diff
+
+
+def is_empty(diff):
+    return not any(changes for section in diff.values() for changes in section.values())
+
+
+def placements(game):
+    """
+    Dictionary mapping from item name to the name of the location it is in
+    in game, or INVENTORY.
+    """
+    placed = {}
+    for location_name, location in game.locations.items():
+        for item_name in location.items:
+            placed[item_name] = location_name
+    for item_name in game.inventory:
+        placed[item_name] = INVENTORY
+    return placed
+
+
+def rebase_game(game, old_data, new_game, new_data):
+    """
+    Carry the player's state from game, played on old_data, over to
+    new_game, freshly built from new_data, and return new_game. The player
+    stays where they are (or goes to the start if that location was
+    removed) and keeps what they carry. Things they moved stay where they
+    left them, unless the new data moved them too, then the data wins.
+    Removed things are gone, also from the inventory.
+    """
+    old_items = dict(old_data["items"], **old_data["characters"])
+    new_items = dict(new_data["items"], **new_data["characters"])
+    new_placed = placements(new_game)
+
+    for item_name, placed in placements(game).items():
+        if item_name not in new_items or item_name not in new_placed:
+            continue
+        home = old_items.get(item_name, {}).get("location")
+        if placed is not INVENTORY and (placed == home or new_items[item_name]["location"] != home):
+            # not moved by the player, or moved by the new data as well
+            continue
+        if placed is not INVENTORY and placed not in new_game.locations:
+            continue
+        location = new_game.locations[new_placed[item_name]]
+        item = location.items[item_name]
+        location.remove_item(item)
+        if placed is INVENTORY:
+            new_game.add_to_inventory(item)
+        else:
+            new_game.locations[placed].add_item(item_name, item)
+
+    for name, location in game.locations.items():
+        if location.has_been_visited and name in new_game.locations:
+            new_game.locations[name].has_been_visited = True
+    new_game.visited_place = {name for name in game.visited_place if name in new_game.locations}
+    for attribute in ["properties", "print_commands", "defeat_enemy_score", "special_event_score"]:
+        setattr(new_game, attribute, getattr(game, attribute))
+    location = new_game.locations.get(game.curr_location.name)
+    if location is not None:
+        new_game.curr_location = location
+        location.has_been_visited = True
+    return new_game
+
+
+class WorldWatcher:
+    """
+    Background thread reloading the worlds of registry whose data files
+    changed, checked every interval seconds. on_reload is called with the
+    world ID and the diff of every reload (None for a sharded world).
+    """
+    def __init__(self, registry, interval=1.0, on_reload=None):
+        self.registry = registry
+        self.interval = interval
+        self.on_reload = on_reload
+        # Dictionary mapping from world ID to the signature of data files
+        # that failed to load, not tried again until they change
+        self.failed = {}
+        # counters
+        self.reloads = 0
+        self.errors = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="world-watcher", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                # the next change must still be picked up
+                logger.exception("checking worlds for changes failed")
+
+    def check(self):
+        """
+        Reload every changed world now. Returns the IDs of the worlds reloaded.
+        """
+        reloaded = []
+        for world_id, signature in self.registry.changed():
+            if self.failed.get(world_id) == signature:
+                continue
+            try:
+                old, new = self.registry.reload(world_id)
+            except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                # a file half written, or invalid data (e.g. a list where a
+                # dictionary belongs): keep playing the old one
+                logger.exception("reload of world %s rejected", world_id)
+                self.errors += 1
+                self.failed[world_id] = signature
+                continue
+            self.failed.pop(world_id, None)
+            if new is None:
+                continue
+            self.reloads += 1
+            reloaded.append(world_id)
+            if self.on_reload is not None:
+                # a sharded world has no data in memory to compare
+                sharded = old.world_data is None or new.world_data is None
+                self.on_reload(world_id, None if sharded else diff_worlds(old.world_data, new.world_data))
+        return reloaded
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
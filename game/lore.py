@@ -0,0 +1,137 @@
+import re
+import string
+from collections import Counter, defaultdict
+
+import numpy as np
+
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "for", "from", "has", "have",
+    "he", "her", "his", "i", "in", "is", "it", "its", "me", "my", "of", "on", "or", "she",
+    "that", "the", "their", "they", "this", "to", "was", "what", "where", "which", "who",
+    "why", "with", "you", "your"
+}
+
+
+def tokenize(text):
+    """
+    Lowercase text and split it into content words.
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+def split_sentences(text):
+    """
+    Split a description into sentences.
+    """
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.split(text) if sentence.strip()]
+
+
+def lore_snippet(name, sentence):
+    """
+    Format a sentence about a location, character or item as a snippet.
+    """
+    return string.capwords(name) + ": " + sentence
+
+
+class LoreIndex:
+    """
+    The LoreIndex holds every description of the world, split into one
+    snippet per sentence, and a TF-IDF matrix over those snippets. The
+    matrix is stored column-wise as posting arrays (snippet ids and
+    weights per term), so a query only touches the postings of its own
+    terms. Snippets are prefixed with the name of what they describe, e.g.
+    "Wand: A wand is a magic staff used by wizards and witches.", which is
+    the same shape as the bullets of the Setting section of a prompt.
+    """
+    def __init__(self, snippets):
+        # List of snippet strings
+        self.snippets = snippets
+        # Token count of each snippet, filled in lazily by count_tokens
+        self.token_counts = np.full(len(snippets), -1, dtype=np.int32)
+
+        term_counts = [Counter(tokenize(snippet)) for snippet in snippets]
+        document_frequency = Counter()
+        for counts in term_counts:
+            document_frequency.update(counts.keys())
+        # Dictionary mapping from term to inverse document frequency
+        self.idf = {
+            term: np.log((1 + len(snippets)) / (1 + frequency)) + 1
+            for term, frequency in document_frequency.items()
+        }
+
+        postings = defaultdict(lambda: ([], []))
+        for snippet_id, counts in enumerate(term_counts):
+            weights = {term: count * self.idf[term] for term, count in counts.items()}
+            norm = np.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+            for term, weight in weights.items():
+                postings[term][0].append(snippet_id)
+                postings[term][1].append(weight / norm)
+        # Dictionary mapping from term to (snippet ids, weights) arrays
+        self.postings = {
+            term: (np.array(ids, dtype=np.int32), np.array(weights, dtype=np.float32))
+            for term, (ids, weights) in postings.items()
+        }
+
+    def search(self, query, k=4):
+        """
+        Returns the ids of the k snippets most similar to the query, best first.
+        """
+        scores = np.zeros(len(self.snippets), dtype=np.float32)
+        for term, count in Counter(tokenize(query)).items():
+            if term not in self.postings:
+                continue
+            ids, weights = self.postings[term]
+            scores[ids] += count * self.idf[term] * weights
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        return candidates[np.argsort(-scores[candidates])].tolist()
+
+    def retrieve(self, query, k=4, token_budget=96, count_tokens=None, exclude=()):
+        """
+        Returns up to k snippets relevant to the query whose total length
+        fits in token_budget. count_tokens measures a snippet in model
+        tokens and defaults to a whitespace word count.
+        """
+        if count_tokens is None:
+            count_tokens = lambda text: len(text.split())
+        selected = []
+        used = 0
+        for snippet_id in self.search(query, k + len(exclude)):
+            snippet = self.snippets[snippet_id]
+            if snippet in exclude:
+                continue
+            if self.token_counts[snippet_id] < 0:
+                self.token_counts[snippet_id] = count_tokens(snippet)
+            if used + self.token_counts[snippet_id] > token_budget:
+                continue
+            used += self.token_counts[snippet_id]
+            selected.append(snippet)
+            if len(selected) == k:
+                break
+        return selected
+
+
+def build_lore_index(world_data):
+    """
+    Chunk every description of a world's data, as load_world_data returns
+    it, into sentences and index them.
+    """
+    snippets = []
+    seen = set()
+    for key, fields in [
+        ("locations", ["description", "appearance"]),
+        ("characters", ["description", "appearance"]),
+        ("items", ["description"])
+    ]:
+        for name, entry in world_data[key].items():
+            for field in fields:
+                for sentence in split_sentences(entry.get(field, "")):
+                    snippet = lore_snippet(name, sentence)
+                    if snippet not in seen:
+                        seen.add(snippet)
+                        snippets.append(snippet)
+    return LoreIndex(snippets)
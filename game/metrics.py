@@ -0,0 +1,140 @@
+import time
+import bisect
+import functools
+import threading
+
+
+# Upper bounds in seconds of the stage histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Every metric that render_metrics exposes, in registration order
+REGISTRY = []
+
+
+def format_labels(label, label_value, extra=""):
+    """
+    Render the {label="value"} part of a sample line.
+    """
+    labels = []
+    if label is not None:
+        labels.append('%s="%s"' % (label, str(label_value).replace('"', '\\"')))
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Histogram:
+    """
+    A Prometheus histogram, optionally split by the value of one label.
+    Observing a value costs a bisect and a few increments under a lock.
+    """
+    def __init__(self, name, documentation, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # Dictionary mapping from label value to [bucket counts, sum, count]
+        self.series = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, label_value=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            series = [(label_value, list(counts), total, count) for label_value, (counts, total, count) in self.series.items()]
+        for label_value, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else repr(bound))
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(self.label, label_value, le), cumulative))
+            lines.append("%s_sum%s %r" % (self.name, format_labels(self.label, label_value), total))
+            lines.append("%s_count%s %d" % (self.name, format_labels(self.label, label_value), count))
+        return lines
+
+
+class Callback:
+    """
+    A gauge or counter whose value is read from a function at scrape time,
+    so the hot path does not pay anything for it. The function returns a
+    number, or a dictionary from label value to number when label is set.
+    """
+    def __init__(self, name, documentation, function, kind="gauge", label=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.kind = kind
+        self.label = label
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+        values = self.function()
+        if self.label is None:
+            values = {None: values}
+        for label_value, value in values.items():
+            lines.append("%s%s %r" % (self.name, format_labels(self.label, label_value), value))
+        return lines
+
+
+def render_metrics():
+    """
+    Render every registered metric in the Prometheus text format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "game_stage_seconds",
+    "Time spent in each stage of handling a request.",
+    label="stage"
+)
+
+
+class span:
+    """
+    Context manager that records the time spent in a stage, e.g.
+
+        with span("parse"):
+            parser.parse_command(command)
+    """
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, self.stage)
+
+
+def timed(stage):
+    """
+    Decorator that records every call of a function as a stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - start, stage)
+        return wrapper
+    return decorator
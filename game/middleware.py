@@ -0,0 +1,20 @@
+from django.conf import settings
+
+
+class ImmutableAssetsMiddleware:
+    """
+    Marks responses for content-hashed assets as cacheable forever: their
+    name changes whenever their content does, so a browser never has to
+    revalidate them. Applies to the paths under IMMUTABLE_ASSET_PREFIXES
+    when static files are served through Django (e.g. with WhiteNoise); a
+    front server serving them directly needs the same header.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.prefixes = tuple(settings.IMMUTABLE_ASSET_PREFIXES)
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if request.path.startswith(self.prefixes) and response.status_code == 200:
+            response["Cache-Control"] = "public, max-age=%d, immutable" % settings.IMMUTABLE_ASSET_MAX_AGE
+        return response
@@ -1,10 +1,29 @@
 from django.db import models
 import os
+import hashlib
 
 # Create your models here.
 
+def player_directory(session_key):
+    """
+    Directory of the images of a player, named after a hash of their
+    session so that the session key itself is not exposed in URLs.
+    """
+    return os.path.join("images", "profiles", hashlib.sha1(session_key.encode("utf-8")).hexdigest()[:16])
+
+
 def update_filename(instance, filename):
-    return os.path.join("images", "profile.png")
+    """
+    The uploaded image is named after a hash of its content, so uploading
+    the same image twice stores it once and images never overwrite each
+    other.
+    """
+    digest = hashlib.sha256()
+    for chunk in instance.image.chunks():
+        digest.update(chunk)
+    instance.image.seek(0)
+    extension = os.path.splitext(filename)[1].lower() or ".png"
+    return os.path.join(player_directory(instance.session_key), digest.hexdigest()[:16] + extension)
 
 
 class Profile(models.Model):
@@ -12,6 +31,11 @@ class Profile(models.Model):
     persona = models.TextField("Persona", default="")
     appearance = models.TextField("Appearance", default="")
     image = models.ImageField(upload_to=update_filename, blank=True, null=True)
+    # Session of the player the profile belongs to
+    session_key = models.CharField(max_length=40, default="", blank=True, db_index=True)
+    # Square WebP images built from image by game.avatars.AvatarWorker
+    avatar = models.ImageField(blank=True, null=True, editable=False)
+    thumbnail = models.ImageField(blank=True, null=True, editable=False)
 
     def __str__(self):
         return self.name
@@ -0,0 +1,194 @@
+"""
+Many players in one world.
+
+Every Player has its own Game (position, inventory, visited places) and
+Parser over the Location and Item objects of a SharedWorld, so players see
+each other and contend for the same items. Each location has its own lock:
+a command holds the lock of the player's location (and, for a move, of the
+destination too), so commands in different rooms never wait for each other
+and two players taking the same item cannot both get it. Room events
+(players entering, leaving, taking and dropping things) are delivered only
+to the players in that room, from a set of players per location.
+
+This is the engine side only: game/views.py and game/sockets.py still run
+every session on their one shared Game, so web players do not get a
+Player of their own yet and no room events reach them. For now SharedWorld
+is driven by benchmarks/multiplayer_benchmark.py.
+"""
+import threading
+from collections import defaultdict, deque
+from contextlib import ExitStack
+
+from .game import Game, Parser, build_game
+
+
+class Player:
+    """
+    A player of a SharedWorld. Events of the room they are in are appended
+    to events (the most recent max_events of them) and passed to on_event.
+    """
+    def __init__(self, name, start_at, assets=None, on_event=None, max_events=100):
+        self.name = name
+        self.game = Game(start_at, assets)
+        self.parser = Parser(self.game)
+        self.events = deque(maxlen=max_events)
+        self.on_event = on_event
+        self.received = 0
+
+    def deliver(self, event):
+        # only called with the lock of the player's room held
+        self.received += 1
+        self.events.append(event)
+        if self.on_event is not None:
+            self.on_event(event)
+
+
+class SharedWorld:
+    """
+    The shared state of a multiplayer world: who is where, and a lock per
+    location. With lock_mode="world" every command takes one lock for the
+    whole world instead, to compare against.
+    """
+    def __init__(self, start_at, assets=None, lock_mode="location"):
+        if lock_mode not in ("location", "world"):
+            raise ValueError("lock_mode must be 'location' or 'world', not %r" % lock_mode)
+        self.start_at = start_at
+        self.assets = assets
+        self.lock_mode = lock_mode
+        # Dictionary mapping from player name to Player objects
+        self.players = {}
+        # Dictionary mapping from location name to the players there
+        self.present = defaultdict(set)
+        # Dictionary mapping from location name to its lock, made on first use
+        self.locks = {}
+        self.world_lock = threading.Lock()
+
+    def lock(self, location):
+        if self.lock_mode == "world":
+            return self.world_lock
+        lock = self.locks.get(location.name)
+        if lock is None:
+            # setdefault is atomic, so racing threads end up with the same lock
+            lock = self.locks.setdefault(location.name, threading.Lock())
+        return lock
+
+    def locked(self, *locations):
+        """
+        Context manager holding the locks of locations, always taken in the
+        order of the location names so that two moves cannot deadlock.
+        """
+        stack = ExitStack()
+        locks = []
+        for location in sorted({location.name: location for location in locations}.values(), key=lambda l: l.name):
+            lock = self.lock(location)
+            if lock not in locks:
+                locks.append(lock)
+        for lock in locks:
+            stack.enter_context(lock)
+        return stack
+
+    def publish(self, location, event, exclude=None):
+        """
+        Deliver event to the players in location. Called with the
+        location's lock held, so every player sees a room's events in the
+        same order.
+        """
+        for player in self.present[location.name]:
+            if player is not exclude:
+                player.deliver(event)
+
+    def others_here(self, player):
+        return sorted(other.name for other in self.present[player.game.curr_location.name] if other is not player)
+
+    def join(self, name, on_event=None):
+        if name in self.players:
+            raise ValueError("%s is already playing" % name)
+        player = Player(name, self.start_at, self.assets, on_event)
+        with self.locked(self.start_at):
+            self.players[name] = player
+            self.present[self.start_at.name].add(player)
+            self.publish(self.start_at, {"type": "enter", "player": name, "location": self.start_at.name}, player)
+        return player
+
+    def leave(self, player):
+        """
+        Remove player from the world. The things they carried are left in
+        the room they were in.
+        """
+        location = player.game.curr_location
+        with self.locked(location):
+            for item_name, item in list(player.game.inventory.items()):
+                location.add_item(item_name, item)
+            player.game.inventory.clear()
+            self.present[location.name].discard(player)
+            self.players.pop(player.name, None)
+            self.publish(location, {"type": "leave", "player": player.name, "location": location.name})
+
+    def destination(self, player, command):
+        """
+        The location a direction command would take player to, matched like
+        Parser.go_in_direction does, or None.
+        """
+        direction = player.parser.get_direction(command)
+        if not direction:
+            return None
+        connections = player.game.curr_location.connections
+        for connection in connections:
+            if direction in connection:
+                direction = connection
+        return connections.get(direction)
+
+    def run(self, player, command):
+        """
+        Parse a command of player, holding the locks of the locations it
+        touches, and tell the players in those locations what happened.
+        Returns what Parser.parse_command returns. The commands of one
+        player must be run one at a time.
+        """
+        location = player.game.curr_location
+        with self.locked(location):
+            # corrected with the room locked, since correcting reads the
+            # room's items while other players take and drop them
+            command, intent = player.parser.correct_command(command)
+            destination = self.destination(player, command) if intent == "direction" else None
+            if destination is None:
+                return self.apply(player, location, command, intent)
+        # a move also locks where it leads, both taken in order; the
+        # corrected command is parsed again, so a room changed meanwhile is
+        # seen as it is now
+        with self.locked(location, destination):
+            return self.apply(player, location, command, intent)
+
+    def apply(self, player, location, command, intent):
+        """
+        Parse command, with the locks of location and of where it leads
+        held, and publish what it changed.
+        """
+        inventory = set(player.game.inventory)
+        narration, characters, items = player.parser.parse_command(command)
+
+        arrived = player.game.curr_location
+        if arrived is not location:
+            self.present[location.name].discard(player)
+            self.publish(location, {"type": "leave", "player": player.name, "location": location.name})
+            self.publish(arrived, {"type": "enter", "player": player.name, "location": arrived.name})
+            self.present[arrived.name].add(player)
+        for item_name in set(player.game.inventory) - inventory:
+            self.publish(location, {"type": "take", "player": player.name, "item": item_name}, player)
+        for item_name in inventory - set(player.game.inventory):
+            self.publish(location, {"type": "drop", "player": player.name, "item": item_name}, player)
+
+        if intent in ("direction", "redescribe"):
+            others = self.others_here(player)
+            if others:
+                narration += "\n" + ", ".join(others) + (" is" if len(others) == 1 else " are") + " here."
+        return narration, characters, items
+
+
+def build_shared_world(assets=None, lock_mode="location", **filenames):
+    """
+    A SharedWorld of the world build_game loads from filenames, where
+    players join at build_game's start location.
+    """
+    game = build_game(assets=assets, **filenames)
+    return SharedWorld(game.curr_location, assets, lock_mode)
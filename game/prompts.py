@@ -0,0 +1,94 @@
+from .lore import lore_snippet, split_sentences
+
+
+# Speaker prefix of the player's turns in the Conversation section
+PLAYER_STR = "Player:"
+
+
+class DialogueOverloaded(Exception):
+    """
+    Raised by the ModelRouter when max_queue_depth requests are already
+    in flight, instead of queueing without limit.
+    """
+    pass
+
+
+def npc_str(name):
+    """
+    Speaker prefix of a character's turns in the Conversation section.
+    """
+    return name + ":"
+
+
+def render_character(character):
+    """
+    Render one entry of the Characters section. The appearance line is left
+    out for characters without an appearance, such as movie characters.
+    """
+    text = "* " + character["name"] + ":\n- persona: " + character["persona"] + "\n"
+    if character.get("appearance") is not None:
+        text += "- appearance: " + character["appearance"] + "\n"
+    return text
+
+
+def render_prompt(setting, npc, player):
+    """
+    Render the prompt that precedes a conversation: the Setting bullets,
+    the NPC and the player. The fine-tuned model was trained on this
+    format, so everything that builds prompts or training data goes
+    through here.
+    """
+    return "Setting:\n" + "".join("* " + bullet + "\n" for bullet in setting) + "\n" \
+             + "Characters:\n" + render_character(npc) + render_character(player) \
+             + "\n\n===\n\nConversation:\n"
+
+
+def anchor_sentences(character):
+    """
+    Returns the first sentence of the location description, persona and
+    appearance of a character, the part of its prompt that is always kept.
+    """
+    anchors = {}
+    for field in ["location_description", "persona", "appearance"]:
+        sentences = split_sentences(character[field])
+        anchors[field] = sentences[0] if sentences else ""
+    return anchors
+
+
+def retrieve_lore(lore_index, tokenizer, character, input_str, k=4, token_budget=96):
+    """
+    Returns the lore snippets most relevant to a message, leaving out the
+    anchor sentences that are already part of the prompt. Tokens are
+    counted with tokenizer.count_tokens when it has one.
+    """
+    anchors = anchor_sentences(character)
+    exclude = {
+        lore_snippet(character["location"], anchors["location_description"]),
+        lore_snippet(character["name"], anchors["persona"]),
+        lore_snippet(character["name"], anchors["appearance"])
+    }
+    return lore_index.retrieve(
+        character["name"] + " " + input_str,
+        k=k,
+        token_budget=token_budget,
+        count_tokens=getattr(tokenizer, "count_tokens", None) or (lambda text: len(tokenizer.encode(text))),
+        exclude=exclude
+    )
+
+
+def build_prompt(player, character, lore=None):
+    """
+    Render the Setting and Characters sections of the prompt. Without lore
+    the full location description, persona and appearance are used; with
+    lore only their first sentences are kept and the retrieved snippets
+    are added to the Setting.
+    """
+    location_description = character["location_description"]
+    npc = {"name": character["name"], "persona": character["persona"], "appearance": character["appearance"]}
+    if lore is not None:
+        anchors = anchor_sentences(character)
+        location_description = anchors["location_description"]
+        npc["persona"] = anchors["persona"]
+        npc["appearance"] = anchors["appearance"]
+    setting = [character["location"] + ": " + location_description] + list(lore or [])
+    return render_prompt(setting, npc, {"name": "Player", "persona": player["persona"], "appearance": player["appearance"]})
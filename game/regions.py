@@ -0,0 +1,379 @@
+"""
+Region-sharded worlds.
+
+shard_world splits the locations, characters and items JSON files into
+regions of neighbouring locations, each its own file, plus a small index
+(world.json) of where every location lives. build_sharded_game starts a
+game from the index alone and pages regions in as the player enters or
+approaches them, keeping at most max_resident_locations locations in
+memory and evicting the least recently used regions beyond that.
+
+Locations are identified by a stable ID derived from their name, and
+connections refer to IDs, so a connection into a region that is not loaded
+is only resolved when the player follows it. Regions the player changed
+(e.g. by taking or dropping an item) are written to an overlay file when
+they are evicted, so paging a region back in restores it as the player left
+it while memory stays bounded however much of the world they changed.
+
+    python -m game.regions game/static/game/data data/worlds/harry_potter
+"""
+import os
+import json
+import hashlib
+import argparse
+import tempfile
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+
+from .game import Game, Item, Location
+
+
+INDEX_FILE = "world.json"
+REGIONS_DIR = "regions"
+
+
+def location_id(name):
+    """
+    Stable ID of a location, the same whatever else changes in the world.
+    """
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()[:12]
+
+
+def assign_regions(location_data, region_size):
+    """
+    Group locations into regions of region_size locations by breadth-first
+    search, so connected locations tend to share a region. A search that
+    runs out of unassigned neighbours carries on from the next unassigned
+    location, so that hubs do not leave behind many tiny regions.
+    Returns a dictionary mapping each location name to its region number.
+    """
+    regions = {}
+    region = 0
+    size = 0
+    for seed in location_data:
+        queue = deque([seed])
+        while queue:
+            name = queue.popleft()
+            if name in regions:
+                continue
+            if size == region_size:
+                region += 1
+                size = 0
+                queue.clear()
+            regions[name] = region
+            size += 1
+            queue.extend(other for other in location_data[name]["connections"] if other not in regions)
+    return regions
+
+
+def shard_world(
+    locations_filename,
+    characters_filename,
+    items_filename,
+    output_dir,
+    region_size=256,
+    start_index=5
+):
+    """
+    Write a world in the sharded format: output_dir/world.json and one
+    output_dir/regions/<region>.json per region. The player starts at the
+    location start_index of locations_filename, like in build_game.
+    """
+    location_data = json.load(open(locations_filename, 'r'))
+    characters_data = json.load(open(characters_filename, 'r'))
+    items_data = json.load(open(items_filename, 'r'))
+    regions = assign_regions(location_data, region_size)
+
+    shards = {}
+    for name, data in location_data.items():
+        shard = shards.setdefault(regions[name], {"locations": {}, "items": {}})
+        shard["locations"][location_id(name)] = {
+            "name": name,
+            "description": data["description"],
+            "appearance": data.get("appearance"),
+            # directions are the lowercased names of the connected
+            # locations, as add_connection stores them
+            "connections": {other.lower(): location_id(other) for other in data["connections"]}
+        }
+    for name, data in characters_data.items():
+        shards[regions[data["location"]]]["items"][name] = {
+            "description": data["description"],
+            "examine_text": data["appearance"],
+            "location": location_id(data["location"]),
+            "character": True,
+            "gettable": True
+        }
+    for name, data in items_data.items():
+        shards[regions[data["location"]]]["items"][name] = {
+            "description": data["description"],
+            "examine_text": data["description"],
+            "location": location_id(data["location"]),
+            "character": False,
+            "gettable": True
+        }
+
+    os.makedirs(os.path.join(output_dir, REGIONS_DIR), exist_ok=True)
+    index = {"version": 1, "start": location_id(list(location_data)[start_index]), "regions": {}, "locations": {}}
+    for region, shard in sorted(shards.items()):
+        region_name = "r%05d" % region
+        filename = os.path.join(REGIONS_DIR, region_name + ".json")
+        with open(os.path.join(output_dir, filename), 'w') as outfile:
+            json.dump(shard, outfile)
+        index["regions"][region_name] = {"file": filename, "locations": len(shard["locations"])}
+        for identifier, data in shard["locations"].items():
+            index["locations"][identifier] = [region_name, data["name"]]
+    with open(os.path.join(output_dir, INDEX_FILE), 'w') as outfile:
+        json.dump(index, outfile)
+    print("%d locations in %d regions written to %s" % (len(location_data), len(shards), output_dir))
+
+
+class LazyConnections(MutableMapping):
+    """
+    The connections of a location, a dictionary from direction to location
+    like Location.connections, holding location IDs and loading the region
+    of a connected location only when it is looked up.
+    """
+    def __init__(self, world, connections):
+        self.world = world
+        self.targets = dict(connections)
+
+    def __getitem__(self, direction):
+        target = self.targets[direction]
+        return self.world.location(target) if isinstance(target, str) else target
+
+    def __setitem__(self, direction, location):
+        self.targets[direction] = location.id if isinstance(location, RegionLocation) else location
+
+    def __delitem__(self, direction):
+        del self.targets[direction]
+
+    def __iter__(self):
+        return iter(self.targets)
+
+    def __len__(self):
+        return len(self.targets)
+
+
+class RegionLocation(Location):
+    """
+    A location of a sharded world, which marks its region as changed when
+    items come or go or the player first visits it.
+    """
+    def __init__(self, world, identifier, region, name, description):
+        self.world = world
+        self.id = identifier
+        self.region = region
+        self.visited = False
+        super().__init__(name, description)
+
+    @property
+    def has_been_visited(self):
+        return self.visited
+
+    @has_been_visited.setter
+    def has_been_visited(self, visited):
+        if visited and not self.visited:
+            self.world.dirty.add(self.region)
+        self.visited = visited
+
+    def add_item(self, name, item):
+        super().add_item(name, item)
+        self.world.dirty.add(self.region)
+
+    def remove_item(self, item):
+        super().remove_item(item)
+        self.world.dirty.add(self.region)
+
+
+class ShardedWorld:
+    """
+    The regions of a sharded world currently in memory, in least recently
+    used order. The overlays of changed regions are written to overlay_dir,
+    by default a temporary directory removed with the world.
+    """
+    def __init__(self, world_dir, max_resident_locations=10000, prefetch=8, overlay_dir=None):
+        self.world_dir = world_dir
+        self.index = json.load(open(os.path.join(world_dir, INDEX_FILE), 'r'))
+        self.max_resident_locations = max_resident_locations
+        # at most this many regions are paged in ahead of the player per move
+        self.prefetch = prefetch
+        self.resident_locations = 0
+        # Dictionary mapping from region name to its locations, by ID
+        self.regions = OrderedDict()
+        if overlay_dir is None:
+            self.overlay_tempdir = tempfile.TemporaryDirectory(prefix="overlay-")
+            overlay_dir = self.overlay_tempdir.name
+        else:
+            os.makedirs(overlay_dir, exist_ok=True)
+        self.overlay_dir = overlay_dir
+        # Regions the player changed and that were evicted, whose items and
+        # visited locations are in overlay_dir, applied over their files
+        # when they are loaded again
+        self.overlay = set()
+        self.dirty = set()
+        self.pinned = set()
+        self.loads = 0
+        self.evictions = 0
+
+    def region_of(self, identifier):
+        return self.index["locations"][identifier][0]
+
+    def load_region(self, region):
+        if region in self.regions:
+            self.regions.move_to_end(region)
+            return self.regions[region]
+
+        shard = json.load(open(os.path.join(self.world_dir, self.index["regions"][region]["file"]), 'r'))
+        if region in self.overlay:
+            shard.update(json.load(open(self.overlay_path(region), 'r')))
+        locations = {}
+        for identifier, data in shard["locations"].items():
+            location = RegionLocation(self, identifier, region, data["name"], data["description"])
+            location.appearance = data.get("appearance")
+            location.connections = LazyConnections(self, data["connections"])
+            location.travel_descriptions = {direction: "" for direction in data["connections"]}
+            location.has_been_visited = identifier in shard.get("visited", ())
+            locations[identifier] = location
+        for name, data in shard["items"].items():
+            Item(
+                name, data["description"], data["examine_text"], start_at=locations[data["location"]],
+                gettable=data["gettable"], character=data["character"]
+            )
+        # placing the items is not a change of the player's
+        self.dirty.discard(region)
+        self.regions[region] = locations
+        self.resident_locations += len(locations)
+        self.loads += 1
+        self.evict()
+        return locations
+
+    def serialize_region(self, region):
+        """
+        What the player can change in a region: its items and the
+        locations they have visited.
+        """
+        items = {}
+        visited = []
+        for identifier, location in self.regions[region].items():
+            if location.has_been_visited:
+                visited.append(identifier)
+            for name, item in location.items.items():
+                items[name] = {
+                    "description": item.description,
+                    "examine_text": item.examine_text,
+                    "location": identifier,
+                    "character": item.properties["character"],
+                    "gettable": item.properties["gettable"]
+                }
+        return {"items": items, "visited": visited}
+
+    def overlay_path(self, region):
+        return os.path.join(self.overlay_dir, region + ".json")
+
+    def evict(self):
+        """
+        Drop least recently used regions while more than
+        max_resident_locations locations are loaded, keeping pinned ones
+        and writing changed ones to the overlay.
+        """
+        # the region loaded last is the one being asked for
+        for region in list(self.regions)[:-1]:
+            if self.resident_locations <= self.max_resident_locations:
+                break
+            if region in self.pinned:
+                continue
+            if region in self.dirty:
+                with open(self.overlay_path(region), 'w') as outfile:
+                    json.dump(self.serialize_region(region), outfile)
+                self.overlay.add(region)
+                self.dirty.discard(region)
+            self.resident_locations -= len(self.regions.pop(region))
+            self.evictions += 1
+
+    def location(self, identifier):
+        return self.load_region(self.region_of(identifier))[identifier]
+
+    def enter(self, location):
+        """
+        Page in the regions of the locations the player can go to next, as
+        long as they fit under max_resident_locations without evicting
+        anything, and pin them and the region the player is in until the
+        next move. Prefetching never evicts, so a hub next to every region
+        cannot make each visit replace the regions loaded by the last one.
+        """
+        self.pinned = {location.region}
+        self.load_region(location.region)
+        loaded = 0
+        for target in location.connections.targets.values():
+            if loaded == self.prefetch:
+                break
+            identifier = target.id if isinstance(target, RegionLocation) else target
+            region = self.region_of(identifier)
+            if region in self.regions:
+                continue
+            if self.resident_locations + self.index["regions"][region]["locations"] > self.max_resident_locations:
+                continue
+            self.pinned.add(region)
+            self.load_region(region)
+            loaded += 1
+        self.regions.move_to_end(location.region)
+        # regions pinned for the last move may be over the cap now
+        self.evict()
+
+    def stats(self):
+        return {
+            "regions": len(self.index["regions"]),
+            "resident_regions": len(self.regions),
+            "resident_locations": self.resident_locations,
+            "overlay_regions": len(self.overlay),
+            "loads": self.loads,
+            "evictions": self.evictions
+        }
+
+
+class ShardedGame(Game):
+    """
+    A Game over a ShardedWorld, which tells the world whenever the player
+    moves so it can page regions in and out.
+    """
+    def __init__(self, world, start_at, assets=None):
+        self.world = world
+        super().__init__(start_at, assets)
+
+    @property
+    def curr_location(self):
+        return self._curr_location
+
+    @curr_location.setter
+    def curr_location(self, location):
+        self._curr_location = location
+        self.world.enter(location)
+
+
+def build_sharded_game(world_dir, max_resident_locations=10000, start=None, assets=None, prefetch=8, overlay_dir=None):
+    """
+    Start a game on a world written by shard_world. Only the index is read
+    up front; start is a location name overriding the index's start.
+    """
+    world = ShardedWorld(world_dir, max_resident_locations, prefetch, overlay_dir)
+    start_id = location_id(start) if start is not None else world.index["start"]
+    return ShardedGame(world, world.location(start_id), assets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a world into separately loadable regions.")
+    parser.add_argument("data_dir", help="directory with locations.json, characters.json and items.json")
+    parser.add_argument("output", help="directory for the sharded world")
+    parser.add_argument("--region-size", type=int, default=256, help="locations per region")
+    args = parser.parse_args()
+    shard_world(
+        os.path.join(args.data_dir, "locations.json"),
+        os.path.join(args.data_dir, "characters.json"),
+        os.path.join(args.data_dir, "items.json"),
+        args.output,
+        region_size=args.region_size
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Dialogue without a model.
+
+A response index holds, for every character, questions a player might ask
+and a pool of answers the dialogue model gave to each, generated offline by
+dialogue_systems/build_response_index.py. A ResponseRouter answers a
+message with an answer to the most similar question of the character,
+found by a dot product of hashed bag-of-words vectors, so serving needs
+neither torch nor transformers nor a model in memory: an answer takes
+microseconds and the index a few MB.
+
+The index is a single .npz of plain arrays:
+
+    characters         JSON list of character names, sorted
+    offsets            int32, the questions of character i are rows offsets[i]:offsets[i + 1]
+    vectors            float16 (questions, dimensions), L2-normalized question vectors
+    idf                float32 (dimensions,), inverse document frequency of each hash bucket
+    pools              int32 (questions, pool size), response ids, -1 where the pool is shorter
+    response_text      uint8, the UTF-8 responses one after another
+    response_offsets   int64, response i is response_text[response_offsets[i]:response_offsets[i + 1]]
+"""
+import re
+import json
+import zlib
+import threading
+from collections import Counter
+
+import numpy as np
+
+
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+DIMENSIONS = 1024
+# Responses of a conversation that are not repeated while the pool has others
+RECENT_RESPONSES = 8
+
+
+def features(text):
+    """
+    The words and word pairs of text, lowercased.
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    return words + [first + " " + second for first, second in zip(words, words[1:])]
+
+
+def hash_features(text, dimensions=DIMENSIONS):
+    """
+    Hash buckets and signs of the features of text. crc32 is used instead
+    of hash() so that the buckets are the same in every process.
+    """
+    buckets = []
+    signs = []
+    for feature in features(text):
+        value = zlib.crc32(feature.encode("utf-8"))
+        buckets.append(value % dimensions)
+        signs.append(1.0 if value & 0x80000000 else -1.0)
+    return np.array(buckets, dtype=np.int64), np.array(signs, dtype=np.float32)
+
+
+def embed(text, idf):
+    """
+    L2-normalized TF-IDF vector of text in the hashed feature space.
+    """
+    buckets, signs = hash_features(text, len(idf))
+    vector = np.zeros(len(idf), dtype=np.float32)
+    np.add.at(vector, buckets, signs * idf[buckets])
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def save_response_index(filename, entries, dimensions=DIMENSIONS):
+    """
+    Write the index of entries, a list of (character name, question,
+    responses) tuples.
+    """
+    entries = sorted(entries, key=lambda entry: entry[0])
+    counts = Counter(entry[0] for entry in entries)
+    characters = sorted(counts)
+    offsets = np.cumsum([0] + [counts[name] for name in characters]).astype(np.int32)
+
+    document_frequency = np.zeros(dimensions, dtype=np.float64)
+    for _, question, _ in entries:
+        document_frequency[np.unique(hash_features(question, dimensions)[0])] += 1
+    idf = (np.log((1 + len(entries)) / (1 + document_frequency)) + 1).astype(np.float32)
+    vectors = np.stack([embed(question, idf) for _, question, _ in entries]).astype(np.float16)
+
+    # Dictionary mapping from response to its id, so repeated answers are stored once
+    response_ids = {}
+    pool_size = max(len(responses) for _, _, responses in entries)
+    pools = np.full((len(entries), pool_size), -1, dtype=np.int32)
+    for row, (_, _, responses) in enumerate(entries):
+        for column, response in enumerate(responses):
+            pools[row, column] = response_ids.setdefault(response, len(response_ids))
+    encoded = [response.encode("utf-8") for response in response_ids]
+    response_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=response_offsets[1:])
+
+    np.savez_compressed(
+        filename,
+        characters=np.array(json.dumps(characters)),
+        offsets=offsets,
+        vectors=vectors,
+        idf=idf,
+        pools=pools,
+        response_text=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        response_offsets=response_offsets
+    )
+
+
+class ResponseIndex:
+    """
+    A response index loaded from a file written by save_response_index.
+    """
+    def __init__(self, filename):
+        with np.load(filename, allow_pickle=False) as data:
+            characters = json.loads(str(data["characters"]))
+            offsets = data["offsets"]
+            # Dictionary mapping from character name to its rows
+            self.rows = {name: (int(offsets[i]), int(offsets[i + 1])) for i, name in enumerate(characters)}
+            # the matrix products run in float32, fast and exact enough
+            self.vectors = data["vectors"].astype(np.float32)
+            self.idf = data["idf"]
+            self.pools = data["pools"]
+            self.response_text = data["response_text"].tobytes()
+            self.response_offsets = data["response_offsets"]
+
+    def response(self, response_id):
+        start, end = self.response_offsets[response_id], self.response_offsets[response_id + 1]
+        return self.response_text[start:end].decode("utf-8")
+
+    def answer(self, character_name, message, recent=()):
+        """
+        Id of the answer of character_name to message, preferring answers
+        not in recent, or None when the character is not in the index.
+        """
+        rows = self.rows.get(character_name)
+        if rows is None:
+            return None
+        start, end = rows
+        scores = self.vectors[start:end] @ embed(message, self.idf)
+        pool = self.pools[start + int(np.argmax(scores))]
+        pool = pool[pool >= 0]
+        for response_id in pool:
+            if response_id not in recent:
+                return int(response_id)
+        # every answer was given lately: repeat the least recent one
+        positions = {response_id: position for position, response_id in enumerate(recent)}
+        return int(min(pool, key=lambda response_id: positions[response_id]))
+
+
+def history_to_array(chat_history_ids):
+    """
+    A conversation is the ids of the responses given in it.
+    """
+    return np.asarray(chat_history_ids, dtype=np.int64)
+
+
+def array_to_history(token_ids):
+    return np.asarray(token_ids, dtype=np.int64)
+
+
+class ResponseRouter:
+    """
+    Answers messages from a ResponseIndex, with the get_dialogue interface
+    of ModelRouter. The chat history of a conversation is the array of the
+    response ids given in it, which keeps a character from repeating itself.
+    """
+    # no tokenizer: prompts and lore are not used
+    tokenizer = None
+
+    def __init__(self, index, name="response-index"):
+        self.index = index
+        self.name = name
+        self.queue_depth = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.counters = {name: {"routed": 0, "capped": 0, "completed": 0, "errors": 0}}
+
+    def get_dialogue(self, player, character, input_str, chat_history_ids, lore=None, on_text=None):
+        with self.lock:
+            self.queue_depth += 1
+            self.counters[self.name]["routed"] += 1
+        try:
+            history = [int(response_id) for response_id in chat_history_ids]
+            response_id = self.index.answer(character["name"], input_str, history[-RECENT_RESPONSES:])
+            if response_id is None:
+                response = "..."
+            else:
+                response = self.index.response(response_id)
+                history.append(response_id)
+            if on_text is not None:
+                on_text(response)
+        finally:
+            with self.lock:
+                self.queue_depth -= 1
+                self.counters[self.name]["completed"] += 1
+        return np.array(history, dtype=np.int64), response
+
+
+def load_response_router(filename):
+    return ResponseRouter(ResponseIndex(filename))
@@ -0,0 +1,139 @@
+"""
+The game over a websocket, as a plain ASGI application.
+
+Every connection is a coroutine, so a process holds any number of idle
+players without a thread each. Commands run inline on the event loop (the
+engine answers in microseconds), while dialogue generation runs on a
+thread pool sized like the router's queue, and the NPC's answer is pushed
+back token by token as it is generated. Messages are JSON objects:
+
+    client: {"type": "command", "command": "go north"}
+            {"type": "message", "characterId": 1, "message": "Hello"}
+    server: {"type": "state", "narration": ..., "location": ..., "location_img": ..., "characters": [...], "items": [...]}
+            {"type": "token", "characterId": 1, "text": "Hel"}
+            {"type": "reply", "characterId": 1, "text": "Hello there."}
+            {"type": "error", "message": ...}
+            {"type": "error", "characterId": 1, "message": ...}   when an answer failed
+"""
+import json
+import asyncio
+import logging
+from http.cookies import SimpleCookie
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from django.conf import settings
+
+from . import views
+from .metrics import Callback
+
+
+logger = logging.getLogger(__name__)
+dialogue_executor = ThreadPoolExecutor(settings.DIALOGUE_MAX_QUEUE_DEPTH, thread_name_prefix="dialogue")
+open_sockets = 0
+
+Callback("game_open_websockets", "Open game websocket connections.", lambda: open_sockets)
+
+
+def get_session_key(scope):
+    """
+    The Django session key from the connection's cookies, or a key of the
+    connection's own when there is no session yet.
+    """
+    for name, value in scope.get("headers", []):
+        if name == b"cookie":
+            cookie = SimpleCookie(value.decode("latin-1"))
+            if settings.SESSION_COOKIE_NAME in cookie:
+                return cookie[settings.SESSION_COOKIE_NAME].value
+    return "websocket-" + uuid4().hex
+
+
+def state_message():
+    state = views.game_state()
+    return {
+        "type": "state",
+        "narration": state["narration"],
+        "location": state["location"],
+        "location_img": state["location_img"],
+        "characters": [character["name"] for character in state["characters"]],
+        "items": state["items"]
+    }
+
+
+async def write_messages(outbox, send):
+    """
+    Send the messages put in outbox in order, so generation threads and the
+    receive loop never write to the socket at the same time.
+    """
+    while True:
+        message = await outbox.get()
+        await send({"type": "websocket.send", "text": json.dumps(message)})
+
+
+async def answer(outbox, session_key, character_id, character, message):
+    loop = asyncio.get_running_loop()
+
+    def on_text(text):
+        # called from the generation thread
+        loop.call_soon_threadsafe(outbox.put_nowait, {"type": "token", "characterId": character_id, "text": text})
+
+    try:
+        response = await loop.run_in_executor(dialogue_executor, views.reply, session_key, character, message, on_text)
+    except Exception as error:
+        # the client is waiting for the answer, so it is told about the failure
+        logger.exception("dialogue with %s failed", character["name"])
+        outbox.put_nowait({"type": "error", "characterId": character_id, "message": str(error) or type(error).__name__})
+        return
+    outbox.put_nowait({"type": "reply", "characterId": character_id, "text": response})
+
+
+async def game_socket(scope, receive, send):
+    global open_sockets
+    event = await receive()
+    if event["type"] != "websocket.connect":
+        return
+    await send({"type": "websocket.accept"})
+
+    loop = asyncio.get_running_loop()
+    session_key = get_session_key(scope)
+    outbox = asyncio.Queue()
+    writer = loop.create_task(write_messages(outbox, send))
+    # generations of this connection, kept referenced until they finish
+    tasks = set()
+    open_sockets += 1
+    try:
+        outbox.put_nowait(state_message())
+        while True:
+            event = await receive()
+            if event["type"] == "websocket.disconnect":
+                break
+            views.touch_session(session_key)
+            try:
+                data = json.loads(event.get("text") or event.get("bytes") or "{}")
+                if not isinstance(data, dict):
+                    raise ValueError("messages must be JSON objects")
+                if data.get("type") == "command":
+                    views.run_command(str(data["command"]))
+                    outbox.put_nowait(state_message())
+                elif data.get("type") == "message":
+                    views.rebase_world()
+                    character_id = int(data["characterId"])
+                    if not 1 <= character_id <= len(views.characters):
+                        raise ValueError("no character %d here" % character_id)
+                    # looked up now: a command run before the answer is
+                    # generated can change the characters in view
+                    character = views.characters[character_id - 1]
+                    task = loop.create_task(answer(outbox, session_key, character_id, character, str(data["message"])))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    raise ValueError("unknown message type %r" % data.get("type"))
+            except (ValueError, KeyError, TypeError) as error:
+                outbox.put_nowait({"type": "error", "message": str(error)})
+    finally:
+        open_sockets -= 1
+        # a generation already running on the executor still completes, but
+        # nothing is sent for it anymore
+        for task in tasks:
+            task.cancel()
+        writer.cancel()
@@ -0,0 +1,220 @@
+"""
+Telemetry log of commands and dialogue.
+
+The request path only puts an event (a dictionary) on a bounded queue,
+without waiting: when the queue is full the event is dropped and counted.
+A background thread takes the events off the queue in batches, serializes
+them and appends them to gzip-compressed JSON lines files, flushed after
+every batch so that everything written so far can be read while the log is
+still open. Files are rotated at max_file_bytes and only the newest
+max_files are kept, so the log takes a bounded amount of disk too.
+
+    python -m game.telemetry telemetry
+"""
+import os
+import sys
+import gzip
+import json
+import glob
+import time
+import queue
+import atexit
+import argparse
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+
+
+# Put on the queue by close() to stop the writer
+STOP = object()
+
+FILE_PATTERN = "events-*.jsonl.gz"
+
+
+class TelemetryLog:
+    """
+    Asynchronous, batched writer of telemetry events to directory.
+    """
+    def __init__(
+        self,
+        directory,
+        max_queue=10000,
+        batch_size=256,
+        flush_seconds=1.0,
+        max_file_bytes=16 * 1024 * 1024,
+        max_files=50
+    ):
+        self.directory = str(directory)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.queue = queue.Queue(maxsize=max_queue)
+        # file being written and the gzip stream on top of it
+        self.raw = None
+        self.file = None
+        self.sequence = 0
+        # counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.writer = threading.Thread(target=self.run, name="telemetry-writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def record(self, event_type, **fields):
+        """
+        Queue an event of event_type with fields (JSON serializable values
+        that are not changed afterwards). Never blocks.
+        """
+        fields["type"] = event_type
+        fields["time"] = time.time()
+        try:
+            self.queue.put_nowait(fields)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            event = self.queue.get()
+            if event is STOP:
+                break
+            batch = [event]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    event = self.queue.get_nowait()
+                except queue.Empty:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        event = self.queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                if event is STOP:
+                    stopping = True
+                    break
+                batch.append(event)
+            self.write(batch)
+        self.close_file()
+
+    def write(self, batch):
+        lines = "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in batch)
+        try:
+            if self.file is None:
+                self.open_file()
+            self.file.write(lines.encode("utf-8"))
+            # a sync flush ends the batch on a byte boundary readers can decode up to
+            self.file.flush()
+            self.written += len(batch)
+            self.batches += 1
+            if self.raw.tell() >= self.max_file_bytes:
+                self.close_file()
+        except OSError:
+            # a full or read-only disk costs the batch, not the writer
+            self.errors += 1
+            self.close_file()
+
+    def open_file(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.sequence += 1
+        name = "events-%s-%d-%06d.jsonl.gz" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid(), self.sequence)
+        self.raw = open(os.path.join(self.directory, name), "ab")
+        self.file = gzip.GzipFile(fileobj=self.raw, mode="ab")
+        for path in log_files(self.directory)[:-self.max_files]:
+            os.remove(path)
+
+    def close_file(self):
+        try:
+            if self.file is not None:
+                self.file.close()
+            if self.raw is not None:
+                self.raw.close()
+        except OSError:
+            self.errors += 1
+        self.file = None
+        self.raw = None
+
+    def close(self):
+        """
+        Write out the queued events and stop the writer.
+        """
+        if self.writer.is_alive():
+            self.queue.put(STOP)
+            self.writer.join()
+
+
+def log_files(directory):
+    """
+    The log files in directory, oldest first.
+    """
+    return sorted(glob.glob(os.path.join(str(directory), FILE_PATTERN)), key=lambda path: (os.path.getmtime(path), path))
+
+
+def read_events(directory):
+    """
+    Every event in the log files of directory, oldest first. The file still
+    being written is read up to its last flushed batch.
+    """
+    for path in log_files(directory):
+        with gzip.open(path, "rt", encoding="utf-8") as infile:
+            try:
+                for line in infile:
+                    if line.endswith("\n"):
+                        yield json.loads(line)
+            except (EOFError, gzip.BadGzipFile):
+                continue
+
+
+def summarize(events):
+    """
+    Event counts, command latency per intent, and the most visited
+    locations and most talked to characters.
+    """
+    types = Counter()
+    latencies = defaultdict(list)
+    locations = Counter()
+    characters = Counter()
+    for event in events:
+        types[event["type"]] += 1
+        if event["type"] == "command":
+            latencies[event.get("intent") or "unknown"].append(event["seconds"])
+            locations[event.get("location")] += 1
+        elif event["type"] == "dialogue":
+            latencies["dialogue"].append(event["seconds"])
+            characters[event.get("character")] += 1
+    return {
+        "events": dict(types),
+        "latency": {
+            name: {
+                "count": len(values),
+                "p50_s": float(np.percentile(values, 50)),
+                "p99_s": float(np.percentile(values, 99))
+            }
+            for name, values in sorted(latencies.items())
+        },
+        "locations": locations.most_common(10),
+        "characters": characters.most_common(10)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a telemetry log directory.")
+    parser.add_argument("directory")
+    args = parser.parse_args()
+    json.dump(summarize(read_events(args.directory)), sys.stdout, indent=4)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,459 @@
-from django.test import TestCase
+import io
+import os
+import copy
+import json
+import shutil
+import time
+import tempfile
+from contextlib import redirect_stdout
 
-# Create your tests here.
+import numpy as np
+import torch
+from django.test import SimpleTestCase
+
+from dialogue_extraction.dataset import MASK_FILE, META_FILE, OFFSETS_FILE, TOKENS_FILE, DialogueDataset
+from dialogue_systems.finetune import attention_mask, position_ids
+
+from .conversations import ConversationStore
+from .dialoGPT import ModelRouter, get_dialogue
+from .dialogue_stub import load_stub_models
+from .fuzzy import FuzzyIndex, edit_distance
+from .game import Game, Item, Location, Parser, build_world, load_world_data
+from .hot_reload import WorldWatcher, diff_worlds, is_empty, rebase_game
+from .lore import LoreIndex, build_lore_index, lore_snippet
+from .prompts import DialogueOverloaded
+from .regions import ShardedWorld, build_sharded_game, shard_world
+from .telemetry import TelemetryLog, log_files, read_events, summarize
+from .worlds import WORLD_DATA_FILES, WorldRegistry, WorldTemplate
+
+
+def stub_models(**latency):
+    """
+    Stub tokenizer and model answering at once, for tests.
+    """
+    return load_stub_models(**dict(dict(prefill_seconds=0, prefill_token_seconds=0, token_seconds=0, jitter=0), **latency))
+
+
+class ConversationStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.spill_dir.cleanup)
+
+    def store(self, **caps):
+        return ConversationStore(self.spill_dir.name, **caps)
+
+    def test_session_cap_spills_and_restores(self):
+        store = self.store(max_session_bytes=100)
+        store.put("a", "Hagrid", np.arange(40))
+        store.put("a", "Dobby", np.arange(40))
+        # 160 bytes of uint16 tokens, so the older conversation is spilled
+        self.assertEqual(store.stats()["bytes"], 80)
+        self.assertEqual(store.evictions, 1)
+        self.assertTrue(os.path.exists(store.spill_path("a", "Hagrid")))
+        np.testing.assert_array_equal(store.get("a", "Hagrid"), np.arange(40))
+        self.assertEqual(store.restores, 1)
+        self.assertFalse(os.path.exists(store.spill_path("a", "Hagrid")))
+
+    def test_global_cap_spills_least_recently_used_sessions(self):
+        store = self.store(max_session_bytes=1000, max_bytes=100)
+        store.put("a", "Hagrid", np.arange(40))
+        store.put("b", "Hagrid", np.arange(40))
+        self.assertEqual(store.stats()["resident_sessions"], 1)
+        self.assertEqual(store.stats()["sessions"], 2)
+        self.assertEqual(store.stats()["bytes"], 80)
+        np.testing.assert_array_equal(store.get("a", "Hagrid"), np.arange(40))
+
+    def test_unknown_conversation_is_a_miss(self):
+        store = self.store()
+        self.assertIsNone(store.get("a", "Hagrid"))
+        self.assertEqual(store.misses, 1)
+
+    def test_token_ids_must_fit_the_dtype(self):
+        with self.assertRaises(ValueError):
+            self.store().put("a", "Hagrid", [70000])
+
+    def test_expire_forgets_idle_sessions_in_memory_and_on_disk(self):
+        store = self.store(max_session_bytes=100, max_idle_seconds=60)
+        store.put("a", "Hagrid", np.arange(40))
+        store.put("a", "Dobby", np.arange(40))
+        store.put("b", "Hagrid", np.arange(10))
+        store.last_used["a"] = time.time() - 120
+        store.expire()
+        self.assertEqual(store.expirations, 1)
+        self.assertFalse(os.path.exists(store.session_dir("a")))
+        self.assertIsNone(store.get("a", "Hagrid"))
+        self.assertEqual(store.stats()["bytes"], 20)
+
+
+class LongConversationTests(SimpleTestCase):
+    def test_history_is_trimmed_to_the_model_positions(self):
+        tokenizer, model = stub_models()
+        player = {"persona": "I am an explorer.", "appearance": "I am wearing jeans."}
+        character = {
+            "name": "Hagrid",
+            "persona": "I keep the keys and grounds of Hogwarts.",
+            "appearance": "I am twice as tall as a normal man.",
+            "location": "Hagrid's Hut",
+            "location_description": "A wooden hut at the edge of the forest."
+        }
+        chat_history_ids = torch.zeros((1, 0), dtype=torch.long)
+        for _ in range(100):
+            chat_history_ids, response = get_dialogue(
+                tokenizer, model, player, character, "What lives in the forbidden forest?", chat_history_ids
+            )
+            self.assertTrue(response)
+        self.assertLess(chat_history_ids.shape[-1], model.config.n_positions)
+
+
+class FuzzyIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = FuzzyIndex((name, name) for name in ["Golden Snitch", "Invisibility Cloak", "Elder Wand", "Owl"])
+
+    def test_exact_names_match_whatever_the_case(self):
+        self.assertEqual(self.index.match("elder wand"), "Elder Wand")
+
+    def test_typos_within_the_allowed_edits_are_corrected(self):
+        self.assertEqual(self.index.match("golden sntich"), "Golden Snitch")
+        self.assertEqual(self.index.match("invisbility clok"), "Invisibility Cloak")
+        self.assertEqual(self.index.match("eldr wand"), "Elder Wand")
+
+    def test_short_words_allow_fewer_edits(self):
+        self.assertEqual(self.index.match("owk"), "Owl")
+        self.assertIsNone(self.index.match("ow"))
+        self.assertIsNone(self.index.match("broomstick"))
+
+    def test_removed_names_no_longer_match(self):
+        self.index.remove("Elder Wand")
+        self.assertIsNone(self.index.match("eldr wand"))
+        self.assertEqual(len(self.index), 3)
+
+    def test_edit_distance_counts_a_swap_as_one_edit(self):
+        self.assertEqual(edit_distance("wnad", "wand", 2), 1)
+        self.assertEqual(edit_distance("kitten", "sitting", 3), 3)
+        self.assertEqual(edit_distance("kitten", "sitting", 1), 2)
+
+
+class CommandCorrectionTests(SimpleTestCase):
+    def setUp(self):
+        hall = Location("Great Hall", "A hall.")
+        tower = Location("Gryffindor Tower", "A tower.")
+        hall.add_connection("gryffindor tower", tower)
+        Item("golden goblet", "A goblet.", start_at=hall)
+        Item("Hagrid", "A giant.", start_at=hall, character=True)
+        self.game = Game(hall)
+        self.parser = Parser(self.game)
+
+    def test_verbs_directions_and_items_are_corrected(self):
+        self.assertEqual(self.parser.correct_command("tkae golden goblet"), ("take golden goblet", "take"))
+        self.assertEqual(self.parser.correct_command("take goldne goblet"), ("take golden goblet", "take"))
+        self.assertEqual(self.parser.correct_command("go gryffindor towr"), ("go gryffindor tower", "direction"))
+        self.assertEqual(self.parser.correct_command("who is hagird"), ("who is hagrid", "character"))
+
+    def test_the_index_follows_items_taken_and_dropped(self):
+        self.parser.parse_command("take golden goblet")
+        self.assertIsNone(self.game.curr_location.item_index[0].match("golden goblet"))
+        self.assertEqual(self.parser.correct_command("drop goldne goblet"), ("drop golden goblet", "drop"))
+        self.parser.parse_command("drop golden goblet")
+        self.assertEqual(self.game.curr_location.item_index[0].match("goldne goblet"), "golden goblet")
+
+
+class ShardedWorldTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        data_dir = os.path.join(os.path.dirname(__file__), "static", "game", "data")
+        self.world_dir = os.path.join(directory.name, "world")
+        # one location per region, so every move pages regions in and out
+        with redirect_stdout(io.StringIO()):
+            shard_world(
+                os.path.join(data_dir, "locations.json"), os.path.join(data_dir, "characters.json"),
+                os.path.join(data_dir, "items.json"), self.world_dir, region_size=1
+            )
+        self.game = build_sharded_game(self.world_dir, max_resident_locations=1, prefetch=0)
+        self.parser = Parser(self.game)
+
+    def leave(self):
+        start = self.game.curr_location
+        self.parser.parse_command("go " + sorted(start.connections.targets)[0])
+        self.assertNotIn(start.region, self.game.world.regions)
+        return self.game.world.location(start.id)
+
+    def test_visited_locations_survive_eviction(self):
+        self.assertTrue(self.leave().has_been_visited)
+        self.assertEqual(self.game.world.stats()["overlay_regions"], 1)
+
+    def test_taken_items_stay_taken_after_eviction(self):
+        start = self.game.curr_location
+        item_name = next(name for name, item in start.items.items() if not item.properties["character"])
+        self.parser.parse_command("take " + item_name)
+        back = self.leave()
+        self.assertNotIn(item_name, back.items)
+        self.assertIn(item_name, self.game.inventory)
+
+    def test_unchanged_regions_are_not_written(self):
+        world = ShardedWorld(self.world_dir, max_resident_locations=1, prefetch=0)
+        for identifier in list(world.index["locations"])[:3]:
+            world.location(identifier)
+        self.assertEqual(world.stats()["evictions"], 2)
+        self.assertEqual(os.listdir(world.overlay_dir), [])
+
+
+class WorldTemplateTests(SimpleTestCase):
+    def test_lore_is_built_from_the_loaded_world_data(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "static", "game", "data")
+        template = WorldTemplate("harry_potter", {"data_dir": data_dir})
+        name = next(iter(template.world_data["items"]))
+        template.world_data["items"][name]["description"] = "It hums whenever a basilisk is near."
+        self.assertIn(lore_snippet(name, "It hums whenever a basilisk is near."), template.lore().retrieve("basilisk"))
+
+
+class HotReloadTests(SimpleTestCase):
+    def setUp(self):
+        self.data_dir = os.path.join(os.path.dirname(__file__), "static", "game", "data")
+        self.old_data = load_world_data(**{
+            key: os.path.join(self.data_dir, filename) for key, filename in WORLD_DATA_FILES.items()
+        })
+        self.new_data = copy.deepcopy(self.old_data)
+        self.game = build_world(self.old_data)
+        self.parser = Parser(self.game)
+
+    def a_thing_here(self):
+        return next(name for name, item in self.game.curr_location.items.items() if not item.properties["character"])
+
+    def test_diff_lists_what_changed(self):
+        items = self.new_data["items"]
+        removed, moved, changed = sorted(items)[:3]
+        del items[removed]
+        items[moved]["location"] = next(
+            name for name in self.new_data["locations"] if name != items[moved]["location"]
+        )
+        items[changed]["description"] = "Something else entirely."
+        diff = diff_worlds(self.old_data, self.new_data)
+        self.assertEqual(diff["items"]["removed"], [removed])
+        self.assertEqual(list(diff["items"]["moved"]), [moved])
+        self.assertEqual(diff["items"]["changed"], [changed])
+        self.assertTrue(is_empty(diff_worlds(self.old_data, copy.deepcopy(self.old_data))))
+
+    def test_rebase_keeps_the_player_and_what_they_carry(self):
+        item_name = self.a_thing_here()
+        self.parser.parse_command("take " + item_name)
+        self.new_data["locations"][self.game.curr_location.name]["description"] = "Rebuilt."
+        new_game = rebase_game(self.game, self.old_data, build_world(self.new_data), self.new_data)
+        self.assertEqual(new_game.curr_location.name, self.game.curr_location.name)
+        self.assertEqual(new_game.curr_location.description, "Rebuilt.")
+        self.assertIn(item_name, new_game.inventory)
+        self.assertNotIn(item_name, new_game.curr_location.items)
+
+    def test_rebase_drops_removed_things_from_the_inventory(self):
+        item_name = self.a_thing_here()
+        self.parser.parse_command("take " + item_name)
+        del self.new_data["items"][item_name]
+        new_game = rebase_game(self.game, self.old_data, build_world(self.new_data), self.new_data)
+        self.assertNotIn(item_name, new_game.inventory)
+
+    def test_watcher_keeps_the_old_world_when_the_data_is_malformed(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        world_dir = os.path.join(directory.name, "world")
+        shutil.copytree(self.data_dir, world_dir)
+        registry = WorldRegistry(directory.name)
+        old = registry.get("world")
+        watcher = WorldWatcher(registry, interval=3600)
+        self.addCleanup(watcher.stop)
+        locations = copy.deepcopy(self.old_data["locations"])
+        locations[next(iter(locations))]["connections"] = 5
+        with open(os.path.join(world_dir, "locations.json"), "w") as outfile:
+            json.dump(locations, outfile)
+        os.utime(os.path.join(world_dir, "locations.json"), ns=(0, 0))
+        with self.assertLogs("game.hot_reload", "ERROR"):
+            self.assertEqual(watcher.check(), [])
+        self.assertEqual(watcher.errors, 1)
+        self.assertIs(registry.get("world"), old)
+
+
+class TelemetryLogTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_recorded_events_are_summarized(self):
+        log = TelemetryLog(self.directory, flush_seconds=0.01)
+        log.record("command", command="go north", intent="direction", location="Hogwarts", seconds=0.002)
+        log.record("command", command="take wand", intent="take", location="Hogwarts", seconds=0.001)
+        log.record("dialogue", character="Hagrid", message="Hello", response="Hi", seconds=0.5)
+        log.close()
+        self.assertEqual(log.written, 3)
+        summary = summarize(read_events(self.directory))
+        self.assertEqual(summary["events"], {"command": 2, "dialogue": 1})
+        self.assertEqual(summary["latency"]["direction"]["count"], 1)
+        self.assertAlmostEqual(summary["latency"]["dialogue"]["p50_s"], 0.5)
+        self.assertEqual(summary["locations"], [("Hogwarts", 2)])
+        self.assertEqual(summary["characters"], [("Hagrid", 1)])
+
+    def test_files_are_rotated_and_the_oldest_removed(self):
+        log = TelemetryLog(self.directory, batch_size=1, flush_seconds=0, max_file_bytes=1, max_files=2)
+        for index in range(5):
+            log.record("command", command="look %d" % index, seconds=0.0)
+            # one batch, and so one file, per event
+            while log.written <= index:
+                time.sleep(0.001)
+        log.close()
+        self.assertEqual(len(log_files(self.directory)), 2)
+        self.assertEqual([event["command"] for event in read_events(self.directory)], ["look 3", "look 4"])
+
+
+class LoreIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = LoreIndex([
+            lore_snippet("Hagrid", "Hagrid keeps a three-headed dog called Fluffy."),
+            lore_snippet("Hagrid", "Hagrid lives in a hut by the forest."),
+            lore_snippet("Snitch", "The golden snitch is the smallest ball in quidditch."),
+            lore_snippet("Forest", "Centaurs and spiders live in the forbidden forest.")
+        ])
+
+    def test_search_ranks_the_most_similar_snippets_first(self):
+        self.assertEqual(self.index.search("what ball is used in quidditch", k=1), [2])
+        self.assertEqual(self.index.search("who lives in the forbidden forest", k=2), [3, 1])
+        self.assertEqual(self.index.search("broomstick"), [])
+
+    def test_retrieve_leaves_out_excluded_snippets(self):
+        excluded = self.index.snippets[3]
+        self.assertEqual(
+            self.index.retrieve("forbidden forest", k=1, exclude={excluded}),
+            [self.index.snippets[1]]
+        )
+
+    def test_retrieve_keeps_within_the_token_budget(self):
+        lore = self.index.retrieve("Hagrid dog hut forest", k=4, token_budget=12)
+        self.assertTrue(lore)
+        self.assertLessEqual(sum(len(snippet.split()) for snippet in lore), 12)
+        index = LoreIndex(self.index.snippets)
+        lore = index.retrieve("Hagrid dog hut forest", k=4, token_budget=12, count_tokens=lambda text: 100)
+        self.assertEqual(lore, [])
+
+    def test_world_lore_has_one_snippet_per_sentence(self):
+        index = build_lore_index({
+            "locations": {"Hut": {"description": "A small hut. It smells of smoke.", "appearance": "Wooden."}},
+            "characters": {},
+            "items": {"Kettle": {"description": "A copper kettle."}}
+        })
+        self.assertEqual(index.snippets, [
+            lore_snippet("Hut", "A small hut."), lore_snippet("Hut", "It smells of smoke."),
+            lore_snippet("Hut", "Wooden."), lore_snippet("Kettle", "A copper kettle.")
+        ])
+
+
+class ModelRouterTests(SimpleTestCase):
+    def setUp(self):
+        tokenizer, model = stub_models()
+        self.router = ModelRouter(
+            [("large", tokenizer, model), ("small", tokenizer, model)],
+            latency_budget=1.0, max_queue_depth=2, max_length=256, min_length=24, decay_seconds=30.0
+        )
+
+    def test_slow_model_is_skipped_for_the_next_one(self):
+        name, _, _, max_length, queue_depth = self.router.route()
+        self.assertEqual((name, max_length, queue_depth), ("large", 256, 1))
+        self.router.release(name, 2.0, 100, queue_depth)
+        name, _, _, max_length, queue_depth = self.router.route()
+        self.assertEqual((name, max_length), ("small", 256))
+        self.router.release(name, 0.5, 100, queue_depth)
+        self.assertEqual(self.router.queue_depth, 0)
+
+    def test_length_is_capped_when_no_model_fits(self):
+        for expected in ["large", "small"]:
+            name, _, _, _, queue_depth = self.router.route()
+            self.assertEqual(name, expected)
+            self.router.release(name, 2.0, 100, queue_depth)
+        name, _, _, max_length, queue_depth = self.router.route()
+        # 0.02 seconds per token fit 50 tokens in the budget
+        self.assertEqual(name, "small")
+        self.assertAlmostEqual(max_length, 50, delta=1)
+        self.assertEqual(self.router.counters["small"]["capped"], 1)
+        self.router.release(name, 2.0, 1, queue_depth)
+        # however slow, a capped answer still gets min_length
+        self.assertEqual(self.router.route()[3], 24)
+
+    def test_requests_beyond_the_queue_depth_are_rejected(self):
+        first, second = self.router.route(), self.router.route()
+        with self.assertRaises(DialogueOverloaded):
+            self.router.route()
+        self.assertEqual(self.router.rejected, 1)
+        self.router.release(first[0], 0.1, 10, first[4], failed=True)
+        self.assertEqual(self.router.counters[first[0]]["errors"], 1)
+        self.assertEqual(self.router.route()[0], "large")
+
+    def test_latency_decays_without_samples(self):
+        name, _, _, _, queue_depth = self.router.route()
+        self.router.release(name, 4.0, 100, queue_depth)
+        self.assertEqual(self.router.route()[0], "small")
+        self.router.release("small", 0.1, 100, 1)
+        # two half-lives later the large model fits the budget again
+        self.router.sampled_at["large"] -= 60.0
+        self.assertAlmostEqual(self.router.decayed("large", self.router.request_latency["large"]), 1.0, places=2)
+        self.assertEqual(self.router.route()[0], "large")
+
+
+def write_dataset(path, conversations, eos_token_id=0):
+    """
+    Write conversations (lists of token IDs, every token trained on) as
+    build_dataset would.
+    """
+    tokens = np.concatenate([np.array(conversation, dtype=np.uint16) for conversation in conversations])
+    tokens.tofile(os.path.join(path, TOKENS_FILE))
+    np.ones(len(tokens), dtype=np.uint8).tofile(os.path.join(path, MASK_FILE))
+    np.save(os.path.join(path, OFFSETS_FILE), np.cumsum([0] + [len(conversation) for conversation in conversations]))
+    json.dump({"eos_token_id": eos_token_id}, open(os.path.join(path, META_FILE), 'w'))
+    return DialogueDataset(path)
+
+
+class PackedDatasetTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_conversations_are_packed_with_an_end_token_each(self):
+        dataset = write_dataset(self.path, [[1, 2, 3], [4, 5], [6, 7, 8, 9]])
+        sequences = list(dataset.packed(8, np.random.default_rng(0), eos_token_id=99))
+        packed = []
+        for tokens, mask, segments in sequences:
+            self.assertEqual(len(tokens), 8)
+            self.assertEqual(segments[0], 1)
+            for segment in range(1, segments.max() + 1):
+                in_segment = tokens[segments == segment]
+                self.assertEqual(in_segment[-1], 99)
+                # the end token is not trained on
+                self.assertEqual(mask[segments == segment][-1], 0)
+                packed.append(in_segment[:-1].tolist())
+            # padding is the end token, in no segment, not trained on
+            self.assertTrue(np.all(tokens[segments == 0] == 99))
+            self.assertTrue(np.all(mask[segments == 0] == 0))
+            self.assertTrue(np.all(np.diff(segments[segments > 0]) >= 0))
+        self.assertEqual(sorted(packed), [[1, 2, 3], [4, 5], [6, 7, 8, 9]])
+
+    def test_long_conversations_are_split(self):
+        dataset = write_dataset(self.path, [list(range(1, 11))])
+        sequences = list(dataset.packed(4, np.random.default_rng(0)))
+        self.assertEqual([tokens[segments == 1][:-1].tolist() for tokens, _, segments in sequences], [
+            [1, 2, 3], [4, 5, 6], [7, 8, 9], [10]
+        ])
+
+
+class PackedTrainingTests(SimpleTestCase):
+    def test_positions_restart_at_every_conversation(self):
+        segments = np.array([1, 1, 1, 2, 2, 3, 0, 0])
+        self.assertEqual(position_ids(segments).tolist(), [0, 1, 2, 0, 1, 0, 0, 1])
+
+    def test_tokens_attend_only_to_earlier_tokens_of_their_conversation(self):
+        mask = attention_mask(np.array([[1, 1, 2, 2, 2]]))
+        self.assertEqual(mask.shape, (1, 1, 5, 5))
+        allowed = (mask[0, 0] == 0).int().tolist()
+        self.assertEqual(allowed, [
+            [1, 0, 0, 0, 0],
+            [1, 1, 0, 0, 0],
+            [0, 0, 1, 0, 0],
+            [0, 0, 1, 1, 0],
+            [0, 0, 1, 1, 1]
+        ])
+        self.assertTrue(torch.all(mask[mask != 0] == torch.finfo(torch.float32).min))
@@ -4,5 +4,6 @@ from . import views
 
 urlpatterns = [
     path('', views.ProfileFormView.as_view(), name="profile"),
-    path('game/', views.parse_command, name="game")
+    path('game/', views.parse_command, name="game"),
+    path('metrics/', views.metrics, name="metrics")
 ]
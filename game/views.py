@@ -1,25 +1,209 @@
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
 from django.shortcuts import render
+from django.templatetags.static import static
 from django.views.generic.edit import FormView
+from django.core.files.storage import default_storage
 from game.forms import ProfileForm
+from game.models import Profile, update_filename
 
 from .game import *
-from .dialoGPT import *
+from .avatars import AvatarWorker
+from .conversations import ConversationStore
+from .metrics import Callback, render_metrics, span
+from .prompts import DialogueOverloaded, retrieve_lore
+from .telemetry import TelemetryLog
+from .worlds import WorldRegistry
+from .fuzzy import FuzzyIndex
+from .hot_reload import WorldWatcher, diff_worlds, is_empty, rebase_game
 
 
-game = build_game()
-parser = Parser(game)
+telemetry = TelemetryLog(
+    settings.TELEMETRY_DIR,
+    max_queue=settings.TELEMETRY_QUEUE_SIZE,
+    max_file_bytes=settings.TELEMETRY_FILE_BYTES,
+    max_files=settings.TELEMETRY_MAX_FILES
+)
+worlds = WorldRegistry(
+    settings.WORLDS_DIR,
+    settings.WORLDS,
+    max_bytes=settings.WORLD_CACHE_BYTES,
+    idle_seconds=settings.WORLD_IDLE_SECONDS,
+    url=static
+)
+world_watcher = None
+if settings.WORLD_RELOAD_SECONDS:
+    world_watcher = WorldWatcher(
+        worlds, settings.WORLD_RELOAD_SECONDS,
+        on_reload=lambda reloaded_world_id, diff: telemetry.record("world_reload", world=reloaded_world_id, diff=diff)
+    )
+world_id = settings.DEFAULT_WORLD
+# template the game was built from, or last rebased onto
+game_template = worlds.get(world_id)
+game = game_template.new_game()
+lore_index = game_template.lore()
+parser = Parser(game, telemetry=telemetry)
 narration_history = game.describe()
 characters = game.get_current_characters()
 items = game.get_current_items()
-profile_path = "media/images/profile.png"
+DEFAULT_PROFILE_IMAGE = "images/profile.png"
+# Dictionary mapping from session key to the media path of the player's image
+profile_images = {}
 
 player = {
     "name": "Player",
     "persona": "I am an explorer from earth. I like to travel to different places and learn about strong but interesting things. I am always excited about exploring the unknown.",
     "appearance": "I am wearing jeans. The jeans are loose but strong. I am wearing windbreaker. The windbreaker is long, black and looks very cold. I am wearing a hat. I'm wearing a hat. The hat is brown and partly hides my face."
 }
-tokenizer, model = load_models()
-chat_history_ids_list = [tokenizer.encode("", return_tensors='pt').long().to(device) for _ in characters]
+if settings.DIALOGUE_BACKEND == "response_index":
+    # answers from the precomputed index, without importing torch
+    from .response_index import array_to_history, history_to_array, load_response_router
+    router = load_response_router(settings.DIALOGUE_RESPONSE_INDEX)
+    history_dtype = np.uint32
+else:
+    from .dialoGPT import array_to_history, history_to_array, load_router
+    router = load_router(
+        settings.DIALOGUE_MODELS,
+        latency_budget=settings.DIALOGUE_LATENCY_BUDGET,
+        max_queue_depth=settings.DIALOGUE_MAX_QUEUE_DEPTH,
+        stub=settings.DIALOGUE_STUB
+    )
+    history_dtype = np.uint16
+conversations = ConversationStore(
+    settings.CONVERSATION_SPILL_DIR,
+    max_session_bytes=settings.CONVERSATION_SESSION_BYTES,
+    max_bytes=settings.CONVERSATION_MAX_BYTES,
+    max_idle_seconds=settings.CONVERSATION_IDLE_SECONDS,
+    dtype=history_dtype
+)
+
+
+
+def avatar_ready(profile):
+    # unless the player uploaded another image in the meantime
+    if profile_images.get(profile.session_key) == profile.image.name:
+        profile_images[profile.session_key] = profile.avatar.name
+
+
+avatar_worker = AvatarWorker(on_ready=avatar_ready)
+
+# Dictionary mapping from session key to the time of its last request
+last_seen = {}
+# held by everything that reads or changes last_seen
+sessions_lock = threading.Lock()
+ACTIVE_SESSION_SECONDS = 15 * 60
+# idle sessions are forgotten every PRUNE_REQUESTS requests
+PRUNE_REQUESTS = 1000
+requests_seen = 0
+
+
+def get_session_key(request):
+    """
+    Returns the session key of the request, creating the session if needed.
+    """
+    if request.session.session_key is None:
+        request.session.save()
+    return request.session.session_key
+
+
+def profile_image(session_key):
+    """
+    Media path of the image of the player of the session: the avatar once
+    it is built, the uploaded image until then.
+    """
+    path = profile_images.get(session_key)
+    if path is None:
+        profile = Profile.objects.filter(session_key=session_key).exclude(image="").order_by("-pk").first()
+        if profile is not None and profile.image:
+            path = profile.avatar.name if profile.avatar else profile.image.name
+        else:
+            path = DEFAULT_PROFILE_IMAGE
+        profile_images[session_key] = path
+    return path
+
+
+def prune_sessions():
+    """
+    Forget the sessions without a request in the last ACTIVE_SESSION_SECONDS,
+    and the profile images of sessions no longer seen. profile_image looks
+    them up again if such a session comes back.
+    """
+    cutoff = time.time() - ACTIVE_SESSION_SECONDS
+    with sessions_lock:
+        for session_key, seen in list(last_seen.items()):
+            if seen < cutoff:
+                del last_seen[session_key]
+        for session_key in list(profile_images):
+            if session_key not in last_seen:
+                profile_images.pop(session_key, None)
+
+
+def touch_session(session_key):
+    """
+    Note a request of the session, pruning the idle ones (and their expired
+    conversations) now and then so that neither grows without bound.
+    """
+    global requests_seen
+    with sessions_lock:
+        last_seen[session_key] = time.time()
+        requests_seen += 1
+        prune = requests_seen % PRUNE_REQUESTS == 0
+    if prune:
+        prune_sessions()
+        conversations.expire()
+
+
+def count_active_sessions():
+    """
+    Number of sessions with a request in the last ACTIVE_SESSION_SECONDS.
+    """
+    cutoff = time.time() - ACTIVE_SESSION_SECONDS
+    with sessions_lock:
+        return sum(1 for seen in last_seen.values() if seen >= cutoff)
+
+
+Callback("game_active_sessions", "Sessions with a request in the last 15 minutes.", count_active_sessions)
+Callback("dialogue_queue_depth", "Dialogue generations in flight.", lambda: router.queue_depth)
+Callback("dialogue_rejected_total", "Messages rejected because the dialogue queue was full.",
+         lambda: router.rejected, kind="counter")
+Callback("dialogue_routed_total", "Messages routed to each dialogue model.",
+         lambda: {name: counters["routed"] for name, counters in router.counters.items()}, kind="counter", label="model")
+Callback("dialogue_capped_total", "Messages answered with a capped max_length by each dialogue model.",
+         lambda: {name: counters["capped"] for name, counters in router.counters.items()}, kind="counter", label="model")
+Callback("conversation_cache_hits_total", "Conversation histories found in memory.",
+         lambda: conversations.hits, kind="counter")
+Callback("conversation_cache_misses_total", "Conversations started without a history.",
+         lambda: conversations.misses, kind="counter")
+Callback("conversation_cache_restores_total", "Conversation histories loaded back from disk.",
+         lambda: conversations.restores, kind="counter")
+Callback("conversation_cache_evictions_total", "Conversation histories spilled to disk.",
+         lambda: conversations.evictions, kind="counter")
+Callback("conversation_cache_expirations_total", "Sessions whose conversations were forgotten after going idle.",
+         lambda: conversations.expirations, kind="counter")
+Callback("conversation_cache_sessions", "Sessions with conversations, in memory or on disk.",
+         lambda: conversations.stats()["sessions"])
+Callback("conversation_cache_bytes", "Bytes of conversation histories held in memory.",
+         lambda: conversations.stats()["bytes"])
+Callback("avatar_queue_depth", "Profile images waiting for their avatars.", lambda: avatar_worker.queue.qsize())
+Callback("avatars_built_total", "Profile images turned into avatars.", lambda: avatar_worker.built, kind="counter")
+Callback("avatars_failed_total", "Profile images that could not be read.", lambda: avatar_worker.failed, kind="counter")
+Callback("worlds_loaded", "World templates held in memory.", lambda: len(worlds.templates))
+Callback("world_loads_total", "World templates loaded from their data files.", lambda: worlds.loads, kind="counter")
+Callback("world_evictions_total", "World templates dropped from memory.", lambda: worlds.evictions, kind="counter")
+Callback("world_reloads_total", "World templates reloaded after their data files changed.",
+         lambda: worlds.reloads, kind="counter")
+Callback("telemetry_queue_depth", "Telemetry events waiting to be written.", lambda: telemetry.queue_depth)
+Callback("telemetry_events_written_total", "Telemetry events written to the log.",
+         lambda: telemetry.written, kind="counter")
+Callback("telemetry_events_dropped_total", "Telemetry events dropped because the queue was full.",
+         lambda: telemetry.dropped, kind="counter")
 
 
 class ProfileFormView(FormView):
@@ -28,50 +212,164 @@ class ProfileFormView(FormView):
     success_url = "/game"
 
     def form_valid(self, form):
-        global player, profile_path
+        global player
         player = {
             "name": "Player",
             "persona": form.data["persona"],
             "appearance": form.data["appearance"]
         }
-        instance = form.save()
-        try:
-            profile_path = instance.image.path
-        except:
-            pass
+        session_key = get_session_key(self.request)
+        instance = form.save(commit=False)
+        instance.session_key = session_key
+        if instance.image and not instance.image._committed:
+            # an image the player uploaded before is not stored again
+            name = update_filename(instance, instance.image.name)
+            if default_storage.exists(name):
+                instance.image = name
+        instance.save()
+        if instance.image:
+            profile_images[session_key] = instance.image.name
+            avatar_worker.submit(instance.pk)
         return super(ProfileFormView, self).form_valid(form)
 
 
+def start_world(new_world_id):
+    """
+    Start a new game of the world new_world_id, for every player. Raises
+    ValueError when there is no such world.
+    """
+    global world_id, game_template, game, lore_index, parser, narration_history, characters, items
+    template = worlds.get(new_world_id)
+    world_id = new_world_id
+    game_template = template
+    game = template.new_game()
+    lore_index = template.lore()
+    parser = Parser(game, telemetry=telemetry)
+    narration_history = game.describe()
+    characters = game.get_current_characters()
+    items = game.get_current_items()
+
+
+def rebase_world():
+    """
+    Carry the game over to the world's data if it was reloaded since the
+    game started, keeping the conversations of the characters in view.
+    """
+    global game_template, game, lore_index, characters, items
+    template = worlds.get(world_id)
+    if template is game_template:
+        return
+    if template.world_data is None or game_template.world_data is None:
+        # a sharded game reads the regions it pages in from the new files
+        # anyway, and its world is never all in memory to rebase
+        game_template = template
+        return
+    diff = diff_worlds(game_template.world_data, template.world_data)
+    if not is_empty(diff):
+        game = rebase_game(game, game_template.world_data, template.new_game(), template.world_data)
+        parser.game = game
+        parser.inventory_index = FuzzyIndex()
+        lore_index = template.lore()
+        dialogues = {character["name"]: character["dialogues"] for character in characters}
+        characters = game.get_current_characters()
+        for character in characters:
+            character["dialogues"] = dialogues.get(character["name"], [])
+        items = game.get_current_items()
+    game_template = template
+
+
+def run_command(command):
+    """
+    Run a player command through the parser and update the narration and
+    the characters and items in view.
+    """
+    global narration_history, characters, items
+    rebase_world()
+    with span("parse"):
+        narration, current_characters, current_items = parser.parse_command(command)
+    narration_history += narration + "\n"
+    if current_characters is not None:
+        items = current_items
+        characters = current_characters
+    if current_items is not None:
+        items = current_items
+
+
+def reply(session_key, character, message, on_text=None):
+    """
+    Answer a message to character, one of the characters of the current
+    location, in the conversation of the session, calling on_text with
+    every new piece of the answer as it is generated. Returns the answer.
+    """
+    rebase_world()
+    # the same character in the reloaded world, if it was reloaded meanwhile
+    character = next((current for current in characters if current["name"] == character["name"]), character)
+    character["dialogues"].append(message)
+    history = conversations.get(session_key, character["name"])
+    chat_history_ids = array_to_history(history if history is not None else [])
+    lore = None
+    if router.tokenizer is not None and lore_index is not None:
+        lore = retrieve_lore(
+            lore_index, router.tokenizer, character, message,
+            k=settings.LORE_TOP_K, token_budget=settings.LORE_TOKEN_BUDGET
+        )
+    start = time.perf_counter()
+    overloaded = False
+    try:
+        chat_history_ids, response = router.get_dialogue(
+            player, character, message, chat_history_ids, lore=lore, on_text=on_text
+        )
+        conversations.put(session_key, character["name"], history_to_array(chat_history_ids))
+    except DialogueOverloaded:
+        overloaded = True
+        response = character["name"] + " is busy talking to others. Try again in a moment."
+    response = response.strip("\n")
+    character["dialogues"].append(response)
+    telemetry.record(
+        "dialogue", session=hashlib.sha1(session_key.encode("utf-8")).hexdigest()[:16],
+        character=character["name"], location=parser.game.curr_location.name, message=message,
+        response=response, overloaded=overloaded, seconds=time.perf_counter() - start
+    )
+    return response
+
+
+def game_state():
+    """
+    Everything the game page shows.
+    """
+    return {
+        "narration": narration_history,
+        "location": parser.game.curr_location.name,
+        "location_img": parser.game.assets.image("locations", parser.game.curr_location.name_cleaned),
+        "characters": characters,
+        "items": items
+    }
+
+
 def parse_command(request):
-    global narration_history, characters, items, player, tokenizer, model, chat_history_ids_list
+    touch_session(get_session_key(request))
+    requested_world = request.GET.get("world")
+    if requested_world and requested_world != world_id:
+        # every player shares the one game, so not everyone may switch it
+        if not (settings.WORLD_SWITCHING or request.user.is_staff):
+            raise PermissionDenied("Only staff can switch the world everyone plays.")
+        try:
+            start_world(requested_world)
+        except ValueError:
+            raise Http404("There is no world %r." % requested_world)
+    rebase_world()
     if request.method == "POST": 
         if "command" in request.POST:
-            command = request.POST["command"]
-            narration, current_characters, current_items = parser.parse_command(command)
-            narration_history += narration + "\n"
-            if current_characters is not None:
-                items = current_items
-                characters = current_characters
-                chat_history_ids_list = [
-                    tokenizer.encode("", return_tensors='pt').long().to(device) for _ in characters
-                ]
-            if current_items is not None:
-                items = current_items
+            run_command(request.POST["command"])
         elif "message" in request.POST:
             idx = int(request.POST['characterId'][0]) - 1
-            characters[idx]["dialogues"].append(request.POST['message'])
-            chat_history_ids, response = get_dialogue(
-                tokenizer, model, player, characters[idx], request.POST['message'], chat_history_ids_list[idx]
-            )
-            characters[idx]["dialogues"].append(response.strip("\n"))
-            chat_history_ids_list[idx] = chat_history_ids
-    context = {
-        "narration": narration_history,
-        "location": parser.game.curr_location.name,
-        "location_img": "game/locations/" + parser.game.curr_location.name_cleaned + ".png",
-        "characters": characters,
-        "items": items,
-        "profile_img": "images/" + profile_path.split("/")[-1]
-    }
+            reply(get_session_key(request), characters[idx], request.POST['message'])
+    context = game_state()
+    context["profile_img"] = profile_image(get_session_key(request))
+
+    with span("render"):
+        return render(request, 'game.html', context)
+
 
-    return render(request, 'game.html', context)
+def metrics(request):
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,278 @@
+"""
+Hosting many worlds.
+
+A WorldRegistry maps world IDs to worlds: the ones configured explicitly,
+and every directory of worlds_dir holding the three world data files (as
+written by world_construction). Nothing is read until a world is first
+played: its data files are then parsed once into a WorldTemplate, from
+which every new game of that world is built. Templates are kept in an LRU
+within a memory budget, and the ones not played for idle_seconds are
+dropped, so boot time and memory do not depend on how many worlds are
+installed.
+
+A world directory can hold a world.json with its settings:
+
+    {"start": "Hogwarts Castle", "asset_root": "worlds/hogwarts", "asset_manifest": "assets.json"}
+
+start is the location players start at (by default the sixth one),
+asset_root the directory under the static root with its images (by default
+"worlds/<world ID>") and asset_manifest its derivatives manifest, relative
+to the world directory.
+
+A world directory written by game/regions.py holds the world.json index of
+a sharded world instead of the three data files. Its template only reads
+the index, and every game pages the regions in as the player walks, keeping
+at most the "max_resident_locations" setting of the world loaded (10000 by
+default).
+"""
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from .assets import AssetManifest
+from .game import build_world, load_world_data
+from .lore import build_lore_index
+from .regions import INDEX_FILE, build_sharded_game
+
+
+WORLD_DATA_FILES = {
+    "locations_filename": "locations.json",
+    "characters_filename": "characters.json",
+    "items_filename": "items.json"
+}
+WORLD_SETTINGS_FILE = "world.json"
+WORLD_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def is_sharded(data_dir):
+    """
+    Whether data_dir holds a world written by regions.shard_world.
+    """
+    filename = os.path.join(data_dir, INDEX_FILE)
+    return os.path.exists(filename) and "regions" in json.load(open(filename, 'r'))
+
+
+def is_world(data_dir):
+    return is_sharded(data_dir) or all(
+        os.path.exists(os.path.join(data_dir, filename)) for filename in WORLD_DATA_FILES.values()
+    )
+
+
+def data_signature(filenames):
+    """
+    Modification times and sizes of the data files, which change when any
+    of them is written.
+    """
+    signature = []
+    for key in sorted(filenames):
+        stat = os.stat(filenames[key])
+        signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+class WorldTemplate:
+    """
+    The parsed data of a world, and the settings to build its games with.
+    """
+    def __init__(self, world_id, config, url=None):
+        self.world_id = world_id
+        data_dir = str(config["data_dir"])
+        self.data_dir = data_dir
+        self.sharded = is_sharded(data_dir)
+        self.max_resident_locations = config.get("max_resident_locations", 10000)
+        if self.sharded:
+            self.filenames = {"index_filename": os.path.join(data_dir, INDEX_FILE)}
+        else:
+            self.filenames = {key: os.path.join(data_dir, filename) for key, filename in WORLD_DATA_FILES.items()}
+        # taken before reading, so that a change while reading is seen later
+        self.signature = data_signature(self.filenames)
+        self.start = config.get("start")
+        if self.sharded:
+            # the regions are read by each game as it goes
+            self.world_data = None
+            index = json.load(open(self.filenames["index_filename"], 'r'))
+            names = {name for _, name in index["locations"].values()}
+        else:
+            self.world_data = load_world_data(**self.filenames)
+            names = self.world_data["locations"]
+        if self.start is not None and self.start not in names:
+            raise ValueError("world %s has no location %r to start at" % (world_id, self.start))
+        manifest = config.get("asset_manifest")
+        self.assets = AssetManifest(
+            os.path.join(data_dir, manifest) if manifest is not None else None,
+            url=url,
+            root=config.get("asset_root", "worlds/" + world_id)
+        )
+        # size of the data files, which the memory budget is counted in
+        self.nbytes = sum(os.path.getsize(filename) for filename in self.filenames.values())
+        self.last_used = time.monotonic()
+        self.lore_index = None
+
+    def new_game(self):
+        self.last_used = time.monotonic()
+        if self.sharded:
+            return build_sharded_game(self.data_dir, self.max_resident_locations, self.start, self.assets)
+        return build_world(self.world_data, self.assets, self.start)
+
+    def lore(self):
+        """
+        The LoreIndex of the world's descriptions, built on first use, or
+        None for a sharded world, whose descriptions are never all loaded.
+        """
+        if self.sharded:
+            return None
+        if self.lore_index is None:
+            # from the data games are built from, so it agrees with them
+            # even if the files changed since
+            self.lore_index = build_lore_index(self.world_data)
+        return self.lore_index
+
+
+class WorldRegistry:
+    """
+    World templates by world ID, loaded on first use. max_bytes is the
+    budget of world data (counted in bytes of the data files) kept loaded.
+    """
+    def __init__(self, worlds_dir=None, worlds=None, max_bytes=64 * 1024 * 1024, idle_seconds=3600, url=None):
+        self.worlds_dir = str(worlds_dir) if worlds_dir is not None else None
+        # Dictionary mapping from world ID to the settings of a world
+        # configured explicitly, with its "data_dir"
+        self.configs = dict(worlds or {})
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.url = url
+        # OrderedDict mapping from world ID to WorldTemplate, least recently used first
+        self.templates = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        # counters
+        self.loads = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    def config(self, world_id):
+        """
+        The settings of a world, or a ValueError when there is no such world.
+        """
+        if world_id in self.configs:
+            return self.configs[world_id]
+        if self.worlds_dir is not None and WORLD_ID.match(world_id):
+            data_dir = os.path.join(self.worlds_dir, world_id)
+            if is_sharded(data_dir):
+                # the index's start is a location ID, not a setting
+                index = json.load(open(os.path.join(data_dir, INDEX_FILE), 'r'))
+                config = {key: index[key] for key in ["asset_root", "asset_manifest", "max_resident_locations"] if key in index}
+                return dict(config, data_dir=data_dir)
+            if is_world(data_dir):
+                config = {"data_dir": data_dir}
+                settings_filename = os.path.join(data_dir, WORLD_SETTINGS_FILE)
+                if os.path.exists(settings_filename):
+                    config.update(json.load(open(settings_filename, 'r')))
+                return config
+        raise ValueError("there is no world %r" % world_id)
+
+    def available(self):
+        """
+        The IDs of every installed world.
+        """
+        world_ids = set(self.configs)
+        if self.worlds_dir is not None and os.path.isdir(self.worlds_dir):
+            for entry in os.scandir(self.worlds_dir):
+                if entry.is_dir() and WORLD_ID.match(entry.name) and is_world(entry.path):
+                    world_ids.add(entry.name)
+        return sorted(world_ids)
+
+    def get(self, world_id):
+        """
+        The WorldTemplate of world_id, loading it if needed.
+        """
+        with self.lock:
+            template = self.templates.get(world_id)
+            if template is not None:
+                self.templates.move_to_end(world_id)
+                template.last_used = time.monotonic()
+                self.evict()
+                return template
+        # parsed without the lock, so games of other worlds go on meanwhile
+        template = WorldTemplate(world_id, self.config(world_id), self.url)
+        with self.lock:
+            loaded = self.templates.get(world_id)
+            if loaded is not None:
+                # loaded by another request meanwhile
+                self.templates.move_to_end(world_id)
+                return loaded
+            self.templates[world_id] = template
+            self.nbytes += template.nbytes
+            self.loads += 1
+            self.evict()
+            return template
+
+    def new_game(self, world_id):
+        return self.get(world_id).new_game()
+
+    def changed(self):
+        """
+        (world ID, signature) of the loaded worlds whose data files changed
+        since they were loaded.
+        """
+        with self.lock:
+            templates = list(self.templates.items())
+        changed = []
+        for world_id, template in templates:
+            try:
+                signature = data_signature(template.filenames)
+            except OSError:
+                # being replaced right now, seen on the next check
+                continue
+            if signature != template.signature:
+                changed.append((world_id, signature))
+        return changed
+
+    def reload(self, world_id):
+        """
+        Load the data files of a loaded world again and swap the new
+        template in. Returns (old template, new template), or (None, None)
+        when the world is not loaded (it is read afresh on first use).
+        Raises like loading does, keeping the old template.
+        """
+        with self.lock:
+            old = self.templates.get(world_id)
+        if old is None:
+            return None, None
+        # parsed without the lock, so games of other worlds go on meanwhile
+        new = WorldTemplate(world_id, self.config(world_id), self.url)
+        # data that does not build (e.g. a connection to a removed location) raises here, before the swap
+        new.new_game()
+        with self.lock:
+            if self.templates.get(world_id) is not old:
+                # evicted or reloaded meanwhile
+                return None, None
+            self.templates[world_id] = new
+            self.nbytes += new.nbytes - old.nbytes
+            self.reloads += 1
+        return old, new
+
+    def evict(self):
+        """
+        Drop idle templates, then the least recently used ones while over
+        the budget. The most recently used one is always kept. Games built
+        from a dropped template are not affected. Callers must hold the lock.
+        """
+        cutoff = time.monotonic() - self.idle_seconds
+        for world_id, template in list(self.templates.items())[:-1]:
+            if template.last_used < cutoff or self.nbytes > self.max_bytes:
+                del self.templates[world_id]
+                self.nbytes -= template.nbytes
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            "loaded": len(self.templates),
+            "bytes": self.nbytes,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "reloads": self.reloads
+        }
@@ -0,0 +1,164 @@
+import os
+import io
+import json
+import math
+import hashlib
+import argparse
+
+from PIL import Image, ImageOps
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_ROOT = os.path.join(REPO_ROOT, "game", "static")
+SOURCE_DIR = os.path.join(STATIC_ROOT, "game")
+DERIVED_DIR = os.path.join(STATIC_ROOT, "game", "derived")
+ASSET_MANIFEST = os.path.join(REPO_ROOT, "game", "assets.json")
+
+# Widths of the thumbnails of each asset class, at 1x and 2x of the size
+# the game displays them at. Characters and items are cropped to squares,
+# which also lets them share a sprite atlas of equal tiles.
+PROFILES = {
+    "locations": {"widths": [384, 768], "square": False, "tile": None},
+    "characters": {"widths": [36, 72], "square": True, "tile": 72},
+    "items": {"widths": [180, 360], "square": True, "tile": 180},
+}
+WEBP_QUALITY = 80
+
+
+def encode(image, image_format):
+    buffer = io.BytesIO()
+    if image_format == "webp":
+        image.save(buffer, "WEBP", quality=WEBP_QUALITY, method=6)
+    else:
+        # a 256 color palette keeps the PNG fallback a fraction of the RGB size
+        image.quantize(256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.FLOYDSTEINBERG).save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def write_hashed(data, directory, stem, extension):
+    """
+    Write data under a name containing its content hash and return the path
+    relative to the static root, as the game's templates reference it.
+    """
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    filename = os.path.join(directory, "%s.%s.%s" % (stem, digest, extension))
+    if not os.path.exists(filename):
+        with open(filename, 'wb') as outfile:
+            outfile.write(data)
+    return os.path.relpath(filename, STATIC_ROOT).replace(os.sep, "/")
+
+
+def resize(image, width, square):
+    if square:
+        # keep the top of portraits, where the faces are
+        return ImageOps.fit(image, (width, width), Image.LANCZOS, centering=(0.5, 0.3))
+    height = round(image.height * width / image.width)
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def build_kind(kind, source_dir=SOURCE_DIR, derived_dir=DERIVED_DIR):
+    """
+    Thumbnails of every image of an asset class and, for square classes,
+    a sprite atlas of all of them. Returns the manifest entries of the
+    assets and of the atlas.
+    """
+    profile = PROFILES[kind]
+    outdir = os.path.join(derived_dir, kind)
+    os.makedirs(outdir, exist_ok=True)
+    assets = {}
+    tiles = []
+    for filename in sorted(os.listdir(os.path.join(source_dir, kind))):
+        name, extension = os.path.splitext(filename)
+        if extension != ".png":
+            continue
+        image = Image.open(os.path.join(source_dir, kind, filename)).convert("RGB")
+        # never upscale, but always keep at least the smallest width
+        widths = [width for width in profile["widths"] if width <= image.width] or profile["widths"][:1]
+        variants = []
+        for width in widths:
+            thumbnail = resize(image, width, profile["square"])
+            variants.append({
+                "width": thumbnail.width,
+                "height": thumbnail.height,
+                "webp": write_hashed(encode(thumbnail, "webp"), outdir, "%s-%d" % (name, width), "webp"),
+                "png": write_hashed(encode(thumbnail, "png"), outdir, "%s-%d" % (name, width), "png")
+            })
+        assets[kind + "/" + name] = {"variants": variants}
+        if profile["tile"]:
+            tiles.append((name, resize(image, profile["tile"], True)))
+
+    atlas = None
+    if tiles:
+        tile = profile["tile"]
+        columns = math.ceil(math.sqrt(len(tiles)))
+        rows = math.ceil(len(tiles) / columns)
+        sheet = Image.new("RGB", (columns * tile, rows * tile))
+        for index, (name, image) in enumerate(tiles):
+            column, row = index % columns, index // columns
+            sheet.paste(image, (column * tile, row * tile))
+            assets[kind + "/" + name]["sprite"] = {"column": column, "row": row}
+        atlas = {
+            "columns": columns,
+            "rows": rows,
+            "tile": tile,
+            "webp": write_hashed(encode(sheet, "webp"), outdir, "atlas", "webp"),
+            "png": write_hashed(encode(sheet, "png"), outdir, "atlas", "png")
+        }
+    return assets, atlas
+
+
+def remove_stale(manifest, derived_dir=DERIVED_DIR):
+    """
+    Delete derived files no longer referenced by the manifest, e.g. the
+    thumbnails of images that were re-rendered since.
+    """
+    referenced = set()
+    for entry in list(manifest["assets"].values()):
+        for variant in entry["variants"]:
+            referenced.update([variant["webp"], variant["png"]])
+    for atlas in manifest["atlases"].values():
+        referenced.update([atlas["webp"], atlas["png"]])
+    for directory, _, filenames in os.walk(derived_dir):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(directory, filename), STATIC_ROOT).replace(os.sep, "/")
+            if path not in referenced:
+                os.remove(os.path.join(directory, filename))
+
+
+def build_derivatives(kinds=tuple(PROFILES), source_dir=SOURCE_DIR, derived_dir=DERIVED_DIR, manifest_filename=ASSET_MANIFEST):
+    """
+    Build the thumbnails and atlases of every asset class and write the
+    manifest the game resolves image paths with. Files are named by the
+    hash of their content, so they can be cached by browsers forever.
+    """
+    manifest = {"assets": {}, "atlases": {}}
+    if os.path.exists(manifest_filename):
+        manifest = json.load(open(manifest_filename, 'r'))
+    for kind in kinds:
+        manifest["assets"] = {key: entry for key, entry in manifest["assets"].items() if not key.startswith(kind + "/")}
+        manifest["atlases"].pop(kind, None)
+        assets, atlas = build_kind(kind, source_dir, derived_dir)
+        manifest["assets"].update(assets)
+        if atlas is not None:
+            manifest["atlases"][kind] = atlas
+        print("%s: %d assets" % (kind, len(assets)))
+    remove_stale(manifest, derived_dir)
+
+    temporary = manifest_filename + ".tmp"
+    with open(temporary, 'w') as outfile:
+        json.dump(manifest, outfile, indent=4, sort_keys=True)
+    os.replace(temporary, manifest_filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build right-sized thumbnails and sprite atlases of the game's images.")
+    parser.add_argument("--only", nargs="+", choices=sorted(PROFILES), default=sorted(PROFILES))
+    parser.add_argument("--source-dir", default=SOURCE_DIR)
+    parser.add_argument("--derived-dir", default=DERIVED_DIR)
+    parser.add_argument("--manifest", default=ASSET_MANIFEST)
+    args = parser.parse_args()
+    build_derivatives(args.only, args.source_dir, args.derived_dir, args.manifest)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,101 +1,234 @@
+import os
 import json
-import shutil
+import hashlib
+import argparse
 
-import pixray
+from derivatives import build_derivatives
+from scheduler import schedule
 
 
-def generate_locations(filename="locations.json"):
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(REPO_ROOT, "game", "static", "game", "data")
+STATIC_DIR = os.path.join(REPO_ROOT, "game", "static", "game")
+MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "manifest.json")
+
+# Bump to re-render everything after a change to the rendering pipeline
+RENDER_VERSION = 1
+
+
+def clean_name(name):
+    return name.lower().replace(" ", "_").replace("/", "_")
+
+
+def location_jobs(filename):
+    jobs = []
     locations = json.load(open(filename, 'r'))
     for location, data in locations.items():
-        location = location.lower().replace(" ", "_").replace("/", "_")
-        pixray.run(
-            prompts=data['appearance'],
-            drawer="vqgan",
-            quality="best",
-            custom_loss="aesthetic",
-            output=location + ".png",
-            outdir="outputs/locations/" + location
-        )
-
-
-def generate_characters(filename="characters.json"):
+        jobs.append({
+            "kind": "locations",
+            "name": clean_name(location),
+            "settings": {
+                "prompts": data['appearance'],
+                "drawer": "vqgan",
+                "quality": "best",
+                "custom_loss": "aesthetic"
+            }
+        })
+    return jobs
+
+
+def character_jobs(filename):
+    jobs = []
     characters = json.load(open(filename, 'r'))
     for name, data in characters.items():
-        _name = name.lower().replace(" ", "_")
-        pixray.run(
-            prompts="A portrait of " + name + ". " + data['appearance'],
-            drawer="vqgan",
-            quality="normal",
-            aspect="portrait",
-            custom_loss="aesthetic",
-            output=_name + ".png",
-            outdir="outputs/characters/" + _name
-        )
+        jobs.append({
+            "kind": "characters",
+            "name": clean_name(name),
+            "settings": {
+                "prompts": "A portrait of " + name + ". " + data['appearance'],
+                "drawer": "vqgan",
+                "quality": "normal",
+                "aspect": "portrait",
+                "custom_loss": "aesthetic"
+            }
+        })
+    return jobs
 
 
-
-def generate_items(filename="items.json"):
+def item_jobs(filename):
+    jobs = []
     items = json.load(open(filename, 'r'))
     for name, data in items.items():
-        _name = name.lower().replace(" ", "_")
-        pixray.run(
-            prompts="A picture of " + name + ". " + data['description'],
-            drawer="vqgan",
-            quality="normal",
-            aspect="square",
-            custom_loss="aesthetic",
-            output=_name + ".png",
-            outdir="outputs/items/" + _name
-        )
-
-
-def collect_images(
-    locations_filename="locations.json",
-    characters_filename="characters.json",
-    items_filename="items.json",
-    location_dir="outputs/locations/",
-    character_dir="outputs/characters/",
-    items_dir="outputs/items/"
+        jobs.append({
+            "kind": "items",
+            "name": clean_name(name),
+            "settings": {
+                "prompts": "A picture of " + name + ". " + data['description'],
+                "drawer": "vqgan",
+                "quality": "normal",
+                "aspect": "square",
+                "custom_loss": "aesthetic"
+            }
+        })
+    return jobs
+
+
+def job_hash(job):
+    """
+    Content hash of everything that determines how an asset looks.
+    """
+    content = json.dumps([RENDER_VERSION, job["settings"]], sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def job_output(job, static_dir=STATIC_DIR):
+    """
+    Final location of the PNG of an asset, where the game serves it from.
+    """
+    return os.path.join(static_dir, job["kind"], job["name"] + ".png")
+
+
+def load_manifest(filename=MANIFEST):
+    if os.path.exists(filename):
+        return json.load(open(filename, 'r'))
+    return {}
+
+
+def save_manifest(manifest, filename=MANIFEST):
+    """
+    Write the manifest atomically, so a crash never leaves it half written.
+    """
+    temporary = filename + ".tmp"
+    with open(temporary, 'w') as outfile:
+        json.dump(manifest, outfile, indent=4, sort_keys=True)
+    os.replace(temporary, filename)
+
+
+def stale_jobs(jobs, manifest, static_dir=STATIC_DIR):
+    """
+    Jobs whose prompt or settings changed since they were last rendered,
+    or whose output file is missing.
+    """
+    stale = []
+    for job in jobs:
+        entry = manifest.get(job["kind"] + "/" + job["name"])
+        if entry is None or entry["hash"] != job_hash(job) or not os.path.exists(job_output(job, static_dir)):
+            stale.append(job)
+    return stale
+
+
+def render(job, static_dir=STATIC_DIR):
+    """
+    Render one asset with pixray straight into the game's static directory.
+    """
+    import pixray
+    pixray.run(
+        output=job["name"] + ".png",
+        outdir=os.path.join(static_dir, job["kind"]),
+        **job["settings"]
+    )
+
+
+def build(
+    jobs,
+    static_dir=STATIC_DIR,
+    manifest_filename=MANIFEST,
+    force=False,
+    dry_run=False,
+    workers=1,
+    threads_per_worker=None,
+    renderer="generate_graphics:render",
+    report_filename=None
 ):
-    locations = json.load(open(locations_filename, 'r'))
-    for location, data in locations.items():
-        location = location.lower().replace(" ", "_").replace("/", "_")
-        try:
-            shutil.copy(location_dir + location + "/" + location + ".png", location_dir + location + ".png")
-        except shutil.SameFileError:
-            print("Source and destination represents the same file.")
-        except PermissionError:
-            print("Permission denied.")
-        except:
-            print("Error occurred while copying file.")
-
-    characters = json.load(open(characters_filename, 'r'))
-    for name, data in characters.items():
-        name = name.lower().replace(" ", "_")
-        try:
-            shutil.copy(character_dir + name + "/" + name + ".png", character_dir + name + ".png")
-        except shutil.SameFileError:
-            print("Source and destination represents the same file.")
-        except PermissionError:
-            print("Permission denied.")
-        except:
-            print("Error occurred while copying file.")
-
-    items = json.load(open(items_filename, 'r'))
-    for name, data in items.items():
-        name = name.lower().replace(" ", "_")
-        try:
-            shutil.copy(items_dir + name + "/" + name + ".png", items_dir + name + ".png")
-        except shutil.SameFileError:
-            print("Source and destination represents the same file.")
-        except PermissionError:
-            print("Permission denied.")
-        except:
-            print("Error occurred while copying file.")
+    """
+    Render every stale asset in a pool of workers. The manifest is saved
+    after each asset, so an interrupted build resumes with the assets it
+    had not finished, and it keeps how long each asset took so the next
+    build can start with the slowest ones. Returns the failed jobs.
+    """
+    manifest = load_manifest(manifest_filename)
+    todo = jobs if force else stale_jobs(jobs, manifest, static_dir)
+    print("%d of %d assets to render" % (len(todo), len(jobs)))
+    if dry_run:
+        for job in todo:
+            print(job["kind"] + "/" + job["name"])
+        return []
+    for kind in set(job["kind"] for job in todo):
+        os.makedirs(os.path.join(static_dir, kind), exist_ok=True)
+
+    def on_success(job, seconds):
+        manifest[job["kind"] + "/" + job["name"]] = {
+            "hash": job_hash(job),
+            "output": os.path.relpath(job_output(job, static_dir), REPO_ROOT),
+            "seconds": round(seconds, 1)
+        }
+        save_manifest(manifest, manifest_filename)
+
+    timings = {key: entry["seconds"] for key, entry in manifest.items() if "seconds" in entry}
+    failed = schedule(
+        todo, static_dir, renderer=renderer, workers=workers, threads_per_worker=threads_per_worker,
+        timings=timings, on_success=on_success, report_filename=report_filename
+    )
+    if failed:
+        print("%d assets failed: %s" % (len(failed), ", ".join(job["kind"] + "/" + job["name"] for job, _ in failed)))
+    return failed
+
+
+def adopt(jobs, static_dir=STATIC_DIR, manifest_filename=MANIFEST):
+    """
+    Record the current settings of every asset that already has an image
+    but no manifest entry, e.g. images rendered before the manifest existed.
+    """
+    manifest = load_manifest(manifest_filename)
+    for job in jobs:
+        key = job["kind"] + "/" + job["name"]
+        if key not in manifest and os.path.exists(job_output(job, static_dir)):
+            manifest[key] = {"hash": job_hash(job), "output": os.path.relpath(job_output(job, static_dir), REPO_ROOT)}
+    save_manifest(manifest, manifest_filename)
+
+
+def all_jobs(data_dir=DATA_DIR, kinds=("locations", "characters", "items")):
+    jobs = []
+    if "locations" in kinds:
+        jobs += location_jobs(os.path.join(data_dir, "locations.json"))
+    if "characters" in kinds:
+        jobs += character_jobs(os.path.join(data_dir, "characters.json"))
+    if "items" in kinds:
+        jobs += item_jobs(os.path.join(data_dir, "items.json"))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the images of every changed location, character and item.")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--static-dir", default=STATIC_DIR)
+    parser.add_argument("--manifest", default=MANIFEST)
+    parser.add_argument("--only", nargs="+", choices=["locations", "characters", "items"],
+                        default=["locations", "characters", "items"])
+    parser.add_argument("--force", action="store_true", help="re-render every asset")
+    parser.add_argument("--dry-run", action="store_true", help="only list the assets that would be rendered")
+    parser.add_argument("--adopt", action="store_true", help="record existing images as up to date")
+    parser.add_argument("--workers", type=int, default=1, help="assets rendered in parallel")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="torch/OpenMP threads per worker, cores divided by workers by default")
+    parser.add_argument("--renderer", default="generate_graphics:render",
+                        help="module:function rendering one job, e.g. scheduler:placeholder_render")
+    parser.add_argument("--report", default=None, help="JSON file kept up to date with progress and ETA")
+    args = parser.parse_args()
+
+    jobs = all_jobs(args.data_dir, args.only)
+    if args.adopt:
+        adopt(jobs, args.static_dir, args.manifest)
+    failed = build(
+        jobs, args.static_dir, args.manifest, force=args.force, dry_run=args.dry_run, workers=args.workers,
+        threads_per_worker=args.threads_per_worker, renderer=args.renderer, report_filename=args.report
+    )
+    if not args.dry_run:
+        # thumbnails and atlases the game serves instead of the full-size renders
+        build_derivatives(args.only, source_dir=args.static_dir)
+    if failed:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
-    generate_locations()
-    generate_characters()
-    generate_items()
-    collect_images()
+    main()
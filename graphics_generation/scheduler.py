@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import hashlib
+import importlib
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+
+# Relative cost of a pixray quality setting, used when no timing is known
+QUALITY_COST = {"draft": 1, "normal": 2, "better": 3, "best": 4}
+
+
+def load_renderer(spec):
+    """
+    Resolve a "module:function" renderer spec. Specs rather than functions
+    are handed to the workers so any renderer can be swapped in by name.
+    """
+    module_name, function_name = spec.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def init_worker(threads):
+    """
+    Limit the threads of every math library in a worker, so that workers
+    times threads matches the number of cores instead of oversubscribing.
+    """
+    for variable in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ[variable] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+
+def run_job(renderer_spec, job, static_dir):
+    """
+    Render one job in a worker. Failures are returned instead of raised so
+    one bad asset never takes the others down.
+    """
+    start = time.perf_counter()
+    try:
+        load_renderer(renderer_spec)(job, static_dir)
+        return {"ok": True, "seconds": time.perf_counter() - start}
+    except Exception:
+        return {"ok": False, "seconds": time.perf_counter() - start, "error": traceback.format_exc()}
+
+
+def estimate_cost(job, timings):
+    """
+    Expected seconds of a job: its last measured time if there is one,
+    otherwise a guess from its quality setting.
+    """
+    key = job["kind"] + "/" + job["name"]
+    if key in timings:
+        return timings[key]
+    return QUALITY_COST.get(job["settings"].get("quality", "normal"), 2) * 60.0
+
+
+def write_report(filename, report):
+    if filename is None:
+        return
+    temporary = filename + ".tmp"
+    with open(temporary, 'w') as outfile:
+        json.dump(report, outfile, indent=4)
+    os.replace(temporary, filename)
+
+
+def schedule(
+    jobs,
+    static_dir,
+    renderer="generate_graphics:render",
+    workers=1,
+    threads_per_worker=None,
+    timings=None,
+    on_success=None,
+    report_filename=None
+):
+    """
+    Render jobs in a pool of worker processes, largest first so the
+    longest renders do not end up alone at the tail. on_success(job,
+    seconds) is called in this process after every finished render, and a
+    progress report with an ETA is rewritten after every job. A worker
+    that dies (e.g. out of memory) fails only the jobs it was running; the
+    pool is restarted for the rest. Returns the list of failed jobs.
+    """
+    timings = timings or {}
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    queue = sorted(jobs, key=lambda job: estimate_cost(job, timings), reverse=True)
+    total_cost = sum(estimate_cost(job, timings) for job in queue)
+    done_cost = 0.0
+    failed = []
+    done = 0
+    start = time.time()
+
+    def report(running):
+        elapsed = time.time() - start
+        rate = done_cost / elapsed if done_cost else None
+        remaining_cost = total_cost - done_cost
+        write_report(report_filename, {
+            "total": len(jobs),
+            "done": done,
+            "failed": [job["kind"] + "/" + job["name"] for job, _ in failed],
+            "running": [job["kind"] + "/" + job["name"] for job in running],
+            "queued": len(queue),
+            "elapsed_seconds": elapsed,
+            "eta_seconds": remaining_cost / rate if rate else None
+        })
+
+    while queue:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(threads_per_worker,))
+        in_flight = {}
+        try:
+            while queue or in_flight:
+                while queue and len(in_flight) < workers:
+                    job = queue.pop(0)
+                    in_flight[executor.submit(run_job, renderer, job, static_dir)] = job
+                report(in_flight.values())
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    result = future.result()
+                    job = in_flight.pop(future)
+                    done += 1
+                    done_cost += estimate_cost(job, timings)
+                    key = job["kind"] + "/" + job["name"]
+                    if result["ok"]:
+                        print("%s rendered in %.1fs (%d/%d)" % (key, result["seconds"], done, len(jobs)))
+                        if on_success is not None:
+                            on_success(job, result["seconds"])
+                    else:
+                        print("%s failed:\n%s" % (key, result["error"]))
+                        failed.append((job, result["error"]))
+        except BrokenProcessPool:
+            for job in in_flight.values():
+                done += 1
+                failed.append((job, "worker process died"))
+                print("%s failed: worker process died" % (job["kind"] + "/" + job["name"]))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+    report([])
+    return failed
+
+
+def placeholder_render(job, static_dir):
+    """
+    Cheap stand-in for pixray that writes a flat image in a color derived
+    from the prompt, for tests and dry runs of the pipeline.
+    """
+    from PIL import Image
+    sizes = {"portrait": (256, 384), "landscape": (384, 256), "square": (256, 256)}
+    size = sizes.get(job["settings"].get("aspect", "landscape"), (384, 256))
+    digest = hashlib.sha256(job["settings"]["prompts"].encode("utf-8")).digest()
+    outdir = os.path.join(static_dir, job["kind"])
+    os.makedirs(outdir, exist_ok=True)
+    Image.new("RGB", size, tuple(digest[:3])).save(os.path.join(outdir, job["name"] + ".png"))
@@ -2,6 +2,8 @@
 ASGI config for interactive_fiction project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Websocket connections to /ws/game/ are handled by game.sockets, everything
+else by Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
@@ -13,4 +15,19 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'interactive_fiction.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported once Django is set up, since it loads the game
+from game.sockets import game_socket
+
+GAME_SOCKET_PATH = "/ws/game/"
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        if scope["path"] == GAME_SOCKET_PATH:
+            return await game_socket(scope, receive, send)
+        # refuse the handshake of any other websocket
+        await receive()
+        return await send({"type": "websocket.close"})
+    return await django_application(scope, receive, send)
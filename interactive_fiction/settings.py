@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,6 +43,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'game.middleware.ImmutableAssetsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -127,3 +129,113 @@ MEDIA_ROOT = BASE_DIR / "media"
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Dialogue models, from the preferred one to the cheapest fallback.
+# The router switches to a cheaper model (or caps the reply length) when
+# the projected generation latency would exceed DIALOGUE_LATENCY_BUDGET
+# seconds, and rejects messages beyond DIALOGUE_MAX_QUEUE_DEPTH.
+
+DIALOGUE_MODELS = [
+    {
+        "name": "dialoGPT-medium",
+        "model_path": "game/static/game/dialoGPT.pth",
+        "base_model": "microsoft/DialoGPT-medium"
+    },
+    {
+        "name": "dialoGPT-small",
+        "model_path": None,
+        "base_model": "microsoft/DialoGPT-small",
+        "stub": {"token_seconds": 0.008}
+    },
+]
+DIALOGUE_LATENCY_BUDGET = 3.0
+DIALOGUE_MAX_QUEUE_DEPTH = 8
+
+# DIALOGUE_BACKEND "response_index" answers from the response index built by
+# dialogue_systems/build_response_index.py instead of running the models,
+# and neither torch nor transformers is imported.
+
+DIALOGUE_BACKEND = os.environ.get("DIALOGUE_BACKEND", "model")
+DIALOGUE_RESPONSE_INDEX = BASE_DIR / "game" / "static" / "game" / "responses.npz"
+
+# With DIALOGUE_STUB=1 in the environment the models are replaced by
+# game.dialogue_stub.StubModel, which answers after the latency modelled by
+# these parameters, for load tests (benchmarks/load_test.py).
+
+DIALOGUE_STUB = {
+    "prefill_seconds": 0.05,
+    "prefill_token_seconds": 0.0002,
+    "token_seconds": 0.02,
+    "mean_tokens": 24,
+    "jitter": 0.2,
+    "contention": 0.5
+} if os.environ.get("DIALOGUE_STUB") else None
+
+
+# Per-character conversation memory. Token histories of a session above
+# CONVERSATION_SESSION_BYTES, or of all sessions above CONVERSATION_MAX_BYTES,
+# are spilled to CONVERSATION_SPILL_DIR. Sessions idle for
+# CONVERSATION_IDLE_SECONDS are forgotten, in memory and on disk.
+
+CONVERSATION_SPILL_DIR = BASE_DIR / "conversations"
+CONVERSATION_SESSION_BYTES = 256 * 1024
+CONVERSATION_MAX_BYTES = 64 * 1024 * 1024
+CONVERSATION_IDLE_SECONDS = 24 * 60 * 60
+
+
+# Lore injected into dialogue prompts: at most LORE_TOP_K snippets of the
+# world descriptions, within LORE_TOKEN_BUDGET tokens.
+
+LORE_TOP_K = 3
+LORE_TOKEN_BUDGET = 64
+
+
+# Telemetry of commands and dialogue (game/telemetry.py), written in the
+# background to gzip JSON lines files in TELEMETRY_DIR. Events beyond
+# TELEMETRY_QUEUE_SIZE waiting to be written are dropped; files are rotated
+# at TELEMETRY_FILE_BYTES and only the newest TELEMETRY_MAX_FILES are kept.
+
+TELEMETRY_DIR = BASE_DIR / "telemetry"
+TELEMETRY_QUEUE_SIZE = 10000
+TELEMETRY_FILE_BYTES = 16 * 1024 * 1024
+TELEMETRY_MAX_FILES = 50
+
+
+# Worlds (game/worlds.py): WORLDS configured here, and every world directory
+# in WORLDS_DIR, loaded on first use. WORLD_CACHE_BYTES bounds the world data
+# kept loaded (in bytes of the data files), and worlds not played for
+# WORLD_IDLE_SECONDS are dropped. The game page plays DEFAULT_WORLD. All
+# players share one game, so ?world=<world ID> switches it for everyone and
+# is only allowed to staff users, or to anyone with WORLD_SWITCHING (e.g. a
+# server played alone). The images of a world in WORLDS_DIR are served from
+# static/worlds/<world ID>/.
+
+WORLDS_DIR = BASE_DIR / "worlds"
+WORLDS = {
+    "harry_potter": {
+        "data_dir": BASE_DIR / "game" / "static" / "game" / "data",
+        "asset_root": "game",
+        "asset_manifest": BASE_DIR / "game" / "assets.json"
+    }
+}
+DEFAULT_WORLD = "harry_potter"
+WORLD_CACHE_BYTES = 64 * 1024 * 1024
+WORLD_IDLE_SECONDS = 60 * 60
+WORLD_SWITCHING = False
+
+STATICFILES_DIRS = [("worlds", WORLDS_DIR)] if WORLDS_DIR.is_dir() else []
+
+# The data files of the loaded worlds are checked for changes every
+# WORLD_RELOAD_SECONDS (None turns it off). A changed world is reloaded and
+# running games are carried over to it on their next command.
+
+WORLD_RELOAD_SECONDS = 1.0
+
+
+# Thumbnails and sprite atlases built by graphics_generation/derivatives.py
+# have content-hashed names, so they are served with a far-future
+# Cache-Control header.
+
+IMMUTABLE_ASSET_PREFIXES = ["/" + STATIC_URL + "game/derived/"]
+IMMUTABLE_ASSET_MAX_AGE = 365 * 24 * 60 * 60
@@ -0,0 +1,382 @@
+"""
+Build a game world from a story summary.
+
+A script version of World_Construction.ipynb: characters and locations are
+extracted with stanza NER (and relation triples with CoreNLP OpenIE), the
+locations connected and the characters placed with extractive QA (batched,
+see qa.py), and descriptions, appearances and items written by a
+completion backend. The output is the locations.json, characters.json and
+items.json the game loads.
+
+Every stage is cached under --stages, keyed by a hash of its inputs and
+parameters (see stages.py), so tweaking the entity edits or the aliases
+re-runs neither the annotators nor the QA model.
+
+    python -m world_construction.construct_world HP1_summary.txt --output world
+"""
+import os
+import json
+import string
+import argparse
+from collections import deque
+
+from dialogue_extraction.completion import BACKENDS, CompletionCache, complete_all
+from world_construction.qa import BatchedQA
+from world_construction.stages import StageCache, digest
+
+
+NER_PROCESSORS = "tokenize,ner"
+OPENIE_PROPERTIES = {
+    "openie.affinity_probability_cap": 2 / 3,
+    "openie.ignore_affinity": True
+}
+
+# Manual corrections of the NER output for the Harry Potter summary
+DEFAULT_EDITS = {
+    "remove_people": ["Diagon Alley", "Ron", "James", "Lord Voldemort's", "Gryffindor", "Slytherin", "Ravenclaw",
+                      "Hufflepuff", "Petunia Dursley", "Vernon"],
+    "remove_locations": ["Gringotts Bank", "Quidditch", "Slytherin", "Hogwarts School of Witchcraft", "Sorting Hat",
+                         "King's Cross"],
+    "add_people": [],
+    "add_locations": ["Diagon Alley", "Hogwarts School of Witchcraft and Wizardry", "King's Cross railway station"],
+    "aliases": {
+        "Hogwarts": "Hogwarts School of Witchcraft and Wizardry",
+        "Gringotts Bank": "Gringotts Wizarding Bank"
+    }
+}
+
+STOP_WORDS = set("""
+i me my myself we our ours ourselves you your yours yourself yourselves he him his himself she her hers herself it
+its itself they them their theirs themselves what which who whom this that these those am is are was were be been
+being have has had having do does did doing a an the and but if or because as until while of at by for with about
+against between into through during before after above below to from up down in out on off over under again further
+then once here there when where why how all any both each few more most other some such no nor not only own same so
+than too very s t can will just don should now
+""".split())
+
+
+def read_story(filename):
+    with open(filename, 'r') as story_file:
+        return story_file.read().replace("\xa0", " ")
+
+
+def annotate_entities(story, processors=NER_PROCESSORS):
+    """
+    The (text, type) of every entity mention stanza's NER finds in the story.
+    """
+    import stanza
+    stanza.download('en')
+    nlp = stanza.Pipeline(lang='en', processors=processors)
+    return [[ent.text, ent.type] for ent in nlp(story).ents]
+
+
+def annotate_openie(story, properties=OPENIE_PROPERTIES, corenlp_dir="./corenlp"):
+    """
+    Entity mentions and the (subject, relation, object) triples of every
+    sentence of the story, from a CoreNLP server with the OpenIE annotator.
+    """
+    import stanza
+    from stanza.server import CoreNLPClient
+    if not os.path.exists(corenlp_dir):
+        stanza.install_corenlp(dir=corenlp_dir)
+    os.environ["CORENLP_HOME"] = corenlp_dir
+    with CoreNLPClient(timeout=150000000, be_quiet=True, annotators=['openie', 'ner'],
+                       endpoint='http://localhost:9001') as client:
+        document = client.annotate(story, properties=properties)
+    return {
+        "mentions": [[mention.entityMentionText, mention.entityType] for mention in document.mentions],
+        "triples": [
+            [[triple.subject, triple.relation, triple.object] for triple in sentence.openieTriple]
+            for sentence in document.sentence
+        ]
+    }
+
+
+def filter_entities(entities, openie, edits, stop_words=STOP_WORDS):
+    """
+    People and locations (organizations and facilities) of the NER output
+    after the manual edits, and the OpenIE triples between two entities.
+    A person whose name is part of an already seen person's name is
+    skipped, e.g. "Harry" after "Harry Potter".
+    """
+    people = []
+    locations = set()
+    people_split = set()
+    for text, entity_type in entities:
+        if entity_type == "PERSON":
+            if text not in people_split and text not in people:
+                people.append(text)
+                people_split.update(text.split())
+        elif entity_type == "ORG" or entity_type == "FAC":
+            locations.add(text)
+    people = (set(people) - set(edits.get("remove_people", []))) | set(edits.get("add_people", []))
+    locations = (locations - set(edits.get("remove_locations", []))) | set(edits.get("add_locations", []))
+
+    # keep the first triple of every subject in a sentence
+    all_entities = set(text for text, _ in entities)
+    triples = []
+    for sentence in openie["triples"]:
+        existing_subjects = set()
+        for subject, relation, triple_object in sentence:
+            if subject in existing_subjects or subject not in all_entities or triple_object not in all_entities:
+                continue
+            if subject in stop_words or triple_object in stop_words:
+                continue
+            triples.append({"subject": subject, "relation": relation, "object": triple_object})
+            existing_subjects.add(subject)
+    return {"people": sorted(people), "locations": sorted(locations), "triples": triples}
+
+
+def match_location(answer, locations, aliases):
+    """
+    The first location an answer names, e.g. "Hogwarts" names "Hogwarts
+    School of Witchcraft and Wizardry".
+    """
+    answer = aliases.get(answer, answer)
+    for location in locations:
+        if answer in location or location in answer:
+            return location
+    return None
+
+
+def connection_questions(locations):
+    return ["Where can I visit from {}?".format(location) for location in locations]
+
+
+def person_questions(people):
+    return ["Where is {}?".format(person) for person in people]
+
+
+def get_location_connections(locations, answers, aliases):
+    """
+    Connect every location to the locations the answers to "Where can I
+    visit from X?" name.
+    """
+    story_map = {}
+    for location, location_answers in zip(locations, answers):
+        connections = set()
+        for answer, score in location_answers:
+            answer = aliases.get(answer, answer)
+            for other in locations:
+                if other != location and (answer in other or other in answer):
+                    connections.add(other)
+        story_map[location] = connections
+        print(location + ": " + ", ".join(sorted(connections)))
+    return story_map
+
+
+def get_location_of_person(people, locations, answers, aliases):
+    """
+    Place every person at the first location the answers to "Where is X?"
+    name, or "nowhere".
+    """
+    person_to_location = {}
+    for person, person_answers in zip(people, answers):
+        person_to_location[person] = "nowhere"
+        for answer, score in person_answers:
+            location = match_location(answer, locations, aliases)
+            if location is not None:
+                person_to_location[person] = location
+                break
+        print(person + ": " + person_to_location[person])
+    return person_to_location
+
+
+def copy_map(story_map):
+    return {location: set(connections) for location, connections in story_map.items()}
+
+
+def enhance_map(story_map):
+    """
+    Make every connection go both ways.
+    """
+    new_story_map = copy_map(story_map)
+    for location, connections in story_map.items():
+        for connection in connections:
+            new_story_map[connection].add(location)
+    return new_story_map
+
+
+def shortest_path_length(story_map, start, goal):
+    explored = set()
+    queue = deque([(start, 0)])
+    while queue:
+        node, distance = queue.popleft()
+        if node == goal:
+            return distance
+        if node in explored:
+            continue
+        explored.add(node)
+        for neighbor in story_map[node]:
+            queue.append((neighbor, distance + 1))
+    return -1
+
+
+def reduce_path(story_map):
+    """
+    Remove the edge A -> B whenever there is another path from A to B,
+    starting with the most connected locations.
+    """
+    clean_map = copy_map(story_map)
+    for location in sorted(clean_map, key=lambda location: len(clean_map[location]), reverse=True):
+        for connection in sorted(clean_map[location]):
+            clean_map[location].remove(connection)
+            if shortest_path_length(clean_map, location, connection) == -1:
+                clean_map[location].add(connection)
+    return clean_map
+
+
+def clean_list(text, skip_words=()):
+    """
+    Parse a completion listing things one per line into short lowercase
+    names without punctuation and stop words.
+    """
+    names = []
+    for line in text.strip().split("\n"):
+        tokens = []
+        for token in line[1:].lower().strip().split():
+            for punctuation in string.punctuation:
+                token = token.replace(punctuation, '')
+            if token and token not in STOP_WORDS and not any(word in token for word in skip_words):
+                tokens.append(token)
+        if 0 < len(tokens) < 7:
+            names.append(" ".join(tokens))
+    return names
+
+
+def describe_world(story, title, locations, story_map, person_to_location, backend, cache=None, max_workers=8):
+    """
+    Write the descriptions and appearances of every location and person and
+    the items of every location with the completion backend, in the schema
+    of game/static/game/data.
+    """
+    def complete(jobs):
+        texts = complete_all(
+            [{"movie": title, "character": name, "prompt": prompt} for name, prompt in jobs],
+            backend, cache=cache, max_workers=max_workers
+        )
+        return [text.strip() for text in texts]
+
+    location_texts = complete(
+        [(location, "Story:\n{}\nWhat is {}?\n".format(story, location)) for location in locations] +
+        [(location, "Story:\n{}\nDescribe the appearance of {}:\n".format(story, location)) for location in locations]
+    )
+    location_info = {}
+    for index, location in enumerate(locations):
+        location_info[location] = {
+            "connections": sorted(story_map[location]),
+            "description": location_texts[index],
+            "appearance": location_texts[len(locations) + index]
+        }
+
+    people = sorted(person_to_location)
+    person_texts = complete(
+        [(person, "Story:\n{}\nDescribe {} in the story:\n".format(story, person)) for person in people] +
+        [(person, "Story:\n{}\nDescribe the appearance of {}:\n".format(story, person)) for person in people]
+    )
+    character_info = {}
+    for index, person in enumerate(people):
+        character_info[person] = {
+            "description": person_texts[index],
+            "appearance": person_texts[len(people) + index],
+            "location": person_to_location[person]
+        }
+
+    item_lists = complete([
+        (location, "Story:{}\n{}{}\nGive a short list of items at {}:\n".format(
+            story, info["description"], info["appearance"], location
+        )) for location, info in location_info.items()
+    ])
+    item_locations = {}
+    for location, item_list in zip(location_info, item_lists):
+        for item in clean_list(item_list):
+            item_locations[item] = location
+    items = sorted(item_locations)
+    item_texts = complete([
+        (item, "{}\n{}{}\nDescribe {} in one sentence:\n".format(
+            story, location_info[item_locations[item]]["description"],
+            location_info[item_locations[item]]["appearance"], item
+        )) for item in items
+    ])
+    item_info = {item: {"location": item_locations[item], "description": text} for item, text in zip(items, item_texts)}
+    return location_info, character_info, item_info
+
+
+def write_world(output_dir, location_info, character_info, item_info, triples):
+    os.makedirs(output_dir, exist_ok=True)
+    for filename, data in [("locations.json", location_info), ("characters.json", character_info),
+                           ("items.json", item_info), ("triples.json", triples)]:
+        with open(os.path.join(output_dir, filename), 'w') as outfile:
+            json.dump(data, outfile, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("story", help="text file with the story summary")
+    parser.add_argument("--output", default="world", help="directory for the world JSON files")
+    parser.add_argument("--edits", default=None, help="JSON file of manual entity corrections, see DEFAULT_EDITS")
+    parser.add_argument("--stages", default="world_stages", help="directory of cached stage outputs")
+    parser.add_argument("--force", nargs="+", default=[], choices=["ner", "openie", "filter", "qa", "describe"],
+                        help="re-run these stages even if cached")
+    parser.add_argument("--skip-openie", action="store_true", help="do not start a CoreNLP server for triples")
+    parser.add_argument("--qa-model", default="deepset/roberta-base-squad2")
+    parser.add_argument("--qa-batch-size", type=int, default=16)
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="openai")
+    parser.add_argument("--cache", default="world_completions.sqlite3", help="completion cache")
+    parser.add_argument("--workers", type=int, default=8, help="completion requests in flight")
+    args = parser.parse_args()
+
+    story = read_story(args.story)
+    story_hash = digest(story)
+    title = os.path.splitext(os.path.basename(args.story))[0]
+    edits = json.load(open(args.edits, 'r')) if args.edits else DEFAULT_EDITS
+    aliases = edits.get("aliases", {})
+    stages = StageCache(args.stages, force=args.force)
+
+    # annotation, keyed by the story alone
+    ner_key, entities = stages.run("ner", [story_hash, NER_PROCESSORS], lambda: annotate_entities(story))
+    if args.skip_openie:
+        openie_key, openie = None, {"mentions": [], "triples": []}
+    else:
+        openie_key, openie = stages.run("openie", [story_hash, OPENIE_PROPERTIES], lambda: annotate_openie(story))
+
+    # the edits only invalidate the filter and what reads from it
+    filter_key, filtered = stages.run(
+        "filter", [ner_key, openie_key, edits, sorted(STOP_WORDS)],
+        lambda: filter_entities(entities, openie, edits)
+    )
+    people, locations = filtered["people"], filtered["locations"]
+    print("Characters: " + ", ".join(people))
+    print("Locations: " + ", ".join(locations))
+
+    # keyed by the questions rather than the filter, so an edit that keeps
+    # the same people and locations (e.g. a new alias) reuses the answers
+    questions = [connection_questions(locations), 5, person_questions(people), 10]
+
+    def answer_questions():
+        qa = BatchedQA(args.qa_model, batch_size=args.qa_batch_size)
+        return {
+            "locations": qa.answer(questions[0], story, topk=questions[1]),
+            "people": qa.answer(questions[2], story, topk=questions[3])
+        }
+
+    qa_key, answers = stages.run("qa", [story_hash, args.qa_model, questions], answer_questions)
+    story_map = enhance_map(reduce_path(get_location_connections(locations, answers["locations"], aliases)))
+    person_to_location = get_location_of_person(people, locations, answers["people"], aliases)
+    # the game needs every character somewhere
+    person_to_location = {person: location for person, location in person_to_location.items() if location != "nowhere"}
+
+    def describe():
+        backend = BACKENDS[args.backend]()
+        cache = CompletionCache(args.cache)
+        try:
+            return describe_world(story, title, locations, story_map, person_to_location, backend, cache, args.workers)
+        finally:
+            cache.close()
+
+    _, world = stages.run("describe", [story_hash, title, story_map, person_to_location, args.backend], describe)
+    write_world(args.output, *world, filtered["triples"])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Batched extractive question answering over one long context.
+
+The notebook asked the QA pipeline the same question up to topk times,
+masking the previous answer in the whole story and re-running the model
+each time, once per location. Here the story is tokenized once and cut
+into overlapping windows, the questions of every location are paired with
+every window and run through the model in batches, and the topk answers of
+a question are decoded from the start/end logits of that single pass: the
+best scoring spans that do not overlap an already chosen span, which is
+what masking the previous answer approximated.
+"""
+import numpy as np
+import torch
+
+
+class BatchedQA:
+    def __init__(
+        self,
+        model_name="deepset/roberta-base-squad2",
+        max_length=384,
+        stride=128,
+        batch_size=16,
+        max_answer_length=30,
+        n_best=20,
+        device=None
+    ):
+        from transformers import AutoModelForQuestionAnswering, AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.device = device or ("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.model = AutoModelForQuestionAnswering.from_pretrained(model_name).to(self.device).eval()
+        self.model_name = model_name
+        self.max_length = max_length
+        self.stride = stride
+        self.batch_size = batch_size
+        self.max_answer_length = max_answer_length
+        self.n_best = n_best
+        # Dictionary mapping from context to its token ids and character offsets
+        self.contexts = {}
+
+    def encode_context(self, context):
+        """
+        Token ids and character offsets of a context, computed once per context.
+        """
+        if context not in self.contexts:
+            encoding = self.tokenizer(context, add_special_tokens=False, return_offsets_mapping=True)
+            self.contexts[context] = (encoding["input_ids"], encoding["offset_mapping"])
+        return self.contexts[context]
+
+    def windows(self, n_tokens, window_length):
+        """
+        Start positions of windows of window_length tokens covering the
+        context, overlapping by stride tokens.
+        """
+        step = max(1, window_length - self.stride)
+        starts = list(range(0, max(1, n_tokens - self.stride), step))
+        if starts[-1] + window_length < n_tokens:
+            starts.append(n_tokens - window_length)
+        return starts
+
+    def build_rows(self, questions, context):
+        """
+        One (question index, input_ids, context_start, window_start,
+        window_length) row per question and window. Windows have the same
+        boundaries for every question, sized for the longest question.
+        """
+        context_ids, _ = self.encode_context(context)
+        # encoding each question with a one token placeholder context gives
+        # the special tokens around it, whatever the model's pair format
+        encoding = self.tokenizer(questions, ["."] * len(questions))
+        layouts = []
+        for index, input_ids in enumerate(encoding["input_ids"]):
+            positions = [j for j, sequence in enumerate(encoding.sequence_ids(index)) if sequence == 1]
+            layouts.append((input_ids[:positions[0]], input_ids[positions[-1] + 1:]))
+        overhead = max(len(prefix) + len(suffix) for prefix, suffix in layouts)
+        window_length = min(len(context_ids), self.max_length - overhead)
+        if window_length <= 0:
+            raise ValueError("questions leave no room for the context within %d tokens" % self.max_length)
+
+        rows = []
+        for question_index, (prefix, suffix) in enumerate(layouts):
+            for window_start in self.windows(len(context_ids), window_length):
+                window = context_ids[window_start:window_start + window_length]
+                rows.append((question_index, prefix + window + suffix, len(prefix), window_start, len(window)))
+        return rows
+
+    @torch.inference_mode()
+    def logits(self, rows):
+        """
+        Start and end logits of every row, run in padded batches.
+        """
+        pad_token_id = self.tokenizer.pad_token_id
+        results = []
+        for batch_start in range(0, len(rows), self.batch_size):
+            batch = rows[batch_start:batch_start + self.batch_size]
+            length = max(len(row[1]) for row in batch)
+            input_ids = torch.full((len(batch), length), pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(batch), length), dtype=torch.long)
+            for index, row in enumerate(batch):
+                input_ids[index, :len(row[1])] = torch.tensor(row[1])
+                attention_mask[index, :len(row[1])] = 1
+            output = self.model(input_ids=input_ids.to(self.device), attention_mask=attention_mask.to(self.device))
+            start_logits = output.start_logits.float().cpu().numpy()
+            end_logits = output.end_logits.float().cpu().numpy()
+            results.extend(zip(start_logits, end_logits))
+        return results
+
+    def spans(self, start_logits, end_logits, context_start, window_start, window_length):
+        """
+        The n_best highest scoring spans of one row as (log probability,
+        first token, last token) in context token positions. Probabilities
+        are normalized over the window and the no-answer token, like the
+        question-answering pipeline does.
+        """
+        positions = np.concatenate([[0], np.arange(context_start, context_start + window_length)])
+        start_log = log_softmax(start_logits[positions])[1:]
+        end_log = log_softmax(end_logits[positions])[1:]
+        n = min(self.n_best, window_length)
+        starts = np.argpartition(-start_log, n - 1)[:n]
+        ends = np.argpartition(-end_log, n - 1)[:n]
+        scores = start_log[starts][:, None] + end_log[ends][None, :]
+        lengths = ends[None, :] - starts[:, None]
+        scores[(lengths < 0) | (lengths >= self.max_answer_length)] = -np.inf
+        spans = []
+        for i, j in zip(*np.nonzero(np.isfinite(scores))):
+            spans.append((scores[i, j], window_start + starts[i], window_start + ends[j]))
+        return spans
+
+    def answer(self, questions, context, topk=10):
+        """
+        Returns, for every question, up to topk (answer, score) pairs from
+        a single batched pass over the context, best first. Answers never
+        overlap each other in the context.
+        """
+        if not questions:
+            return []
+        _, offsets = self.encode_context(context)
+        rows = self.build_rows(questions, context)
+        candidates = [[] for _ in questions]
+        for row, (start_logits, end_logits) in zip(rows, self.logits(rows)):
+            question_index, _, context_start, window_start, window_length = row
+            candidates[question_index].extend(
+                self.spans(start_logits, end_logits, context_start, window_start, window_length)
+            )
+
+        answers = []
+        for spans in candidates:
+            chosen = []
+            taken = []
+            seen = set()
+            for score, first, last in sorted(spans, key=lambda span: span[0], reverse=True):
+                start_char, end_char = offsets[first][0], offsets[last][1]
+                text = context[start_char:end_char].strip()
+                if not text or text in seen or any(start_char < end and start < end_char for start, end in taken):
+                    continue
+                chosen.append((text, round(float(np.exp(score)), 3)))
+                taken.append((start_char, end_char))
+                seen.add(text)
+                if len(chosen) == topk:
+                    break
+            answers.append(chosen)
+        return answers
+
+
+def log_softmax(logits):
+    shifted = logits - logits.max()
+    return shifted - np.log(np.exp(shifted).sum())
@@ -0,0 +1,59 @@
+import os
+import json
+import hashlib
+
+
+# Bump the version of a stage after changing what it computes, to
+# invalidate its cached outputs and the outputs of every stage after it
+STAGE_VERSIONS = {
+    "ner": 1,
+    "openie": 1,
+    "filter": 1,
+    "qa": 1,
+    "describe": 1
+}
+
+
+def digest(value):
+    """
+    Hash of a JSON-serializable value, independent of dictionary order.
+    """
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=sorted).encode("utf-8")).hexdigest()
+
+
+class StageCache:
+    """
+    Caches the output of every stage of the world construction in
+    directory/<stage>/<key>.json, where the key hashes the stage's name and
+    version with everything its output depends on: its parameters and the
+    keys of the stages it reads from. Changing a parameter re-runs only the
+    stages downstream of it, e.g. editing the entity filter reuses the NER
+    and OpenIE annotations. Stages named in force always re-run.
+    """
+    def __init__(self, directory, force=()):
+        self.directory = directory
+        self.force = set(force)
+
+    def key(self, name, inputs):
+        return digest([name, STAGE_VERSIONS[name], inputs])
+
+    def run(self, name, inputs, function):
+        """
+        Returns (key, output) of a stage, calling function() only when no
+        output is cached for these inputs.
+        """
+        key = self.key(name, inputs)
+        filename = os.path.join(self.directory, name, key + ".json")
+        if name not in self.force and os.path.exists(filename):
+            print("%s: cached (%s)" % (name, key[:12]))
+            return key, json.load(open(filename, 'r'))
+
+        print("%s: running (%s)" % (name, key[:12]))
+        output = function()
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temporary = filename + ".tmp"
+        with open(temporary, 'w') as outfile:
+            json.dump(output, outfile, indent=4, default=sorted)
+        os.replace(temporary, filename)
+        # round trip, so a fresh output looks exactly like a cached one
+        return key, json.load(open(filename, 'r'))
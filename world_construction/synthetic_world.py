@@ -0,0 +1,224 @@
+"""
+Synthetic worlds for scale testing the engine.
+
+Generates locations.json, characters.json and items.json in exactly the
+schema of game/static/game/data, at any size and in one of several shapes:
+
+    grid         a square grid, every location connected to its neighbours
+    tree         a random tree with at most 4 children per location
+    small_world  a ring lattice with a fraction of its edges rewired at random
+    hub          preferential attachment, a few locations connected to most
+    dense        a grid whose items and characters crowd into a few rooms
+
+The same seed always generates the same world.
+
+    python -m world_construction.synthetic_world --shape grid --locations 10000 --output data/worlds/grid-10000
+"""
+import os
+import json
+import math
+import random
+import argparse
+
+
+SHAPES = ["grid", "tree", "small_world", "hub", "dense"]
+
+# None of these words contains a direction the parser reacts to
+ADJECTIVES = ["amber", "ancient", "brass", "crimson", "dusty", "emerald", "faded", "gilded", "hidden", "iron",
+              "jade", "lonely", "misty", "narrow", "opal", "quiet", "rusty", "silver", "tiled", "velvet"]
+PLACES = ["hall", "library", "garden", "cellar", "tower", "market", "chapel", "bridge", "forge", "harbor",
+          "corridor", "kitchen", "vault", "courtyard", "gallery", "stable", "archive", "lantern room", "mill", "dock"]
+THINGS = ["lamp", "key", "book", "goblet", "map", "compass", "scroll", "mirror", "wand", "cloak",
+          "coin", "candle", "bottle", "ring", "feather", "dagger", "shield", "locket", "stone", "flute"]
+FIRST_NAMES = ["Ada", "Bram", "Cora", "Dov", "Elsa", "Finn", "Gia", "Hugo", "Ivy", "Jonas",
+               "Kira", "Lev", "Mira", "Nils", "Olga", "Pavel", "Rhea", "Sven", "Tova", "Ugo"]
+LAST_NAMES = ["Quill", "Ashdown", "Marlow", "Thistle", "Crane", "Holloway", "Pike", "Rook", "Vale", "Wren"]
+
+
+def grid_edges(n, rng):
+    width = math.ceil(math.sqrt(n))
+    edges = []
+    for i in range(n):
+        if (i + 1) % width != 0 and i + 1 < n:
+            edges.append((i, i + 1))
+        if i + width < n:
+            edges.append((i, i + width))
+    return edges
+
+
+def tree_edges(n, rng, branching=4):
+    edges = []
+    children = [0] * n
+    open_parents = [0]
+    for i in range(1, n):
+        k = rng.randrange(len(open_parents))
+        parent = open_parents[k]
+        edges.append((parent, i))
+        children[parent] += 1
+        if children[parent] == branching:
+            open_parents[k] = open_parents[-1]
+            open_parents.pop()
+        open_parents.append(i)
+    return edges
+
+
+def small_world_edges(n, rng, neighbours=4, rewire=0.1):
+    """
+    Watts-Strogatz: a ring where every location is connected to its
+    neighbours/2 nearest locations on each side, then every edge moved to a
+    random location with probability rewire.
+    """
+    edges = set()
+    for i in range(n):
+        for offset in range(1, neighbours // 2 + 1):
+            j = (i + offset) % n
+            if rng.random() < rewire:
+                j = rng.randrange(n)
+            if j != i:
+                edges.add((min(i, j), max(i, j)))
+    return sorted(edges)
+
+
+def hub_edges(n, rng, attachments=2):
+    """
+    Barabasi-Albert: every new location connects to attachments existing
+    locations picked with a probability proportional to their degree.
+    """
+    edges = []
+    endpoints = []
+    for i in range(1, n):
+        targets = set()
+        while len(targets) < min(attachments, i):
+            targets.add(rng.choice(endpoints) if endpoints else 0)
+        for j in targets:
+            edges.append((j, i))
+            endpoints.extend([i, j])
+    return edges
+
+
+EDGES = {
+    "grid": grid_edges,
+    "tree": tree_edges,
+    "small_world": small_world_edges,
+    "hub": hub_edges,
+    "dense": grid_edges
+}
+
+
+def unique_names(words_a, words_b, count, rng, width, title=False):
+    """
+    count distinct names made of two words and a zero-padded number. The
+    fixed width keeps a name from being a substring of another, which the
+    parser's matching relies on.
+    """
+    names = []
+    for index in range(count):
+        name = "%s %s %0*d" % (rng.choice(words_a), rng.choice(words_b), width, index)
+        names.append(name.title() if title else name)
+    return names
+
+
+def placements(count, n_locations, rng, skew):
+    """
+    Location index of count things, uniform when skew is 0 and crowding
+    into the first few locations of a random order (Zipf) otherwise.
+    """
+    if not skew:
+        return [rng.randrange(n_locations) for _ in range(count)]
+    order = list(range(n_locations))
+    rng.shuffle(order)
+    weights = [1 / (rank + 1) ** skew for rank in range(n_locations)]
+    return rng.choices(order, weights=weights, k=count)
+
+
+def generate_world(shape="grid", n_locations=100, items_per_location=2.0, characters_per_location=0.5, seed=0, skew=None):
+    """
+    Returns (locations, characters, items) dictionaries in the schema of
+    game/static/game/data. Connections go both ways.
+    """
+    if shape not in EDGES:
+        raise ValueError("unknown shape %r, expected one of %s" % (shape, ", ".join(SHAPES)))
+    if n_locations < 6:
+        # build_game starts the player at the sixth location
+        raise ValueError("a world needs at least 6 locations")
+    if skew is None:
+        skew = 1.2 if shape == "dense" else 0.0
+    rng = random.Random(seed)
+    width = len(str(n_locations * max(1, math.ceil(max(items_per_location, characters_per_location)))))
+
+    location_names = unique_names(ADJECTIVES, PLACES, n_locations, rng, width, title=True)
+    connections = [[] for _ in range(n_locations)]
+    for i, j in EDGES[shape](n_locations, rng):
+        connections[i].append(location_names[j])
+        connections[j].append(location_names[i])
+    locations = {}
+    for index, name in enumerate(location_names):
+        locations[name] = {
+            "connections": connections[index],
+            "description": "The %s is one of %d places in this %s world." % (name, n_locations, shape.replace("_", " ")),
+            "appearance": "The %s has %s walls and a %s floor." % (name, rng.choice(ADJECTIVES), rng.choice(ADJECTIVES))
+        }
+
+    n_characters = round(n_locations * characters_per_location)
+    characters = {}
+    character_names = unique_names(FIRST_NAMES, LAST_NAMES, n_characters, rng, width)
+    for name, location in zip(character_names, placements(n_characters, n_locations, rng, skew)):
+        characters[name] = {
+            "description": "%s is a %s traveller who knows the %s well." % (name, rng.choice(ADJECTIVES), location_names[location]),
+            "appearance": "%s wears a %s cloak." % (name, rng.choice(ADJECTIVES)),
+            "location": location_names[location]
+        }
+
+    n_items = round(n_locations * items_per_location)
+    items = {}
+    item_names = unique_names(ADJECTIVES, THINGS, n_items, rng, width)
+    for name, location in zip(item_names, placements(n_items, n_locations, rng, skew)):
+        items[name] = {
+            "location": location_names[location],
+            "description": "A %s, worn by years of use." % name
+        }
+    return locations, characters, items
+
+
+def save_world(output_dir, locations, characters, items):
+    """
+    Write the world as the three files build_game reads.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for filename, data in [("locations.json", locations), ("characters.json", characters), ("items.json", items)]:
+        with open(os.path.join(output_dir, filename), 'w') as outfile:
+            json.dump(data, outfile)
+
+
+def world_filenames(output_dir):
+    """
+    The keyword arguments of build_game loading a world saved to output_dir.
+    """
+    return {
+        "locations_filename": os.path.join(output_dir, "locations.json"),
+        "characters_filename": os.path.join(output_dir, "characters.json"),
+        "items_filename": os.path.join(output_dir, "items.json")
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shape", choices=SHAPES, default="grid")
+    parser.add_argument("--locations", type=int, default=1000)
+    parser.add_argument("--items-per-location", type=float, default=2.0)
+    parser.add_argument("--characters-per-location", type=float, default=0.5)
+    parser.add_argument("--skew", type=float, default=None,
+                        help="Zipf exponent of item and character placement, 0 for uniform")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    world = generate_world(
+        args.shape, args.locations, args.items_per_location, args.characters_per_location, args.seed, args.skew
+    )
+    save_world(args.output, *world)
+    print("%d locations, %d characters, %d items written to %s" % (len(world[0]), len(world[1]), len(world[2]), args.output))
+
+
+if __name__ == '__main__':
+    main()